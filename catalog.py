@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+"""
+catalog.py.
+
+Conference server-side Python App Engine per-instance catalog of the
+upcoming conferences, kept as columns filtered in process, and refreshed
+from a change log of the conferences created or updated since
+
+"""
+
+import operator
+import threading
+import time
+from datetime import date
+from datetime import timedelta
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import storage
+from settings import CONFERENCE_CATALOG
+
+MEMCACHE_LOG_KEY = "CATALOG_CHANGES"
+# changes kept in the log; a snapshot further behind is rebuilt
+LOG_SIZE = 200
+CHECK_INTERVAL = 2
+CAS_RETRIES = 3
+# endDate is not indexed: a rebuild loads the conferences started up to
+# this many days ago, for those still running, and the undated ones
+LOOKBACK_DAYS = 366
+
+COMPARE = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+
+# integer columns, with NONE standing for a missing value
+INT_COLUMNS = ('month', 'maxAttendees', 'ends')
+NONE = -2 ** 63
+
+# per-instance snapshot, replaced whole on each refresh
+_snapshot = {'checked': 0, 'data': None}
+_lock = threading.Lock()
+
+
+def _newLog():
+    """Return an empty change log, with an epoch of its own."""
+    return (int(time.time() * 1000), 0, [])
+
+
+def _ended(conf, today):
+    """Return True if a conference ended before the ordinal day today."""
+    end = conf.endDate or conf.startDate
+    return bool(end) and end.toordinal() < today
+
+
+def matches(conf, filters, today=None, upcoming=True):
+    """
+    Return True if a conference matches (field, op, value) filters.
+
+    Like the datastore, a repeated property matches when any of its
+    values does, and a missing value matches nothing. Unless upcoming
+    is False, conferences which have ended match nothing either.
+    """
+    if conf.deleted:
+        return False
+    if upcoming and _ended(conf, today or date.today().toordinal()):
+        return False
+    for field, op, value in filters:
+        values = getattr(conf, field)
+        if field != 'topics':
+            values = [values]
+        if not any(v is not None and COMPARE[op](v, value) for v in values):
+            return False
+    return True
+
+
+class Catalog(object):
+
+    """Catalog -- columns of the upcoming conferences, a row each.
+
+    City and topics are dictionary encoded: a row holds the code of its
+    city (-1 for none) and a row of flags over the topic dictionary.
+    Filters are evaluated over the dictionaries, then looked up for all
+    rows at once. Rows of conferences which ended or were deleted stay,
+    flagged dead, until the catalog is rebuilt.
+    """
+
+    def __init__(self, epoch=None, generation=0):
+        import numpy
+        self.epoch = epoch
+        self.generation = generation
+        self.keys = []
+        self.rows = {}
+        self.names = []
+        self.cities = []
+        self.cityCodes = {}
+        self.topics = []
+        self.topicCodes = {}
+        self.live = numpy.zeros(0, dtype=bool)
+        self.city = numpy.zeros(0, dtype=numpy.int32)
+        self.topic = numpy.zeros((0, 0), dtype=bool)
+        self.month = numpy.zeros(0, dtype=numpy.int64)
+        self.maxAttendees = numpy.zeros(0, dtype=numpy.int64)
+        # ordinal of the end date, or of the start date without one
+        self.ends = numpy.zeros(0, dtype=numpy.int64)
+
+    def _copy(self, epoch, generation):
+        catalog = Catalog(epoch, generation)
+        for name in ('keys', 'names', 'cities', 'topics'):
+            setattr(catalog, name, list(getattr(self, name)))
+        for name in ('rows', 'cityCodes', 'topicCodes'):
+            setattr(catalog, name, dict(getattr(self, name)))
+        for name in ('live', 'city', 'topic') + INT_COLUMNS:
+            setattr(catalog, name, getattr(self, name).copy())
+        return catalog
+
+    @staticmethod
+    def _code(codes, values, value):
+        """Return the dictionary code of value, adding it if new."""
+        if value is None:
+            return -1
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def _grow(self):
+        """Extend the columns to every row and topic."""
+        import numpy
+        rows = len(self.keys)
+        for name in ('live', 'city') + INT_COLUMNS:
+            column = getattr(self, name)
+            if len(column) < rows:
+                grown = numpy.zeros(rows, dtype=column.dtype)
+                grown[:len(column)] = column
+                setattr(self, name, grown)
+        if self.topic.shape != (rows, len(self.topics)):
+            grown = numpy.zeros((rows, len(self.topics)), dtype=bool)
+            grown[:self.topic.shape[0], :self.topic.shape[1]] = self.topic
+            self.topic = grown
+
+    def update(self, epoch, generation, conferences):
+        """
+        Return a copy with the rows of conferences replaced.
+
+        conferences maps websafe keys to Conference entities, or to None
+        for purged ones.
+        """
+        catalog = self._copy(epoch, generation)
+        today = date.today().toordinal()
+        changes = []
+        for wsck, conf in sorted(conferences.items()):
+            row = catalog.rows.get(wsck)
+            if conf is None or conf.deleted or _ended(conf, today):
+                if row is not None:
+                    changes.append((row, None))
+                continue
+            if row is None:
+                row = catalog.rows[wsck] = len(catalog.keys)
+                catalog.keys.append(wsck)
+                catalog.names.append(None)
+            catalog.names[row] = conf.name
+            end = conf.endDate or conf.startDate
+            changes.append((row, {
+                'city': catalog._code(catalog.cityCodes, catalog.cities,
+                                      conf.city),
+                'topics': [catalog._code(catalog.topicCodes, catalog.topics,
+                                         topic) for topic in conf.topics],
+                'month': conf.month,
+                'maxAttendees': conf.maxAttendees,
+                'ends': end.toordinal() if end else None,
+            }))
+
+        catalog._grow()
+        for row, values in changes:
+            catalog.live[row] = values is not None
+            if values is None:
+                continue
+            catalog.city[row] = values['city']
+            catalog.topic[row] = False
+            catalog.topic[row, values['topics']] = True
+            for name in INT_COLUMNS:
+                value = values[name]
+                getattr(catalog, name)[row] = NONE if value is None else value
+        return catalog
+
+    def _predicate(self, field, op, value):
+        """Return the flags of the rows matching one filter."""
+        import numpy
+        compare = COMPARE[op]
+        if field == 'city' or field == 'topics':
+            values = self.cities if field == 'city' else self.topics
+            # the trailing False is looked up by the -1 of a missing city
+            matched = numpy.array([compare(v, value) for v in values] +
+                                  [False], dtype=bool)
+            if field == 'city':
+                return matched[self.city]
+            return (self.topic & matched[:-1]).any(axis=1)
+        column = getattr(self, field)
+        return (column != NONE) & compare(column, value)
+
+    def _sortKey(self, row, field):
+        name = self.names[row]
+        if field == 'city':
+            return (self.cities[self.city[row]], name)
+        if field == 'topics':
+            # ordered by the first topic, like the SQLite backend
+            return (min(self.topics[code] for code in
+                        self.topic[row].nonzero()[0]), name)
+        if field:
+            return (int(getattr(self, field)[row]), name)
+        return (name,)
+
+    def query(self, inequality_field, filters):
+        """
+        Return the websafe keys of the upcoming conferences matching
+        (field, operator, value) filters, in query order.
+
+        Any number of filters may be inequalities; conferences are
+        ordered by inequality_field, if any, then name.
+        """
+        today = date.today().toordinal()
+        flags = self.live & ((self.ends == NONE) | (self.ends >= today))
+        for field, op, value in filters:
+            flags &= self._predicate(field, op, value)
+        rows = sorted(flags.nonzero()[0],
+                      key=lambda row: self._sortKey(row, inequality_field))
+        return [self.keys[row] for row in rows]
+
+
+def _current():
+    """
+    Return the snapshot, brought up to date with the change log.
+
+    Return None when the catalog may be stale: the change log cannot be
+    read, or another request of this instance is rebuilding it.
+    """
+    catalog = _snapshot['data']
+    if catalog and time.time() - _snapshot['checked'] < CHECK_INTERVAL:
+        return catalog
+
+    log = memcache.get(MEMCACHE_LOG_KEY)
+    if log is None:
+        # a new log starts a new epoch, rebuilding every snapshot
+        memcache.add(MEMCACHE_LOG_KEY, _newLog())
+        log = memcache.get(MEMCACHE_LOG_KEY)
+        if log is None:
+            return None
+    epoch, generation, changes = log
+    if catalog and (catalog.epoch, catalog.generation) == (epoch, generation):
+        _snapshot['checked'] = time.time()
+        return catalog
+
+    if not _lock.acquire(False):
+        return None
+    try:
+        if catalog and catalog.epoch == epoch and \
+                generation - catalog.generation <= len(changes):
+            wskeys = sorted(set(wsck for gen, wsck in changes
+                                if gen > catalog.generation))
+            conferences = storage.backend().getMulti(
+                [ndb.Key(urlsafe=wsck) for wsck in wskeys])
+            catalog = catalog.update(epoch, generation,
+                                     dict(zip(wskeys, conferences)))
+        else:
+            # update() leaves out those which have ended
+            since = date.today() - timedelta(days=LOOKBACK_DAYS)
+            catalog = Catalog().update(epoch, generation, {
+                conf.key.urlsafe(): conf for conf in
+                storage.backend().iterConferences(startingFrom=since,
+                                                  undated=True)})
+        _snapshot['data'] = catalog
+        _snapshot['checked'] = time.time()
+        return catalog
+    finally:
+        _lock.release()
+
+
+def query(inequality_field, filters):
+    """
+    Return the keys of the upcoming conferences matching filters.
+
+    Return None when the catalog is disabled or may be stale, for the
+    caller to query the datastore instead.
+    """
+    if not CONFERENCE_CATALOG:
+        return None
+    catalog = _current()
+    if catalog is None:
+        return None
+    return [ndb.Key(urlsafe=wsck)
+            for wsck in catalog.query(inequality_field, filters)]
+
+
+def load():
+    """Load the catalog of this instance, used by the warmup handler."""
+    if CONFERENCE_CATALOG:
+        _current()
+
+
+def changed(wsck):
+    """
+    Log a change of the conference with websafe key wsck.
+
+    Inside a transaction this only happens once the transaction commits.
+    """
+    def append():
+        client = memcache.Client()
+        for i in range(CAS_RETRIES):
+            log = client.gets(MEMCACHE_LOG_KEY)
+            if log is None:
+                # snapshots of a lost log are rebuilt, seeing this change
+                if client.add(MEMCACHE_LOG_KEY, _newLog()):
+                    break
+                continue
+            epoch, generation, changes = log
+            changes = (changes + [(generation + 1, wsck)])[-LOG_SIZE:]
+            if client.cas(MEMCACHE_LOG_KEY,
+                          (epoch, generation + 1, changes)):
+                break
+        else:
+            client.set(MEMCACHE_LOG_KEY, _newLog())
+        # this instance sees its own changes in its next query
+        _snapshot['checked'] = 0
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(append)
+    else:
+        append()
@@ -13,8 +13,12 @@ created by Youness Assassi on 2015
 __author__ = 'Youness Assassi'
 
 from datetime import datetime
+import json
 import logging
+import time
+import uuid
 import endpoints
+import inspect
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
@@ -24,9 +28,14 @@ from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.ext.db import BadValueError
 
+from models import BatchRequestForm
+from models import BatchResponseForms
+from models import BatchResponseItem
 from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
+from models import RegistrationTicket
+from models import RegistrationTicketForm
 from models import ProfileForm
 from models import BooleanMessage
 from models import Conference
@@ -34,14 +43,35 @@ from models import ConferenceForm
 from models import ConferenceForms
 # from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import ConferenceSummary
+from models import FacetCountForm
+from models import FacetForm
+from models import FacetForms
+from models import SearchResultForm
+from models import SearchResultForms
 from models import Session
 from models import SessionForm
 from models import SessionForms
 from models import TeeShirtSize
+from models import WaitlistEntry
+from models import WaitlistPositionForm
+from models import WishListUpdateForm
 from models import StringMessage
 from models import sessionTypeChoices
 
+import models
 from utils import getUserId
+import catalog
+import facets
+import idempotency
+import mailer
+import profiler
+import ratelimit
+import recommend
+import searchindex
+import storage
+import tasklag
+import versions
 
 from settings import WEB_CLIENT_ID
 
@@ -49,6 +79,10 @@ EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER"
+MEMCACHE_WAITLIST_KEY = "WAITLIST:%s"
+MEMCACHE_TICKET_KEY = "TICKET:%s"
+MEMCACHE_REGISTRATION_WORKER_KEY = "REGISTRATION_WORKER:%s"
+MEMCACHE_HOT_CONFERENCES_KEY = "HOT_CONFERENCES"
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -80,6 +114,28 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1)
 )
 
+CONF_CONDITIONAL_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2)
+)
+
+PROFILE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1)
+)
+
+CONF_REGISTER_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    idempotencyKey=messages.StringField(2)
+)
+
+TICKET_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ticketId=messages.StringField(1)
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1)
@@ -92,12 +148,13 @@ SESS_POST_REQUEST = endpoints.ResourceContainer(
 
 SESS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    websafeConferenceKey=messages.StringField(1)
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2)
 )
 
 SESSION_WISHLIST_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    sessionId=messages.StringField(1),
+    websafeConferenceKey=messages.StringField(1),
 )
 
 SESSION_WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
@@ -109,6 +166,87 @@ REMOVE_SESSION_WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1)
 )
 
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1, required=True),
+    kind=messages.StringField(2),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+)
+
+RECOMMEND_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    limit=messages.IntegerField(1),
+)
+
+RECOMMENDATIONS = 10
+MAX_RECOMMENDATIONS = 50
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+# read-only methods that can be multiplexed through the batch endpoint,
+# mapped to the tasklet serving them
+BATCH_METHODS = {
+    'getProfile': '_batchGetProfile',
+    'getConferencesToAttend': '_batchGetConferencesToAttend',
+    'getConference': '_batchGetConference',
+    'getConferenceSessions': '_batchGetConferenceSessions',
+    'getSessionsInWishList': '_batchGetSessionsInWishList',
+    'getAnnouncement': '_batchGetAnnouncement',
+    'getFeaturedSpeaker': '_batchGetFeaturedSpeaker',
+}
+
+# batch methods needing the authenticated user's Profile
+BATCH_AUTH_METHODS = ('getProfile', 'getConferencesToAttend',
+                      'getSessionsInWishList')
+
+MAX_BATCH_SIZE = 20
+
+MAX_WISHLIST_SIZE = 100
+
+# waitlisted users registered per promotion transaction; each one adds
+# a Profile entity group to the cross-group transaction
+WAITLIST_PROMOTION_BATCH = 20
+WAITLIST_CACHE_TTL = 60
+
+# number of most recently registered for conferences loaded into the
+# cache on warmup
+WARMUP_HOT_CONFERENCES = 20
+
+# sessions written per put when copying a changed conference summary
+SUMMARY_PUT_BATCH = 200
+# sessions whose wishlists are found with one IN query, of at most 30
+WISHLIST_QUERY_BATCH = 30
+
+# queued registrations wait on a pull queue, tagged by conference, for
+# the conference's one worker, started REGISTRATION_BATCH_WINDOW seconds
+# after the first ticket and chained while tickets remain
+REGISTRATION_QUEUE = 'registration'
+REGISTRATION_BATCH_WINDOW = 1
+REGISTRATION_LEASE_SECONDS = 60
+REGISTRATION_LEASE_BATCH = 240
+REGISTRATION_WORKER_SECONDS = 60
+# the running worker's flag; a crashed worker blocks a new one this long
+REGISTRATION_WORKER_TTL = REGISTRATION_WORKER_SECONDS * 3
+# tickets committed per transaction; with the Conference, each Profile
+# is one of the 25 entity groups a cross-group transaction may use
+REGISTRATION_BATCH = 24
+TICKET_CACHE_TTL = 60 * 60
+TICKET_QUEUED = 'QUEUED'
+TICKET_REGISTERED = 'REGISTERED'
+TICKET_REJECTED = 'REJECTED'
+
+# a deleted conference is purged by a chain of tasks, each working for
+# DELETE_WORKER_SECONDS; sessions are deleted DELETE_BATCH at a time, and
+# the profiles referring to them are scrubbed by tasks of SCRUB_BATCH
+DELETE_WORKER_SECONDS = 60
+# the wishlists of a batch are found with one IN query, of at most 30
+DELETE_BATCH = 30
+SCRUB_BATCH = 100
+# profiles per scrubbing transaction, each its own entity group
+SCRUB_XG_BATCH = 25
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -160,6 +298,10 @@ class ConferenceApi(remote.Service):
                 for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['idempotencyKey']
+        del data['etag']
+        del data['notModified']
+        del data['version']
 
         # add default values for those missing
         # (both data model & outbound Message)
@@ -186,37 +328,47 @@ class ConferenceApi(remote.Service):
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
+        c_key = storage.backend().allocateKey(Conference, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={
-            'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        conf = Conference(**data)
+        storage.backend().put(conf)
+        catalog.changed(c_key.urlsafe())
+        mailer.enqueue('conferenceCreated', user.email(), c_key.urlsafe())
+        taskqueue.add(params=tasklag.params({'websafeKey': c_key.urlsafe()}),
+                      url='/tasks/index_document')
+        facets.enqueueDelta({}, facets.facetValues(conf))
 
         return request
 
-    @ndb.transactional()
     def _updateConferenceObject(self, request):
+        # authenticate and look up the organizer's name before the
+        # transaction, so it only holds the conference's entity group
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
+        prof = storage.backend().get(ndb.Key(Profile, user_id))
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
+        conf = self._updateConferenceTxn(request, user_id)
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+
+    @storage.transactional()
+    def _updateConferenceTxn(self, request, user_id):
+        """
+        Apply the provided fields to the stored Conference.
 
+        With a version, the update is a compare-and-set: it fails with a
+        409 if the conference changed since the client read it.
+        """
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = storage.backend().get(
+            ndb.Key(urlsafe=request.websafeConferenceKey))
         # check that conference exists
-        if not conf:
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' %
                 request.websafeConferenceKey)
@@ -225,26 +377,59 @@ class ConferenceApi(remote.Service):
         if user_id != conf.organizerUserId:
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
+        if request.version is not None and request.version != conf.version:
+            raise ConflictException(
+                'The conference was changed since version %d, it is now '
+                'at version %d. Reload it and retry.'
+                % (request.version, conf.version))
+        old_facets = facets.facetValues(conf)
+        old_summary = ConferenceSummary.fromConference(conf)
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        changed = set()
         for field in request.all_fields():
+            if field.name in ('etag', 'notModified', 'version'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
-                    if field.name == 'startDate':
+                    if field.name == 'startDate' and conf.month != data.month:
                         conf.month = data.month
+                        changed.add('month')
+                if field.name in Conference._properties and \
+                        getattr(conf, field.name) != data:
+                    changed.add(field.name)
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        if not changed:
+            # nothing to write, reindex or invalidate
+            return conf
+        conf.version += 1
+        storage.backend().put(conf)
+        taskqueue.add(params=tasklag.params(
+                      {'websafeKey': conf.key.urlsafe()}),
+                      url='/tasks/index_document',
+                      transactional=ndb.in_transaction())
+        versions.bump('schedule', conf.key.urlsafe())
+        versions.bump('conference', conf.key.urlsafe())
+        catalog.changed(conf.key.urlsafe())
+        facets.enqueueDelta(old_facets, facets.facetValues(conf))
+        if ConferenceSummary.fromConference(conf) != old_summary:
+            # copy the new summary onto the sessions in the background
+            taskqueue.add(params=tasklag.params(
+                          {'websafeConferenceKey': conf.key.urlsafe()}),
+                          url='/tasks/update_session_summaries',
+                          transactional=ndb.in_transaction())
+        return conf
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
+    @idempotency.idempotent('createConference', ConferenceForm)
+    @ratelimit.limited('createConference')
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -254,7 +439,7 @@ class ConferenceApi(remote.Service):
                       http_method='POST',
                       name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
+        """Query for conferences, optionally only those not yet ended."""
         conferences = self._getQuery(request)
 
         # return individual ConferenceForm object per Conference
@@ -270,20 +455,198 @@ class ConferenceApi(remote.Service):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/delete',
+                      http_method='POST', name='deleteConference')
+    def deleteConference(self, request):
+        """
+        Delete a conference, with its sessions and registrations.
+
+        The conference is marked deleted at once, and hidden from then on;
+        its sessions and the profiles referring to it are purged by tasks.
+        """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        self._deleteConferenceTxn(request.websafeConferenceKey,
+                                  getUserId(user))
+        return BooleanMessage(data=True)
+
+    @storage.transactional()
+    def _deleteConferenceTxn(self, wsck, user_id):
+        """Mark a conference deleted and enqueue its purge."""
+        conf = storage.backend().get(ndb.Key(urlsafe=wsck))
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        # check that user is owner
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+        old_facets = facets.facetValues(conf)
+
+        # no seats are left to take, or to hand to the waitlist
+        conf.deleted = True
+        conf.seatsAvailable = 0
+        conf.seatsReleased = 0
+        conf.version += 1
+        storage.backend().put(conf)
+        taskqueue.add(params=tasklag.params({'websafeKey': wsck}),
+                      url='/tasks/index_document',
+                      transactional=ndb.in_transaction())
+        taskqueue.add(params=tasklag.params({'websafeConferenceKey': wsck}),
+                      url='/tasks/delete_conference',
+                      transactional=ndb.in_transaction())
+        for kind in ('conference', 'schedule', 'sessions'):
+            versions.bump(kind, wsck)
+        catalog.changed(wsck)
+        facets.enqueueDelta(old_facets, {})
+
+    @staticmethod
+    def _purgeConference(wsck, cursor=None):
+        """
+        Delete the sessions, registrations and waitlist of a conference.
+
+        used by the delete conference task queue; re-enqueues itself with
+        its progress when its time is up. Sessions are deleted a batch of
+        keys at a time, once the wishlists holding them are scrubbed, then
+        the registrations are scrubbed from the attendees' profiles.
+        """
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = storage.backend().get(c_key)
+        if not conf or not conf.deleted:
+            return
+        deadline = time.time() + DELETE_WORKER_SECONDS
+
+        def reenqueue(cursor=None):
+            params = {'websafeConferenceKey': wsck}
+            if cursor:
+                params['cursor'] = cursor
+            taskqueue.add(params=tasklag.params(params),
+                          url='/tasks/delete_conference')
+
+        # sessions: a retried batch finds its sessions already gone
+        if not cursor:
+            while True:
+                if time.time() > deadline:
+                    return reenqueue()
+                s_keys = storage.backend().sessionKeysByConference(
+                    c_key, DELETE_BATCH)
+                if not s_keys:
+                    break
+                ConferenceApi._enqueueScrub(wsck, [
+                    p_key.id() for p_key in
+                    storage.backend().profileKeysWishing(s_keys)])
+                storage.backend().deleteMulti(s_keys)
+                taskqueue.Queue().add([
+                    taskqueue.Task(params=tasklag.params(
+                                   {'websafeKey': s_key.urlsafe()}),
+                                   url='/tasks/index_document')
+                    for s_key in s_keys])
+
+        # registrations, paged by cursor as profiles are only updated
+        # by the scrubbing tasks
+        more = True
+        while more:
+            if time.time() > deadline:
+                return reenqueue(cursor)
+            p_keys, cursor, more = storage.backend().profileKeysAttending(
+                wsck, SCRUB_BATCH, cursor)
+            ConferenceApi._enqueueScrub(wsck, [p_key.id()
+                                               for p_key in p_keys])
+
+        storage.backend().deleteMulti(
+            storage.backend().waitlistKeys(c_key) + [c_key])
+        storage.backend().cacheDelete(MEMCACHE_WAITLIST_KEY % wsck)
+        catalog.changed(wsck)
+
+    @staticmethod
+    def _enqueueScrub(wsck, user_ids):
+        """Enqueue tasks scrubbing a conference from profiles."""
+        tasks = [taskqueue.Task(params=tasklag.params({
+                 'websafeConferenceKey': wsck,
+                 'userIds': json.dumps(user_ids[i:i + SCRUB_BATCH])}),
+                 url='/tasks/scrub_profiles')
+                 for i in range(0, len(user_ids), SCRUB_BATCH)]
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            taskqueue.Queue().add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+    @staticmethod
+    def _scrubProfiles(wsck, user_ids):
+        """
+        Remove a deleted conference from registrations and wishlists.
+
+        used by the scrub profiles task queue.
+        """
+        for i in range(0, len(user_ids), SCRUB_XG_BATCH):
+            for prof in ConferenceApi._scrubProfilesTxn(
+                    wsck, user_ids[i:i + SCRUB_XG_BATCH]):
+                recommend.invalidate(prof.key.id())
+                versions.bump('profile', prof.key.id())
+                if prof.feedToken:
+                    versions.bump('wishlist', prof.feedToken)
+
+    @staticmethod
+    @storage.transactional(xg=True)
+    def _scrubProfilesTxn(wsck, user_ids):
+        """Scrub a conference from profiles; return those changed."""
+        c_key = ndb.Key(urlsafe=wsck)
+        changed = []
+        for prof in storage.backend().getMulti([ndb.Key(Profile, user_id)
+                                                for user_id in user_ids]):
+            if not prof:
+                continue
+            migrated = prof.migrateWishList()
+            wishList = [s_key for s_key in prof.wishList
+                        if s_key.parent() != c_key]
+            if migrated or wsck in prof.conferenceKeysToAttend or \
+                    len(wishList) != len(prof.wishList):
+                prof.conferenceKeysToAttend = [
+                    key for key in prof.conferenceKeysToAttend
+                    if key != wsck]
+                prof.wishList = wishList
+                changed.append(prof)
+        storage.backend().putMulti(changed)
+        return changed
+
+    def _ifNoneMatch(self, request, header=True):
+        """Return the ETag the client already holds, if any."""
+        etag = request.ifNoneMatch
+        if not etag and header:
+            etag = self.request_state.headers.get('If-None-Match')
+        if etag:
+            return etag.replace('W/', '').strip('"')
+
+    def _conferenceEtag(self, c_key):
+        """Return the ETag of a conference and its organizer's name."""
+        stamps = versions.getMulti([('conference', c_key.urlsafe()),
+                                    ('profile', c_key.parent().id())])
+        return '%s.%s' % (stamps[('conference', c_key.urlsafe())],
+                          stamps[('profile', c_key.parent().id())])
+
+    @endpoints.method(CONF_CONDITIONAL_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
+        # read the version before the data, so the ETag is never newer
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        etag = self._conferenceEtag(c_key)
+        if etag == self._ifNoneMatch(request):
+            return ConferenceForm(etag=etag, notModified=True)
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        conf = storage.backend().get(c_key)
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' %
                 request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        prof = storage.backend().get(conf.key.parent())
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf.etag = etag
+        return cf
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='getConferencesCreated',
@@ -295,36 +658,67 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        # get all the conferences of this user
+        confs = storage.backend().conferencesByOrganizer(user_id)
+        prof = storage.backend().get(ndb.Key(Profile, user_id))
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
             items=[self._copyConferenceToForm(conf, getattr(prof,
                                                             'displayName'))
-                   for conf in confs]
+                   for conf in confs if not conf.deleted]
+        )
+
+    @endpoints.method(message_types.VoidMessage, FacetForms,
+                      path='conferences/facets',
+                      http_method='GET', name='getConferenceFacets')
+    def getConferenceFacets(self, request):
+        """Return conference counts per city, topic and month."""
+        return FacetForms(
+            items=[FacetForm(name=facet,
+                             counts=[FacetCountForm(value=value, count=count)
+                                     for value, count in sorted(
+                                         counts.items(),
+                                         key=lambda c: (-c[1], c[0]))
+                                     if count > 0])
+                   for facet, counts in sorted(facets.getFacets().items())]
         )
 
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
+        """Return the conferences matching the submitted filters."""
         inequality_filter, filters = self._formatFilters(request.filters)
 
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
                 filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"],
-                                                   filtr["operator"],
-                                                   filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+        filters = [(filtr["field"], filtr["operator"], filtr["value"])
+                   for filtr in filters]
+
+        keys = None
+        if request.upcomingOnly:
+            # the catalog holds the upcoming conferences only
+            keys = catalog.query(inequality_filter, filters)
+        if keys is not None:
+            conferences = storage.backend().getMulti(keys)
+        else:
+            # the datastore takes inequalities on one field only
+            if len(set(field for field, op, value in filters
+                       if op != '=')) > 1:
+                if not request.upcomingOnly:
+                    raise endpoints.BadRequestException(
+                        "Inequality filter is allowed on only one field.")
+                # the catalog is unavailable; the other fields are
+                # checked below
+                query_filters = [(field, op, value)
+                                 for field, op, value in filters
+                                 if op == '=' or field == inequality_filter]
+            else:
+                query_filters = filters
+            conferences = storage.backend().queryConferences(
+                inequality_filter, query_filters)
+        # also drops conferences changed since the catalog's last refresh
+        return [conf for conf in conferences
+                if conf and catalog.matches(conf, filters,
+                                            upcoming=request.upcomingOnly)]
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
@@ -342,20 +736,10 @@ class ConferenceApi(remote.Service):
                 raise endpoints.BadRequestException("Filter contains invalid \
                                                      field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used
-                # in previous filters
-                # disallow the filter if inequality was performed on a
-                # different field before
-                # track the field on which the inequality
-                # operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality \
-                                                         filter is allowed on \
-                                                         only one field.")
-                else:
-                    inequality_field = filtr["field"]
+            # Every operation except "=" is an inequality; results are
+            # sorted on the field of the first one
+            if filtr["operator"] != "=" and not inequality_field:
+                inequality_field = filtr["field"]
 
             formatted_filters.append(filtr)
         return (inequality_field, formatted_filters)
@@ -368,22 +752,48 @@ class ConferenceApi(remote.Service):
         prof = self._getProfileFromUser()  # get user Profile
         conf_keys = [ndb.Key(urlsafe=wsck)
                      for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        # conferences being deleted stay registered until purged
+        conferences = [conf for conf in storage.backend().getMulti(conf_keys)
+                       if conf and not conf.deleted]
 
         # get organizers
         organisers = [ndb.Key(Profile, conf.organizerUserId)
                       for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        profiles = storage.backend().getMulti(organisers)
 
         # put display names in a dict for easier fetching
         names = {}
         for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+            if profile:
+                names[profile.key.id()] = profile.displayName
 
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
             items=[self._copyConferenceToForm(conf,
-                   names[conf.organizerUserId])
+                   names.get(conf.organizerUserId))
+                   for conf in conferences]
+        )
+
+    @endpoints.method(RECOMMEND_REQUEST, ConferenceForms,
+                      path='conferences/recommended',
+                      http_method='GET', name='getRecommendedConferences')
+    def getRecommendedConferences(self, request):
+        """Get upcoming conferences similar to the user's conferences."""
+        prof = self._getProfileFromUser()  # get user Profile
+        limit = min(request.limit or RECOMMENDATIONS, MAX_RECOMMENDATIONS)
+        conferences = [conf for conf in storage.backend().getMulti(
+                       recommend.recommend(prof, limit))
+                       if conf and not conf.deleted]
+
+        # get organizers
+        profiles = storage.backend().getMulti(
+            [ndb.Key(Profile, conf.organizerUserId) for conf in conferences])
+        names = {profile.key.id(): profile.displayName
+                 for profile in profiles if profile}
+
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf,
+                   names.get(conf.organizerUserId))
                    for conf in conferences]
         )
 
@@ -402,9 +812,39 @@ class ConferenceApi(remote.Service):
                             getattr(session, field.name))
             elif field.name == "websafeKey":
                     setattr(sessionForm, field.name, session.key.urlsafe())
+        sessionForm.websafeConferenceKey = session.key.parent().urlsafe()
+        summary = session.conference
+        if summary:
+            sessionForm.conferenceName = summary.name
+            sessionForm.conferenceCity = summary.city
+            if summary.startDate:
+                sessionForm.conferenceStartDate = str(summary.startDate)
+            if summary.endDate:
+                sessionForm.conferenceEndDate = str(summary.endDate)
         sessionForm.check_initialized()
         return sessionForm
 
+    def _copySessionsToForms(self, sessions):
+        """
+        Copy Sessions to a SessionForms, with their conference summaries.
+
+        Sessions created before summaries were stored get them from one
+        batch read of their conferences.
+        """
+        sessions = [session for session in sessions if session]
+        c_keys = list(set(session.key.parent() for session in sessions
+                          if not session.conference))
+        if c_keys:
+            summaries = {conf.key: ConferenceSummary.fromConference(conf)
+                         for conf in storage.backend().getMulti(c_keys)
+                         if conf}
+            for session in sessions:
+                if not session.conference:
+                    session.conference = summaries.get(session.key.parent())
+        return SessionForms(
+            items=[self._copySessionToForm(session) for session in sessions]
+        )
+
     def _createSessionObject(self, request):
         """Create or update Session object, returning SessionForm/request."""
         # preload necessary data items
@@ -417,8 +857,8 @@ class ConferenceApi(remote.Service):
         wsck = request.websafeConferenceKey
 
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
+        conf = storage.backend().get(ndb.Key(urlsafe=wsck))
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s'
                 % wsck)
@@ -439,6 +879,10 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
         del data['websafeConferenceKey']
+        del data['idempotencyKey']
+        for field in ('conferenceName', 'conferenceCity',
+                      'conferenceStartDate', 'conferenceEndDate'):
+            del data[field]
 
         # convert date from string to Date object
         if data['startDate']:
@@ -452,80 +896,156 @@ class ConferenceApi(remote.Service):
         # generate Session Key based on conference key and session id
         c_key = conf.key
 
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=c_key)
+        s_key = storage.backend().allocateKey(Session, parent=c_key)
         data['key'] = s_key
+        data['conference'] = ConferenceSummary.fromConference(conf)
         del data['websafeKey']
 
         # create Session
         # creation of Session & return (modified) SessionForm
         session = Session(**data)
-        session.put()
+        storage.backend().put(session)
 
         # set a taskqueue to set the featured speaker
-        taskqueue.add(params={
+        taskqueue.add(params=tasklag.params({
             "speaker": data['speaker'],
-            "wsck": wsck},
+            "wsck": wsck}),
             url='/tasks/set_featured_speaker')
+        taskqueue.add(params=tasklag.params({'websafeKey': s_key.urlsafe()}),
+                      url='/tasks/index_document')
+        versions.bump('schedule', c_key.urlsafe())
+        versions.bump('sessions', c_key.urlsafe())
 
         return self._copySessionToForm(session)
 
-    def _addSessionToWishList(self, request):
-        """ add Session to user wishlist."""
-        retval = None
+    @staticmethod
+    def _updateSessionSummaries(wsck):
+        """
+        Copy the summary of a conference onto its sessions.
+
+        used by the update session summaries task queue.
+        """
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = storage.backend().get(c_key)
+        if not conf or conf.deleted:
+            return
+        summary = ConferenceSummary.fromConference(conf)
+        sessions = [session for session in
+                    storage.backend().sessionsByConference(c_key)
+                    if session.conference != summary]
+        for session in sessions:
+            session.conference = summary
+        for i in range(0, len(sessions), SUMMARY_PUT_BATCH):
+            storage.backend().putMulti(sessions[i:i + SUMMARY_PUT_BATCH])
+        if not sessions:
+            return
+        versions.bump('sessions', wsck)
+        # the wishlist feeds holding these sessions show the summary too
+        for i in range(0, len(sessions), WISHLIST_QUERY_BATCH):
+            p_keys = storage.backend().profileKeysWishing(
+                [session.key for session
+                 in sessions[i:i + WISHLIST_QUERY_BATCH]])
+            for prof in storage.backend().getMulti(p_keys):
+                if prof and prof.feedToken:
+                    versions.bump('wishlist', prof.feedToken)
+
+    def _sessionKey(self, wssk):
+        """Return the Session key for a websafe key; bail if invalid."""
+        try:
+            s_key = ndb.Key(urlsafe=wssk)
+        except Exception:
+            s_key = None
+        if not s_key or s_key.kind() != 'Session':
+            raise endpoints.BadRequestException(
+                'Invalid session key: %s' % wssk)
+        return s_key
+
+    def _conferenceKey(self, wsck):
+        """Return the Conference key for a websafe key; bail if invalid."""
+        try:
+            c_key = ndb.Key(urlsafe=wsck)
+        except Exception:
+            c_key = None
+        if not c_key or c_key.kind() != 'Conference':
+            raise endpoints.BadRequestException(
+                'Invalid conference key: %s' % wsck)
+        return c_key
+
+    def _updateWishList(self, add=(), remove=()):
+        """
+        Add and remove sessions from the user wishlist.
+
+        Return the updated Profile and the keys actually added and removed.
+        """
         prof = self._getProfileFromUser()  # get user Profile
 
-        # get requested session
-        session = ndb.Key(urlsafe=request.websafeSessionKey).get()
-        # check if the session is in db
-        # wssk = request.websafeSessionKey
-        # session = ndb.Key(urlsafe=wssk).get()
-        if not session:
+        # check that new sessions exist, outside of the transaction;
+        # those of a conference being deleted are about to go
+        wishList = set(prof.wishList)
+        new = [s_key for s_key in add if s_key not in wishList]
+        found = storage.backend().getMulti(
+            new + list(set(s_key.parent() for s_key in new)))
+        if not all(found) or any(conf.deleted for conf in found[len(new):]):
             raise ConflictException(
                 "No session found with this key")
 
-        # add session to wishlist
-        # check that the key is not in wishlist
-        if request.websafeSessionKey in prof.wishList:
+        return self._updateWishListTxn(prof.key, add, remove)
+
+    @storage.transactional()
+    def _updateWishListTxn(self, p_key, add, remove):
+        """Apply wishlist changes to the stored Profile."""
+        prof = storage.backend().get(p_key)
+        changed = prof.migrateWishList()
+        wishList = set(prof.wishList)
+
+        removed = [s_key for s_key in set(remove) if s_key in wishList]
+        added = []
+        for s_key in add:
+            if s_key not in wishList:
+                wishList.add(s_key)
+                added.append(s_key)
+        if removed:
+            prof.wishList = [s_key for s_key in prof.wishList
+                             if s_key not in removed]
+        prof.wishList.extend(added)
+        if len(prof.wishList) > MAX_WISHLIST_SIZE:
             raise ConflictException(
-                "You already added the session to your wishList")
-        else:
-            # add session key
-            prof.wishList.append(request.websafeSessionKey)
-            retval = True
-            prof.put()
+                "Your wishList can hold at most %d sessions"
+                % MAX_WISHLIST_SIZE)
 
-        return retval
+        if added or removed or changed:
+            storage.backend().put(prof)
+            recommend.invalidate(prof.key.id())
+            versions.bump('profile', prof.key.id())
+            if prof.feedToken:
+                versions.bump('wishlist', prof.feedToken)
+        return prof, added, removed
 
-    def _removeSessionFromWishList(self, request):
-        """Remove Session from Wish List."""
-        retval = None
-        prof = self._getProfileFromUser()  # get user Profile
-
-        # check if the session is in db
-        wssk = request.websafeSessionKey
-        session = ndb.Key(urlsafe=wssk).get()
-        if not session:
+    def _addSessionToWishList(self, request):
+        """ add Session to user wishlist."""
+        s_key = self._sessionKey(request.websafeSessionKey)
+        prof, added, removed = self._updateWishList(add=[s_key])
+        # check that the key was not in wishlist
+        if not added:
             raise ConflictException(
-                "No session found with this key")
+                "You already added the session to your wishList")
+        return True
 
-        # remove session from wishlist
-        # check that the key is in wishlist
-        if wssk in prof.wishList:
-            # remove from wishlist
-            prof.wishList.remove(wssk)
-            prof.put()
-            retval = True
-        else:
-            retval = False
+    def _removeSessionFromWishList(self, request):
+        """Remove Session from Wish List."""
+        s_key = self._sessionKey(request.websafeSessionKey)
+        prof, added, removed = self._updateWishList(remove=[s_key])
+        # check that the key was in wishlist
+        if not removed:
             raise ConflictException(
                 "You have not added this session to your wishList")
-
-        return retval
+        return True
 
     @endpoints.method(SESS_POST_REQUEST, SessionForm,
                       path='conference/{websafeConferenceKey}/session',
                       http_method='POST', name='createSession')
+    @idempotency.idempotent('createSession', SessionForm)
+    @ratelimit.limited('createSession')
     def createSession(self, request):
         """Create new session."""
         return self._createSessionObject(request)
@@ -535,20 +1055,24 @@ class ConferenceApi(remote.Service):
                       http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
         """Return requested sessions (by websafeConferenceKey)."""
+        etag = str(versions.get('sessions', request.websafeConferenceKey))
+        if etag == self._ifNoneMatch(request):
+            return SessionForms(etag=etag, notModified=True)
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf = storage.backend().get(c_key)
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' %
                 request.websafeConferenceKey)
 
-        # create ancestor query for this conference
-        sessions = Session.query(ancestor=ndb.Key
-                                 (urlsafe=request.websafeConferenceKey))
+        # get the sessions of this conference
+        sessions = storage.backend().sessionsByConference(c_key)
 
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        forms = self._copySessionsToForms(sessions)
+        forms.etag = etag
+        return forms
 
     @endpoints.method(SESS_GET_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/sesssionsbytype',
@@ -560,55 +1084,40 @@ class ConferenceApi(remote.Service):
         (by websafeConferenceKey and session type).
         """
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf = storage.backend().get(c_key)
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' %
                 request.websafeConferenceKey)
 
-        # create ancestor query for this conference
-        sessions = Session.query(ancestor=ndb.Key
-                                 (urlsafe=request.websafeConferenceKey))
-
         # check for valid session type
         if request.sessionType not in sessionTypeChoices:
             raise BadValueError("Value  %s for property sessionType \
                 is not an allowed choice" % request.sessionType)
 
-        sessions = sessions.filter(Session.sessionType ==
-                                   request.sessionType)
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        # get the sessions of this conference of this type
+        sessions = storage.backend().sessionsByConference(
+            c_key, sessionType=request.sessionType)
+        return self._copySessionsToForms(sessions)
 
     @endpoints.method(SessionForm, SessionForms,
                       path='sesssionsbyspeaker',
                       http_method='GET', name='getSessionsBySpeaker')
     def getSessionsBySpeaker(self, request):
         """Return requested sessions (by speaker)."""
-        # create a Session query
-        sessions = Session.query()
-        sessions = sessions.filter(Session.speaker ==
-                                   request.speaker)
+        sessions = storage.backend().sessionsBySpeaker(request.speaker)
 
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        return self._copySessionsToForms(sessions)
 
     @endpoints.method(SessionForm, SessionForms,
                       path='sesssionsbyspeakeroftype',
                       http_method='POST', name='getSessionsBySpeakerOfType')
     def getSessionsBySpeakerOfType(self, request):
         """Return requested sessions (by speaker and type)."""
-        # create a Session Query
-        sessions = Session.query()
-        sessions = sessions.filter(Session.speaker ==
-                                   request.speaker)
-        sessions = sessions.filter(Session.sessionType ==
-                                   request.sessionType)
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        sessions = storage.backend().sessionsBySpeaker(
+            request.speaker, sessionType=request.sessionType)
+        return self._copySessionsToForms(sessions)
 
     @endpoints.method(SessionForm, SessionForms,
                       path='sesssionsstartingAfter',
@@ -619,17 +1128,13 @@ class ConferenceApi(remote.Service):
 
         (starting after a certain time).
         """
-        # create a Session query
-        sessions = Session.query()
-
         # convert time from string to Time object;
+        startTime = None
         if request.startTime:
             startTime = datetime.strptime(request.startTime[:5],
                                           "%H:%M").time()
-            sessions = sessions.filter(Session.startTime >= startTime)
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        sessions = storage.backend().sessionsStartingAfter(startTime)
+        return self._copySessionsToForms(sessions)
 
 # - - - Wishlist - - - - - - - - - - - - - - - - - - - -
     # add the session to the user's list of sessions they are
@@ -637,26 +1142,62 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESSION_WISHLIST_POST_REQUEST, BooleanMessage,
                       path='addSessionToWishlist',
                       http_method='POST', name='addSessionToWishlist')
+    @ratelimit.limited('addSessionToWishlist')
     def addSessionToWishlist(self, request):
         """Add Session to wishlist."""
         return BooleanMessage(data=self._addSessionToWishList(request))
 
+    # add and remove many sessions in one transaction
+    @endpoints.method(WishListUpdateForm, ProfileForm,
+                      path='wishlist', http_method='POST',
+                      name='updateWishList')
+    @ratelimit.limited('updateWishList')
+    def updateWishList(self, request):
+        """Add and remove sessions from wishlist, return the profile."""
+        prof, added, removed = self._updateWishList(
+            add=[self._sessionKey(wssk) for wssk in request.add],
+            remove=[self._sessionKey(wssk) for wssk in request.remove])
+        return self._copyProfileToForm(prof)
+
+    @endpoints.method(message_types.VoidMessage, StringMessage,
+                      path='wishlist/feed', http_method='GET',
+                      name='getWishListFeed')
+    def getWishListFeed(self, request):
+        """Return the path of the user's wishlist calendar feed."""
+        prof = self._getProfileFromUser()
+        token = prof.feedToken or self._setFeedTokenTxn(prof.key)
+        return StringMessage(data='/feeds/wishlist/%s.ics' % token)
+
+    @staticmethod
+    @storage.transactional()
+    def _setFeedTokenTxn(p_key):
+        """Give the stored Profile a wishlist feed token; return it."""
+        prof = storage.backend().get(p_key)
+        if not prof.feedToken:
+            prof.migrateWishList()
+            prof.feedToken = uuid.uuid4().hex
+            storage.backend().put(prof)
+        return prof.feedToken
+
     # query for all the sessions in a conference that the user is interested in
     # getSessionInWishlist()
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(SESSION_WISHLIST_GET_REQUEST, SessionForms,
                       path='sessions/wishlist', http_method='GET',
                       name='getSessionsInWishList')
     def getSessionsInWishList(self, request):
-        """Get Sessions from WishList."""
+        """Get Sessions from WishList, optionally of one conference."""
         prof = self._getProfileFromUser()
-        session_keys = [ndb.Key(urlsafe=wssk)
-                        for wssk in prof.wishList]
-        sessions = ndb.get_multi(session_keys)
+        session_keys = prof.wishList
+        # sessions are children of their conference; filter on the keys
+        # so sessions of other conferences are never fetched
+        if request.websafeConferenceKey:
+            c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+            session_keys = [s_key for s_key in session_keys
+                            if s_key.parent() == c_key]
+        sessions = storage.backend().getMulti(session_keys)
 
         # return set of SessionForm objects per Session
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        return self._copySessionsToForms(sessions)
 
     # removes the session from the user's list of sessions they are
     # interested in attending
@@ -664,23 +1205,37 @@ class ConferenceApi(remote.Service):
     @endpoints.method(REMOVE_SESSION_WISHLIST_POST_REQUEST, BooleanMessage,
                       path='wishlist/session/{websafeSessionKey}',
                       http_method='DELETE', name='removeSessionFromWishList')
+    @ratelimit.limited('removeSessionFromWishList')
     def removeSessionFromWishList(self, request):
         """Remove Session from user's wishlist."""
         return BooleanMessage(data=self._removeSessionFromWishList(request))
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
-    @ndb.transactional(xg=True)
-    def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
+    @storage.transactional(xg=True)
+    def _conferenceRegistration(self, request, reg=True,
+                                idempotencyKey=None):
+        """
+        Register or unregister user for selected conference.
+
+        A repeated idempotencyKey replays the stored result; the result is
+        stored in the user's entity group, within the same transaction.
+        """
         retval = None
         prof = self._getProfileFromUser()  # get user Profile
+        endpoint = 'registerForConference' if reg \
+            else 'unregisterFromConference'
+        if idempotencyKey:
+            stored = idempotency.lookup(prof.key.id(), endpoint,
+                                        idempotencyKey, BooleanMessage)
+            if stored is not None:
+                return stored
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
+        conf = storage.backend().get(ndb.Key(urlsafe=wsck))
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
@@ -694,11 +1249,14 @@ class ConferenceApi(remote.Service):
             # check if seats avail
             if conf.seatsAvailable <= 0:
                 raise ConflictException(
-                    "There are no seats available.")
+                    "There are no seats available. Join the waitlist to "
+                    "be registered when a seat frees up.")
 
             # register user, take away one seat
             prof.conferenceKeysToAttend.append(wsck)
             conf.seatsAvailable -= 1
+            mailer.enqueue('registered', prof.mainEmail, wsck)
+            self._recordHotConference(wsck)
             retval = True
 
         # unregister
@@ -708,29 +1266,411 @@ class ConferenceApi(remote.Service):
 
                 # unregister user, add back one seat
                 prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
+                if conf.waitlistSize:
+                    # hand the seat to the waitlist, not to whoever
+                    # retries registering first
+                    conf.seatsReleased += 1
+                    taskqueue.add(params=tasklag.params(
+                                  {'websafeConferenceKey': wsck}),
+                                  url='/tasks/promote_waitlist',
+                                  transactional=ndb.in_transaction())
+                else:
+                    conf.seatsAvailable += 1
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        # write things back to the datastore & return; unregistering
+        # when not registered changes nothing
+        if retval:
+            storage.backend().putMulti([prof, conf])
+            recommend.invalidate(prof.key.id())
+            versions.bump('profile', prof.key.id())
+            versions.bump('conference', wsck)
+        response = BooleanMessage(data=retval)
+        if idempotencyKey:
+            idempotency.store(prof.key.id(), endpoint, idempotencyKey,
+                              response)
+        return response
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @staticmethod
+    def _recordHotConference(wsck):
+        """
+        Note a registration for the warmup, once the transaction commits.
+
+        Only the latest WARMUP_HOT_CONFERENCES conferences are kept; a
+        registration lost to a concurrent update is of no consequence.
+        """
+        def record():
+            hot = storage.backend().cacheGet(MEMCACHE_HOT_CONFERENCES_KEY)
+            hot = [wsck] + [key for key in hot or [] if key != wsck]
+            storage.backend().cacheSet(MEMCACHE_HOT_CONFERENCES_KEY,
+                                       hot[:WARMUP_HOT_CONFERENCES])
+        storage.backend().onCommit(record)
+
+    @endpoints.method(CONF_REGISTER_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST', name='registerForConference')
+    @ratelimit.limited('registerForConference')
     def registerForConference(self, request):
         """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        return self._conferenceRegistration(
+            request, idempotencyKey=idempotency.getKey(self, request))
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @endpoints.method(CONF_REGISTER_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE', name='unregisterFromConference')
+    @ratelimit.limited('unregisterFromConference')
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
-        return self._conferenceRegistration(request, reg=False)
+        return self._conferenceRegistration(
+            request, reg=False,
+            idempotencyKey=idempotency.getKey(self, request))
+
+# - - - Waitlist - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _invalidateWaitlist(wsck):
+        """Drop the cached waitlist order once the transaction commits."""
+        storage.backend().onCommit(lambda: storage.backend().cacheDelete(
+            MEMCACHE_WAITLIST_KEY % wsck))
+
+    def _joinWaitlist(self, request):
+        """Add user to the waitlist of a sold out conference."""
+        prof = self._getProfileFromUser()  # get user Profile
+        return self._joinWaitlistTxn(request.websafeConferenceKey, prof.key)
+
+    @storage.transactional(xg=True)
+    def _joinWaitlistTxn(self, wsck, p_key):
+        """Add the stored Profile to a conference waitlist."""
+        c_key = ndb.Key(urlsafe=wsck)
+        e_key = ndb.Key(WaitlistEntry, p_key.id(), parent=c_key)
+        conf, entry, prof = storage.backend().getMulti([c_key, e_key, p_key])
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        if wsck in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if conf.seatsAvailable > 0:
+            raise ConflictException(
+                "There are seats available, register instead.")
+
+        if entry:
+            raise ConflictException(
+                "You are already on the waitlist for this conference")
+
+        conf.waitlistSize += 1
+        storage.backend().putMulti([WaitlistEntry(key=e_key), conf])
+        versions.bump('conference', wsck)
+        self._invalidateWaitlist(wsck)
+        return BooleanMessage(data=True)
+
+    def _leaveWaitlist(self, request):
+        """Remove user from the waitlist of a conference."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return self._leaveWaitlistTxn(request.websafeConferenceKey,
+                                      getUserId(user))
+
+    @storage.transactional()
+    def _leaveWaitlistTxn(self, wsck, user_id):
+        """Remove a user's entry from a conference waitlist."""
+        c_key = ndb.Key(urlsafe=wsck)
+        e_key = ndb.Key(WaitlistEntry, user_id, parent=c_key)
+        conf, entry = storage.backend().getMulti([c_key, e_key])
+        if not entry or conf.deleted:
+            return BooleanMessage(data=False)
+
+        storage.backend().delete(e_key)
+        conf.waitlistSize -= 1
+        if not conf.waitlistSize:
+            # nobody left to hand released seats to
+            conf.seatsAvailable += conf.seatsReleased
+            conf.seatsReleased = 0
+        storage.backend().put(conf)
+        versions.bump('conference', wsck)
+        self._invalidateWaitlist(wsck)
+        return BooleanMessage(data=True)
+
+    @staticmethod
+    @storage.transactional(xg=True)
+    def _promoteWaitlist(wsck):
+        """
+        Register waitlisted users for released seats, first come first.
+
+        used by the promote waitlist task queue; re-enqueues itself while
+        released seats and waitlisted users remain.
+        """
+        conf = storage.backend().get(ndb.Key(urlsafe=wsck))
+        if not conf or conf.deleted or not conf.seatsReleased:
+            return
+
+        e_keys = storage.backend().waitlistKeys(
+            conf.key, min(conf.seatsReleased, WAITLIST_PROMOTION_BATCH))
+        profiles = storage.backend().getMulti(
+            [ndb.Key(Profile, e_key.id()) for e_key in e_keys])
+        promoted = []
+        for prof in profiles:
+            if prof and wsck not in prof.conferenceKeysToAttend:
+                prof.conferenceKeysToAttend.append(wsck)
+                promoted.append(prof)
+                recommend.invalidate(prof.key.id())
+
+        storage.backend().deleteMulti(e_keys)
+        conf.waitlistSize -= len(e_keys)
+        conf.seatsReleased -= len(promoted)
+        if not conf.waitlistSize:
+            conf.seatsAvailable += conf.seatsReleased
+            conf.seatsReleased = 0
+        elif conf.seatsReleased:
+            taskqueue.add(params=tasklag.params(
+                          {'websafeConferenceKey': wsck}),
+                          url='/tasks/promote_waitlist',
+                          transactional=ndb.in_transaction())
+        storage.backend().putMulti([conf] + promoted)
+        versions.bump('conference', wsck)
+        for prof in promoted:
+            versions.bump('profile', prof.key.id())
+        mailer.enqueue('waitlistPromoted',
+                       [prof.mainEmail for prof in promoted], wsck)
+        ConferenceApi._invalidateWaitlist(wsck)
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='POST', name='joinWaitlist')
+    @ratelimit.limited('joinWaitlist')
+    def joinWaitlist(self, request):
+        """Join the waitlist of a sold out conference."""
+        return self._joinWaitlist(request)
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='DELETE', name='leaveWaitlist')
+    @ratelimit.limited('leaveWaitlist')
+    def leaveWaitlist(self, request):
+        """Leave the waitlist of a conference."""
+        return self._leaveWaitlist(request)
+
+    @endpoints.method(CONF_GET_REQUEST, WaitlistPositionForm,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='GET', name='getWaitlistPosition')
+    def getWaitlistPosition(self, request):
+        """Return the user's position on a conference waitlist (0 if off)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        # the waitlist order is cached, so polling costs one cache get
+        wsck = request.websafeConferenceKey
+        order = storage.backend().cacheGet(MEMCACHE_WAITLIST_KEY % wsck)
+        if order is None:
+            order = [e_key.id() for e_key in
+                     storage.backend().waitlistKeys(ndb.Key(urlsafe=wsck))]
+            storage.backend().cacheSet(MEMCACHE_WAITLIST_KEY % wsck, order,
+                                       time=WAITLIST_CACHE_TTL)
+
+        position = order.index(user_id) + 1 if user_id in order else 0
+        return WaitlistPositionForm(position=position,
+                                    waitlistSize=len(order))
+
+# - - - Queued registration - - - - - - - - - - - - - - - - - -
+
+    def _ticketForm(self, ticket_id, record):
+        """Return the RegistrationTicketForm of a cached ticket record."""
+        return RegistrationTicketForm(
+            ticketId=ticket_id,
+            websafeConferenceKey=record['websafeConferenceKey'],
+            status=record['status'],
+            reason=record.get('reason'))
+
+    @endpoints.method(CONF_GET_REQUEST, RegistrationTicketForm,
+                      path='conference/{websafeConferenceKey}/registrations',
+                      http_method='POST', name='queueRegistration')
+    @ratelimit.limited('queueRegistration')
+    def queueRegistration(self, request):
+        """
+        Queue a registration for a high-demand conference.
+
+        Return a ticket to poll with getRegistrationTicket; queued
+        registrations are committed in batches, one Conference write for
+        many seats.
+        """
+        prof = self._getProfileFromUser()  # get user Profile
+        wsck = request.websafeConferenceKey
+        self._conferenceKey(wsck)
+
+        ticket_id = uuid.uuid4().hex
+        taskqueue.Queue(REGISTRATION_QUEUE).add(taskqueue.Task(
+            payload=json.dumps(tasklag.params({'ticketId': ticket_id,
+                                               'userId': prof.key.id()})),
+            method='PULL', tag=wsck))
+        record = {'userId': prof.key.id(), 'websafeConferenceKey': wsck,
+                  'status': TICKET_QUEUED}
+        memcache.set(MEMCACHE_TICKET_KEY % ticket_id, record,
+                     time=TICKET_CACHE_TTL)
+
+        # start the worker after the window, so it finds a batch of
+        # tickets, unless the conference has one running
+        if memcache.add(MEMCACHE_REGISTRATION_WORKER_KEY % wsck, True,
+                        time=REGISTRATION_WORKER_TTL):
+            taskqueue.add(params=tasklag.params(
+                          {'websafeConferenceKey': wsck}),
+                          url='/tasks/process_registrations',
+                          countdown=REGISTRATION_BATCH_WINDOW)
+        return self._ticketForm(ticket_id, record)
+
+    @endpoints.method(TICKET_GET_REQUEST, RegistrationTicketForm,
+                      path='registrations/{ticketId}',
+                      http_method='GET', name='getRegistrationTicket')
+    def getRegistrationTicket(self, request):
+        """Return the status of a queued registration."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        # polling costs one memcache get; a ticket is cached from when it
+        # is queued, and the datastore has it once resolved, so a ticket
+        # missing from both was never issued (or evicted while queued)
+        ticket_id = request.ticketId
+        record = memcache.get(MEMCACHE_TICKET_KEY % ticket_id)
+        if record is None:
+            ticket = storage.backend().get(
+                ndb.Key(Profile, user_id, RegistrationTicket, ticket_id))
+            if not ticket:
+                raise endpoints.NotFoundException(
+                    'No ticket found with id: %s' % ticket_id)
+            record = {'userId': user_id,
+                      'websafeConferenceKey': ticket.websafeConferenceKey,
+                      'status': ticket.status, 'reason': ticket.reason}
+            memcache.set(MEMCACHE_TICKET_KEY % ticket_id, record,
+                         time=TICKET_CACHE_TTL)
+        if record['userId'] != user_id:
+            raise endpoints.NotFoundException(
+                'No ticket found with id: %s' % ticket_id)
+        return self._ticketForm(ticket_id, record)
+
+    @staticmethod
+    def _processRegistrations(wsck):
+        """
+        Commit the queued registrations of a conference, in batches.
+
+        used by the process registrations task queue; runs until the
+        conference's tickets are drained, or hands over to the next
+        worker when its time is up, so one worker runs per conference.
+        """
+        queue = taskqueue.Queue(REGISTRATION_QUEUE)
+        worker_key = MEMCACHE_REGISTRATION_WORKER_KEY % wsck
+        deadline = time.time() + REGISTRATION_WORKER_SECONDS
+        while True:
+            if time.time() > deadline:
+                memcache.set(worker_key, True, time=REGISTRATION_WORKER_TTL)
+                taskqueue.add(params=tasklag.params(
+                              {'websafeConferenceKey': wsck}),
+                              url='/tasks/process_registrations')
+                return
+            tasks = queue.lease_tasks_by_tag(REGISTRATION_LEASE_SECONDS,
+                                             REGISTRATION_LEASE_BATCH,
+                                             tag=wsck)
+            if not tasks:
+                # tickets queued while this worker runs start none, so
+                # look once more after clearing the flag
+                memcache.delete(worker_key)
+                tasks = queue.lease_tasks_by_tag(REGISTRATION_LEASE_SECONDS,
+                                                 REGISTRATION_LEASE_BATCH,
+                                                 tag=wsck)
+                if not tasks:
+                    return
+                if not memcache.add(worker_key, True,
+                                    time=REGISTRATION_WORKER_TTL):
+                    # a new worker started meanwhile; leave them to it
+                    for task in tasks:
+                        queue.modify_task_lease(task, 0)
+                    return
+            for i in range(0, len(tasks), REGISTRATION_BATCH):
+                batch = tasks[i:i + REGISTRATION_BATCH]
+                started = time.time()
+                payloads = [json.loads(task.payload) for task in batch]
+                tickets = ConferenceApi._registerBatch(wsck, payloads)
+                memcache.set_multi({
+                    MEMCACHE_TICKET_KEY % ticket.key.id(): {
+                        'userId': ticket.key.parent().id(),
+                        'websafeConferenceKey': wsck,
+                        'status': ticket.status,
+                        'reason': ticket.reason}
+                    for ticket in tickets}, time=TICKET_CACHE_TTL)
+                queue.delete_tasks(batch)
+                finished = time.time()
+                tasklag.recordMulti([
+                    ('registration', tasklag.enqueuedAt(payload), started,
+                     finished, task.retry_count, True)
+                    for task, payload in zip(batch, payloads)])
+
+    @staticmethod
+    @storage.transactional(xg=True)
+    def _registerBatch(wsck, payloads):
+        """
+        Resolve queued tickets in one transaction, first come first.
+
+        The Conference is written once for all the seats taken. Tickets
+        already resolved by an earlier lease of the same tasks are
+        returned unchanged.
+        """
+        c_key = ndb.Key(urlsafe=wsck)
+        t_keys = [ndb.Key(Profile, payload['userId'],
+                          RegistrationTicket, payload['ticketId'])
+                  for payload in payloads]
+        p_keys = list(set(t_key.parent() for t_key in t_keys))
+        entities = storage.backend().getMulti([c_key] + p_keys + t_keys)
+        conf = entities[0]
+        profiles = dict(zip(p_keys, entities[1:len(p_keys) + 1]))
+
+        tickets = []
+        new = []
+        registered = []
+        for t_key, ticket in zip(t_keys, entities[len(p_keys) + 1:]):
+            if not ticket:
+                prof = profiles[t_key.parent()]
+                ticket = RegistrationTicket(key=t_key,
+                                            websafeConferenceKey=wsck,
+                                            status=TICKET_REJECTED)
+                if not conf or conf.deleted:
+                    ticket.reason = 'No conference found with key: %s' % (
+                        wsck)
+                elif not prof:
+                    ticket.reason = 'No profile found'
+                elif wsck in prof.conferenceKeysToAttend:
+                    ticket.reason = ('You have already registered for '
+                                     'this conference')
+                elif conf.seatsAvailable <= 0:
+                    ticket.reason = ('There are no seats available. Join '
+                                     'the waitlist to be registered when '
+                                     'a seat frees up.')
+                else:
+                    prof.conferenceKeysToAttend.append(wsck)
+                    conf.seatsAvailable -= 1
+                    ticket.status = TICKET_REGISTERED
+                    registered.append(prof)
+                new.append(ticket)
+            tickets.append(ticket)
+
+        storage.backend().putMulti(
+            ([conf] if registered else []) + registered + new)
+        if registered:
+            # one notification task for the batch: a transaction may
+            # only add a few tasks
+            mailer.enqueue('registered',
+                           [prof.mainEmail for prof in registered], wsck)
+            versions.bump('conference', wsck)
+            ConferenceApi._recordHotConference(wsck)
+        for prof in registered:
+            recommend.invalidate(prof.key.id())
+            versions.bump('profile', prof.key.id())
+        return tickets
 
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
@@ -745,6 +1685,9 @@ class ConferenceApi(remote.Service):
                     setattr(pf,
                             field.name,
                             getattr(TeeShirtSize, getattr(prof, field.name)))
+                elif field.name == 'wishList':
+                    setattr(pf, field.name,
+                            [s_key.urlsafe() for s_key in prof.wishList])
                 else:
                     setattr(pf, field.name, getattr(prof, field.name))
         pf.check_initialized()
@@ -756,6 +1699,11 @@ class ConferenceApi(remote.Service):
 
         Creating new one if non-existent.
         """
+        return self._getProfileFromUserAsync().get_result()
+
+    @ndb.tasklet
+    def _getProfileFromUserAsync(self):
+        """Tasklet version of _getProfileFromUser()."""
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
@@ -764,7 +1712,11 @@ class ConferenceApi(remote.Service):
         # get Profile from datastore
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = yield storage.backend().getAsync(p_key)
+        if profile:
+            # convert a wishlist stored before it held keys; saved with
+            # the profile's next write
+            profile.migrateWishList()
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -773,9 +1725,9 @@ class ConferenceApi(remote.Service):
                 mainEmail=user.email(),
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            yield storage.backend().putAsync(profile)
 
-        return profile   # return Profile
+        raise ndb.Return(profile)   # return Profile
 
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
@@ -787,26 +1739,47 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
-            for field in ('displayName', 'teeShirtSize'):
-                if hasattr(save_request, field):
-                    val = getattr(save_request, field)
-                    if val:
-                        if field == 'teeShirtSize':
-                            setattr(prof, field, str(val).upper())
-                        else:
-                            setattr(prof, field, val)
-
-            # put profile to datastore
-            prof.put()
+            prof = self._saveProfileTxn(prof.key, save_request)
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
-    @endpoints.method(message_types.VoidMessage, ProfileForm,
+    @staticmethod
+    @storage.transactional()
+    def _saveProfileTxn(p_key, save_request):
+        """Write the user-modifyable fields onto the stored Profile."""
+        prof = storage.backend().get(p_key)
+        changed = prof.migrateWishList()
+        for field in ('displayName', 'teeShirtSize'):
+            if hasattr(save_request, field):
+                val = getattr(save_request, field)
+                if val:
+                    if field == 'teeShirtSize':
+                        val = str(val).upper()
+                    if getattr(prof, field) != val:
+                        setattr(prof, field, val)
+                        changed = True
+
+        # put profile to datastore, unless saved unchanged
+        if changed:
+            storage.backend().put(prof)
+            versions.bump('profile', prof.key.id())
+        return prof
+
+    @endpoints.method(PROFILE_GET_REQUEST, ProfileForm,
                       path='profile', http_method='GET', name='getProfile')
     def getProfile(self, request):
         """Return user profile."""
-        return self._doProfile()
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        etag = str(versions.get('profile', getUserId(user)))
+        if etag == self._ifNoneMatch(request):
+            return ProfileForm(etag=etag, notModified=True)
+
+        pf = self._doProfile()
+        pf.etag = etag
+        return pf
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
                       path='profile', http_method='POST', name='saveProfile')
@@ -824,24 +1797,22 @@ class ConferenceApi(remote.Service):
 
         used by memcache cron job & putAnnouncement().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
+        names = storage.backend().nearlySoldOut(5)
 
-        if confs:
+        if names:
             # If there are almost sold out conferences,
             # format announcement and set it in memcache
             announcement = '%s %s' % (
                 'Last chance to attend! The following conferences '
                 'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+                ', '.join(names))
+            storage.backend().cacheSet(MEMCACHE_ANNOUNCEMENTS_KEY,
+                                       announcement)
         else:
             # If there are no sold out conferences,
             # delete the memcache announcements entry
             announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            storage.backend().cacheDelete(MEMCACHE_ANNOUNCEMENTS_KEY)
 
         return announcement
 
@@ -855,12 +1826,11 @@ class ConferenceApi(remote.Service):
         # check if speaker name should be featured
         speakerName = request.get('speaker')
 
-        # create ancestor query for this conference
-        sessionQuery = Session.query(ancestor=ndb.Key
-                                     (urlsafe=request.get('wsck')))
-        sessions = sessionQuery.filter(Session.speaker == speakerName)
+        # get the speaker's sessions of this conference
+        sessions = storage.backend().sessionsByConference(
+            ndb.Key(urlsafe=request.get('wsck')), speaker=speakerName)
 
-        if sessions.count() > 1:
+        if len(sessions) > 1:
             # get session names where the speaker is speaking
             sessionNames = []
             for session in sessions:
@@ -874,7 +1844,8 @@ class ConferenceApi(remote.Service):
                 'for the following sessions',
                 sessionNamesSting)
 
-            memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, announcement)
+            storage.backend().cacheSet(MEMCACHE_FEATURED_SPEAKER_KEY,
+                                       announcement)
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path="speaker/featured",
@@ -882,7 +1853,8 @@ class ConferenceApi(remote.Service):
     def getFeaturedSpeaker(self, request):
         """Get featured speaker."""
         # return an existing featured announcement from Memcache.
-        announcement = memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY)
+        announcement = storage.backend().cacheGet(
+            MEMCACHE_FEATURED_SPEAKER_KEY)
         if not announcement:
             announcement = ""
         return StringMessage(data=announcement)
@@ -893,10 +1865,191 @@ class ConferenceApi(remote.Service):
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
         # return an existing announcement from Memcache or an empty string.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        announcement = storage.backend().cacheGet(MEMCACHE_ANNOUNCEMENTS_KEY)
         if not announcement:
             announcement = ""
         return StringMessage(data=announcement)
 
-# registers API
-api = endpoints.api_server([ConferenceApi])
+# - - - Search - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(SEARCH_REQUEST, SearchResultForms,
+                      path='search', http_method='GET', name='search')
+    def search(self, request):
+        """Search conferences and sessions by keywords, best match first."""
+        if request.kind not in (None, 'Conference', 'Session'):
+            raise endpoints.BadRequestException(
+                "Search 'kind' must be Conference or Session")
+        limit = min(request.pageSize or SEARCH_PAGE_SIZE,
+                    MAX_SEARCH_PAGE_SIZE)
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid 'pageToken'")
+
+        hits, next_offset = searchindex.query(
+            request.query, kind=request.kind, offset=offset, limit=limit)
+        return SearchResultForms(
+            items=[SearchResultForm(kind=doc.kind,
+                                    websafeKey=doc.key.id(),
+                                    title=doc.title,
+                                    score=score)
+                   for doc, score in hits],
+            nextPageToken=str(next_offset) if next_offset else None
+        )
+
+# - - - Warmup - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _warmup():
+        """
+        Prepare a new instance before it serves traffic.
+
+        used by the /_ah/warmup handler.
+        """
+        # resolve the lazily bound message and enum field types
+        for name, cls in inspect.getmembers(models, inspect.isclass):
+            if issubclass(cls, messages.Message):
+                for field in cls.all_fields():
+                    field.type
+
+        # prime the announcement caches
+        if storage.backend().cacheGet(MEMCACHE_ANNOUNCEMENTS_KEY) is None:
+            ConferenceApi._cacheAnnouncement()
+        storage.backend().cacheGet(MEMCACHE_FEATURED_SPEAKER_KEY)
+        catalog.load()
+
+        # load the conferences most recently registered for into the
+        # storage cache
+        hot = storage.backend().cacheGet(MEMCACHE_HOT_CONFERENCES_KEY)
+        storage.backend().getMulti([ndb.Key(urlsafe=wsck)
+                                    for wsck in hot or []])
+
+# - - - Batch - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(BatchRequestForm, BatchResponseForms,
+                      path='batch', http_method='POST', name='batch')
+    def batch(self, request):
+        """Run several read-only API calls in one round trip."""
+        if len(request.items) > MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                'A batch may contain at most %d items.' % MAX_BATCH_SIZE)
+
+        # authenticate and load the Profile once for the whole batch
+        prof_future = None
+        if any(item.method in BATCH_AUTH_METHODS for item in request.items):
+            prof_future = self._getProfileFromUserAsync()
+
+        # run all sub-requests concurrently and wait for every one of them
+        futures = [self._runBatchItem(item, prof_future)
+                   for item in request.items]
+        ndb.Future.wait_all(futures)
+        return BatchResponseForms(items=[f.get_result() for f in futures])
+
+    @ndb.tasklet
+    def _runBatchItem(self, item, prof_future):
+        """Dispatch a batch sub-request, capturing its errors."""
+        try:
+            if item.method not in BATCH_METHODS:
+                raise endpoints.BadRequestException(
+                    'Method %s cannot be batched.' % item.method)
+            resp = yield getattr(self, BATCH_METHODS[item.method])(
+                item, prof_future)
+        except endpoints.ServiceException as e:
+            resp = BatchResponseItem(status=e.http_status, error=str(e))
+        except Exception as e:
+            logging.exception('batch item %s failed', item.method)
+            resp = BatchResponseItem(status=500, error=str(e))
+        resp.id = item.id
+        resp.method = item.method
+        raise ndb.Return(resp)
+
+    @ndb.tasklet
+    def _batchGetProfile(self, item, prof_future):
+        prof = yield prof_future
+        etag = str(versions.get('profile', prof.key.id()))
+        if etag == self._ifNoneMatch(item, header=False):
+            pf = ProfileForm(etag=etag, notModified=True)
+        else:
+            pf = self._copyProfileToForm(prof)
+            pf.etag = etag
+        raise ndb.Return(BatchResponseItem(profile=pf))
+
+    @ndb.tasklet
+    def _batchGetConferencesToAttend(self, item, prof_future):
+        prof = yield prof_future
+        conferences = yield storage.backend().getMultiAsync(
+            [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend])
+        conferences = [conf for conf in conferences
+                       if conf and not conf.deleted]
+        profiles = yield storage.backend().getMultiAsync(
+            [ndb.Key(Profile, conf.organizerUserId) for conf in conferences])
+        names = {profile.key.id(): profile.displayName
+                 for profile in profiles if profile}
+        raise ndb.Return(BatchResponseItem(conferences=ConferenceForms(
+            items=[self._copyConferenceToForm(
+                   conf, names.get(conf.organizerUserId))
+                   for conf in conferences])))
+
+    @ndb.tasklet
+    def _batchGetConference(self, item, prof_future):
+        c_key = self._conferenceKey(item.websafeConferenceKey)
+        etag = self._conferenceEtag(c_key)
+        if etag == self._ifNoneMatch(item, header=False):
+            raise ndb.Return(BatchResponseItem(
+                conference=ConferenceForm(etag=etag, notModified=True)))
+
+        conf = yield storage.backend().getAsync(c_key)
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' %
+                item.websafeConferenceKey)
+        prof = yield storage.backend().getAsync(conf.key.parent())
+        form = self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        form.etag = etag
+        raise ndb.Return(BatchResponseItem(conference=form))
+
+    @ndb.tasklet
+    def _batchGetConferenceSessions(self, item, prof_future):
+        c_key = self._conferenceKey(item.websafeConferenceKey)
+        etag = str(versions.get('sessions', item.websafeConferenceKey))
+        if etag == self._ifNoneMatch(item, header=False):
+            raise ndb.Return(BatchResponseItem(
+                sessions=SessionForms(etag=etag, notModified=True)))
+
+        conf, sessions = yield (
+            storage.backend().getAsync(c_key),
+            storage.backend().sessionsByConferenceAsync(c_key))
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' %
+                item.websafeConferenceKey)
+        forms = self._copySessionsToForms(sessions)
+        forms.etag = etag
+        raise ndb.Return(BatchResponseItem(sessions=forms))
+
+    @ndb.tasklet
+    def _batchGetSessionsInWishList(self, item, prof_future):
+        prof = yield prof_future
+        session_keys = prof.wishList
+        if item.websafeConferenceKey:
+            c_key = self._conferenceKey(item.websafeConferenceKey)
+            session_keys = [s_key for s_key in session_keys
+                            if s_key.parent() == c_key]
+        sessions = yield storage.backend().getMultiAsync(session_keys)
+        raise ndb.Return(BatchResponseItem(
+            sessions=self._copySessionsToForms(sessions)))
+
+    @ndb.tasklet
+    def _batchGetAnnouncement(self, item, prof_future):
+        announcement = yield storage.backend().cacheGetAsync(
+            MEMCACHE_ANNOUNCEMENTS_KEY)
+        raise ndb.Return(BatchResponseItem(data=announcement or ""))
+
+    @ndb.tasklet
+    def _batchGetFeaturedSpeaker(self, item, prof_future):
+        announcement = yield storage.backend().cacheGetAsync(
+            MEMCACHE_FEATURED_SPEAKER_KEY)
+        raise ndb.Return(BatchResponseItem(data=announcement or ""))
+
+# registers API; admins profile a call with an X-Conference-Profile header
+api = profiler.middleware(endpoints.api_server([ConferenceApi]))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+facets.py.
+
+Conference server-side Python App Engine facet counts (conferences per
+city, topic and month), kept in sharded aggregate entities
+
+"""
+
+import json
+import logging
+import random
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import AppliedFacetTask
+from models import FacetShard
+
+import storage
+import tasklag
+
+# facet name -> Conference property it counts
+FACETS = {
+    'city': 'city',
+    'topic': 'topics',
+    'month': 'month',
+}
+
+FACET_SHARDS = 10
+MEMCACHE_FACETS_KEY = "CONFERENCE_FACETS"
+FACET_CACHE_TTL = 600
+# applied task names are kept well past the last retry of their task
+APPLIED_TASK_TTL = timedelta(days=2)
+APPLIED_TASK_BATCH = 500
+
+
+def _shardKey(facet, shard):
+    return ndb.Key(FacetShard, '%s:%d' % (facet, shard))
+
+
+def facetValues(conf):
+    """Return the facet values of a Conference, as {facet: [values]}."""
+    values = {}
+    if conf:
+        for facet, name in FACETS.items():
+            value = getattr(conf, name)
+            if not isinstance(value, list):
+                # conferences without a start date have month 0
+                value = [] if value in (None, '', 0) else [value]
+            values[facet] = [str(v) for v in value]
+    return values
+
+
+def enqueueDelta(old, new):
+    """
+    Enqueue the count changes between two sets of facet values.
+
+    Inside a transaction the task is only added if the transaction
+    commits.
+    """
+    deltas = {}
+    for facet in FACETS:
+        delta = {}
+        for value in old.get(facet, []):
+            delta[value] = delta.get(value, 0) - 1
+        for value in new.get(facet, []):
+            delta[value] = delta.get(value, 0) + 1
+        delta = {value: n for value, n in delta.items() if n}
+        if delta:
+            deltas[facet] = delta
+    if deltas:
+        taskqueue.add(params=tasklag.params({'deltas': json.dumps(deltas)}),
+                      url='/tasks/update_facets',
+                      transactional=ndb.in_transaction())
+
+
+@ndb.transactional(xg=True)
+def _applyDeltas(task_name, deltas):
+    """Apply count changes unless the named task already did."""
+    s_keys = [_shardKey(facet, random.randrange(FACET_SHARDS))
+              for facet in deltas]
+    t_key = ndb.Key(AppliedFacetTask, task_name)
+    entities = ndb.get_multi(s_keys + [t_key])
+    if entities[-1]:
+        return
+    shards = []
+    for s_key, shard, delta in zip(s_keys, entities, deltas.values()):
+        shard = shard or FacetShard(key=s_key, counts={})
+        for value, n in delta.items():
+            count = shard.counts.get(value, 0) + n
+            if count:
+                shard.counts[value] = count
+            else:
+                shard.counts.pop(value, None)
+        shards.append(shard)
+    ndb.put_multi(shards + [AppliedFacetTask(key=t_key)])
+
+
+def applyDeltas(deltas, task_name):
+    """
+    Apply count changes, each facet to a random shard.
+
+    The shards are written in one transaction with a marker of the task,
+    so a retried task applies its changes once.
+    """
+    _applyDeltas(task_name, deltas)
+    memcache.delete(MEMCACHE_FACETS_KEY)
+
+
+def _purgeAppliedTasks():
+    """Delete the markers of tasks too old to be retried."""
+    query = AppliedFacetTask.query(
+        AppliedFacetTask.applied < datetime.utcnow() - APPLIED_TASK_TTL)
+    while True:
+        t_keys = query.fetch(APPLIED_TASK_BATCH, keys_only=True)
+        if not t_keys:
+            break
+        ndb.delete_multi(t_keys)
+
+
+def _sumShards():
+    """Return the counts of every facet summed over its shards."""
+    facets = {facet: {} for facet in FACETS}
+    shards = ndb.get_multi([_shardKey(facet, shard) for facet in FACETS
+                            for shard in range(FACET_SHARDS)])
+    for shard in shards:
+        if shard:
+            counts = facets[shard.key.id().rsplit(':', 1)[0]]
+            for value, n in shard.counts.items():
+                counts[value] = counts.get(value, 0) + n
+    return facets
+
+
+def getFacets():
+    """Return the counts of every facet, as {facet: {value: count}}."""
+    facets = memcache.get(MEMCACHE_FACETS_KEY)
+    if facets is None:
+        facets = _sumShards()
+        memcache.set(MEMCACHE_FACETS_KEY, facets, time=FACET_CACHE_TTL)
+    return facets
+
+
+def rebuild():
+    """
+    Recount every facet from the Conference entities.
+
+    Log the values whose maintained count was wrong, then replace the
+    shards with the verified counts. Return the number of mismatches.
+    """
+    _purgeAppliedTasks()
+    actual = {facet: {} for facet in FACETS}
+    for conf in storage.backend().iterConferences():
+        if conf.deleted:
+            continue
+        for facet, values in facetValues(conf).items():
+            for value in values:
+                actual[facet][value] = actual[facet].get(value, 0) + 1
+
+    maintained = _sumShards()
+    mismatches = 0
+    for facet in FACETS:
+        for value in set(actual[facet]) | set(maintained[facet]):
+            if actual[facet].get(value, 0) != maintained[facet].get(value, 0):
+                mismatches += 1
+                logging.warning('facet %s=%s counted %d, actual %d',
+                                facet, value,
+                                maintained[facet].get(value, 0),
+                                actual[facet].get(value, 0))
+
+    if mismatches:
+        shards = []
+        for facet in FACETS:
+            shards.append(FacetShard(key=_shardKey(facet, 0),
+                                     counts=actual[facet]))
+            shards.extend(FacetShard(key=_shardKey(facet, shard), counts={})
+                          for shard in range(1, FACET_SHARDS))
+        ndb.put_multi(shards)
+        memcache.delete(MEMCACHE_FACETS_KEY)
+    return mismatches
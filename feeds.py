@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+feeds.py.
+
+Conference server-side Python App Engine iCalendar feeds of conference
+schedules and personal wishlists
+
+"""
+
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import app_identity
+
+import storage
+
+ICS_LINE_LIMIT = 75
+
+
+def _escape(text):
+    """Escape a TEXT value (RFC 5545, 3.3.11)."""
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n')
+            .replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Fold a content line longer than the limit (RFC 5545, 3.1)."""
+    line = line.encode('utf-8') if isinstance(line, unicode) else line
+    parts = []
+    while len(line) > ICS_LINE_LIMIT:
+        cut = ICS_LINE_LIMIT if not parts else ICS_LINE_LIMIT - 1
+        # don't split a multi-byte utf-8 character
+        while cut and (ord(line[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+    parts.append(line)
+    return '\r\n '.join(parts)
+
+
+def _event(session, stamp, conf_name=None):
+    """Return the VEVENT lines of a Session, none if it has no date."""
+    if not session.startDate:
+        return []
+    lines = ['BEGIN:VEVENT',
+             'UID:%s@%s' % (session.key.urlsafe(),
+                            app_identity.get_application_id()),
+             'DTSTAMP:%s' % stamp]
+    if session.startTime:
+        start = datetime.combine(session.startDate, session.startTime)
+        lines.append('DTSTART:%s' % start.strftime('%Y%m%dT%H%M%S'))
+        if session.duration:
+            lines.append('DURATION:PT%dM' % session.duration)
+    else:
+        lines.append('DTSTART;VALUE=DATE:%s'
+                     % session.startDate.strftime('%Y%m%d'))
+        lines.append('DTEND;VALUE=DATE:%s' % (
+            session.startDate + timedelta(days=1)).strftime('%Y%m%d'))
+
+    summary = session.name
+    if conf_name:
+        summary = '%s (%s)' % (summary, conf_name)
+    lines.append('SUMMARY:%s' % _escape(summary))
+    description = []
+    if session.speaker:
+        description.append('Speaker: %s' % session.speaker)
+    if session.sessionType:
+        description.append('Type: %s' % session.sessionType)
+    description.extend(session.highlights or [])
+    if description:
+        lines.append('DESCRIPTION:%s' % _escape('\n'.join(description)))
+    lines.append('END:VEVENT')
+    return lines
+
+
+def _calendar(name, events):
+    lines = ['BEGIN:VCALENDAR',
+             'VERSION:2.0',
+             'PRODID:-//%s//Conference Central//EN'
+             % app_identity.get_application_id(),
+             'CALSCALE:GREGORIAN',
+             'X-WR-CALNAME:%s' % _escape(name)]
+    lines.extend(events)
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
+
+
+def _dtstamp():
+    return datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+
+
+def conferenceFeed(c_key):
+    """Return the iCalendar schedule of a conference, or None."""
+    conf = storage.backend().get(c_key)
+    if not conf or conf.deleted:
+        return None
+    stamp = _dtstamp()
+    events = []
+    for session in storage.backend().sessionsByConference(c_key):
+        events.extend(_event(session, stamp))
+    return _calendar(conf.name, events)
+
+
+def wishListFeed(prof):
+    """Return the iCalendar of the sessions in a user's wishlist."""
+    sessions = [session for session in
+                storage.backend().getMulti(prof.wishList) if session]
+    # sessions carry their conference name; only older ones need a read
+    confs = storage.backend().getMulti(list(set(
+        session.key.parent() for session in sessions
+        if not session.conference)))
+    names = {conf.key: conf.name for conf in confs if conf}
+    stamp = _dtstamp()
+    events = []
+    for session in sessions:
+        name = session.conference.name if session.conference else \
+            names.get(session.key.parent())
+        events.extend(_event(session, stamp, name))
+    return _calendar('My conference wishlist', events)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+idempotency.py.
+
+Conference server-side Python App Engine idempotency keys, replaying the
+stored response of create and registration calls retried by clients
+
+"""
+
+import functools
+from datetime import datetime
+from datetime import timedelta
+
+import endpoints
+from protorpc import protojson
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import ConflictException
+from models import IdempotentResponse
+from models import Profile
+from settings import IDEMPOTENCY_WINDOW
+from utils import getUserId
+
+IDEMPOTENCY_HEADER = 'X-Idempotency-Key'
+MEMCACHE_RESPONSE_KEY = "IDEMPOTENCY:%s"
+MEMCACHE_LOCK_KEY = "IDEMPOTENCY_LOCK:%s"
+LOCK_TIMEOUT = 60
+PURGE_BATCH = 500
+
+
+def getKey(service, request):
+    """Return the idempotency key of a call, from its field or header."""
+    key = getattr(request, 'idempotencyKey', None)
+    if not key:
+        key = service.request_state.headers.get(IDEMPOTENCY_HEADER)
+    return key
+
+
+def _recordKey(user_id, endpoint, key):
+    """Return the datastore key storing a response, in the user's group."""
+    return ndb.Key(IdempotentResponse, '%s:%s' % (endpoint, key),
+                   parent=ndb.Key(Profile, user_id))
+
+
+def lookup(user_id, endpoint, key, response_type):
+    """Return the stored response for key, or None."""
+    r_key = _recordKey(user_id, endpoint, key)
+    mc_key = MEMCACHE_RESPONSE_KEY % r_key.urlsafe()
+    encoded = memcache.get(mc_key)
+    if encoded is None:
+        record = r_key.get()
+        cutoff = datetime.now() - timedelta(seconds=IDEMPOTENCY_WINDOW)
+        if not record or record.created < cutoff:
+            return None
+        encoded = record.response
+        memcache.set(mc_key, encoded, time=IDEMPOTENCY_WINDOW)
+    return protojson.decode_message(response_type, encoded)
+
+
+def store(user_id, endpoint, key, response):
+    """
+    Store the response for key.
+
+    Inside a transaction the record commits with the rest of the
+    transaction and is only cached once that has succeeded.
+    """
+    r_key = _recordKey(user_id, endpoint, key)
+    encoded = protojson.encode_message(response)
+    IdempotentResponse(key=r_key, response=encoded).put()
+
+    def cache():
+        memcache.set(MEMCACHE_RESPONSE_KEY % r_key.urlsafe(), encoded,
+                     time=IDEMPOTENCY_WINDOW)
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(cache)
+    else:
+        cache()
+
+
+def idempotent(endpoint, response_type):
+    """
+    Replay the stored response of an endpoint method for a repeated key.
+
+    Calls without an idempotency key, or by unauthenticated users, run
+    as usual.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request):
+            key = getKey(self, request)
+            user = endpoints.get_current_user()
+            if not key or not user:
+                return func(self, request)
+
+            user_id = getUserId(user)
+            response = lookup(user_id, endpoint, key, response_type)
+            if response is not None:
+                return response
+
+            # keep a concurrent retry from running the write path too
+            lock = MEMCACHE_LOCK_KEY % _recordKey(
+                user_id, endpoint, key).urlsafe()
+            if not memcache.add(lock, 1, time=LOCK_TIMEOUT):
+                raise ConflictException(
+                    "A request with this idempotency key is in progress")
+            try:
+                response = func(self, request)
+                store(user_id, endpoint, key, response)
+            finally:
+                memcache.delete(lock)
+            return response
+        return wrapper
+    return decorator
+
+
+def purgeExpired():
+    """
+    Delete stored responses older than the idempotency window.
+
+    Keys are paged with a cursor and deleted a batch at a time, so a
+    large backlog is never held in memory at once.
+    """
+    cutoff = datetime.now() - timedelta(seconds=IDEMPOTENCY_WINDOW)
+    query = IdempotentResponse.query(IdempotentResponse.created < cutoff)
+    purged = 0
+    cursor = None
+    more = True
+    while more:
+        keys, cursor, more = query.fetch_page(
+            PURGE_BATCH, keys_only=True, start_cursor=cursor)
+        ndb.delete_multi(keys)
+        purged += len(keys)
+    return purged
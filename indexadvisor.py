@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+"""
+indexadvisor.py.
+
+Conference server-side Python App Engine index advisor: records the
+shapes of the datastore queries the API runs, and derives the smallest
+set of composite indexes serving them, with the index writes each set
+costs per put
+
+"""
+
+import json
+import os
+import threading
+import time
+
+from google.appengine.ext import ndb
+
+from models import QueryShape
+from settings import RECORD_QUERY_SHAPES
+
+FLUSH_INTERVAL = 60
+SAMPLE_SIZE = 100
+INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'index.yaml')
+
+ASC = 'asc'
+DESC = 'desc'
+
+# per-instance shape counts, saved to the datastore every FLUSH_INTERVAL
+_counts = {}
+_lock = threading.Lock()
+_flushed = [time.time()]
+
+
+def _order(order):
+    """Return (name, direction) of an order given as 'name' or '-name'."""
+    if order.startswith('-'):
+        return (order[1:], DESC)
+    return (order, ASC)
+
+
+def record(kind, ancestor=False, equalities=(), inequality=None,
+           orders=(), projection=()):
+    """
+    Count one run of a query shape.
+
+    Orders are property names, prefixed with '-' when descending. Counts
+    are kept in memory and saved outside of transactions; concurrent
+    saves may lose a few counts, which only matter as a ranking.
+    """
+    if not RECORD_QUERY_SHAPES:
+        return
+    shape = json.dumps([kind, bool(ancestor), sorted(set(equalities)),
+                        inequality, [list(_order(o)) for o in orders],
+                        list(projection)])
+    with _lock:
+        _counts[shape] = _counts.get(shape, 0) + 1
+    if (time.time() - _flushed[0] > FLUSH_INTERVAL and
+            not ndb.in_transaction()):
+        flush()
+
+
+def flush():
+    """Add the counts recorded by this instance to the stored shapes."""
+    global _counts
+    with _lock:
+        counts, _counts = _counts, {}
+        _flushed[0] = time.time()
+    if not counts:
+        return
+    keys = [ndb.Key(QueryShape, shape) for shape in counts]
+    shapes = []
+    for key, shape in zip(keys, ndb.get_multi(keys)):
+        shape = shape or QueryShape(key=key)
+        shape.count += counts[key.id()]
+        shapes.append(shape)
+    ndb.put_multi(shapes)
+
+
+def _parseShape(shape):
+    kind, ancestor, equalities, inequality, orders, projection = \
+        json.loads(shape)
+    return (kind, ancestor, tuple(equalities), inequality,
+            tuple(tuple(order) for order in orders), tuple(projection))
+
+
+def _suffix(shape):
+    """Return the index properties following the equality filters."""
+    kind, ancestor, equalities, inequality, orders, projection = shape
+    suffix = list(orders)
+    # the inequality property must be the first sort order
+    if inequality and (not suffix or suffix[0][0] != inequality):
+        suffix.insert(0, (inequality, ASC))
+    names = set(name for name, direction in suffix)
+    suffix.extend((name, ASC) for name in projection
+                  if name not in names and name not in equalities)
+    return tuple(suffix)
+
+
+def requiredIndex(shape):
+    """
+    Return the composite index a shape needs, None if built-in indexes do.
+
+    Indexes are (kind, ancestor, ((name, direction), ...)). Equality
+    filters come first, in name order.
+    """
+    kind, ancestor, equalities, inequality, orders, projection = shape
+    if not inequality and not orders and not projection:
+        # kind, ancestor and equality-only queries merge built-in indexes
+        return None
+    suffix = _suffix(shape)
+    names = set(equalities) | set(name for name, direction in suffix)
+    if not ancestor and len(names) <= 1:
+        return None
+    prefix = tuple((name, ASC) for name in equalities
+                   if name not in dict(suffix))
+    return (kind, ancestor, prefix + suffix)
+
+
+def _usable(indexes, shape):
+    """
+    Return the equality filters of a shape and the indexes usable for it.
+
+    An index is usable when its properties are some of the equality
+    filters, in any order, followed by the shape's sort orders.
+    """
+    kind, ancestor, props = requiredIndex(shape)
+    suffix = _suffix(shape)
+    equalities = set(name for name, direction
+                     in props[:len(props) - len(suffix)])
+    usable = []
+    for index in indexes:
+        i_kind, i_ancestor, i_props = index
+        cut = len(i_props) - len(suffix)
+        if (i_kind, i_ancestor) != (kind, ancestor) or cut < 0 or \
+                i_props[cut:] != suffix:
+            continue
+        names = set(name for name, direction in i_props[:cut])
+        if len(names) == cut and names <= equalities:
+            usable.append((index, names))
+    return equalities, usable
+
+
+def serves(indexes, shape):
+    """
+    Return True if indexes serve a shape, alone or merged.
+
+    The datastore merges usable indexes that together cover all the
+    equality filters.
+    """
+    if requiredIndex(shape) is None:
+        return True
+    equalities, usable = _usable(indexes, shape)
+    covered = set()
+    for index, names in usable:
+        covered |= names
+    return bool(usable) and covered == equalities
+
+
+def _uses(shape, index):
+    """Return True if a shape can run on an index."""
+    return requiredIndex(shape) is not None and \
+        bool(_usable([index], shape)[1])
+
+
+def _valueCounts(entity):
+    """Return {property name: number of indexed values} of an entity."""
+    counts = {}
+    for prop in entity._properties.values():
+        if not prop._indexed:
+            continue
+        value = prop._get_value(entity)
+        if prop._repeated:
+            counts[prop._name] = len(value)
+        else:
+            counts[prop._name] = 1
+    return counts
+
+
+def _rows(index, counts):
+    """Return the number of entries an index holds for an entity."""
+    rows = 1
+    for name, direction in index[2]:
+        rows *= counts.get(name, 0)
+    return rows
+
+
+def indexWrites(indexes, samples, changed=None):
+    """
+    Return the average index writes of putting sampled entities.
+
+    Without changed, each put creates the entity: 2 writes, plus 2 per
+    indexed property value, plus 1 per composite index entry. With the
+    names of the changed properties, each put updates it: 1 write, plus
+    4 per changed indexed value, plus 2 per composite entry involving a
+    changed property.
+    """
+    if not samples:
+        return 0.0
+    total = 0
+    for entity in samples:
+        counts = _valueCounts(entity)
+        if changed is None:
+            total += 2 + 2 * sum(counts.values())
+            total += sum(_rows(index, counts) for index in indexes)
+        else:
+            total += 1 + 4 * sum(counts.get(name, 0) for name in changed)
+            total += 2 * sum(_rows(index, counts) for index in indexes
+                             if set(changed) & set(
+                                 name for name, direction in index[2]))
+    return float(total) / len(samples)
+
+
+def proposeIndexes(shapes, samples):
+    """
+    Return the smallest composite index set serving shapes.
+
+    Shapes sharing their sort orders get either one index per set of
+    equality filters, or one index per equality property merged at
+    query time, whichever keeps fewer index entries per entity.
+    """
+    groups = {}
+    for shape in shapes:
+        required = requiredIndex(shape)
+        if required:
+            kind, ancestor, props = required
+            suffix = _suffix(shape)
+            groups.setdefault((kind, ancestor, suffix), set()).add(
+                props[:len(props) - len(suffix)])
+
+    proposed = []
+    for (kind, ancestor, suffix), prefixes in sorted(groups.items()):
+        exact = [(kind, ancestor, prefix + suffix)
+                 for prefix in sorted(prefixes)]
+        merged = sorted(set((kind, ancestor, prop + suffix)
+                            for prefix in prefixes for prop in
+                            ([(p,) for p in prefix] or [()])))
+        kind_samples = samples.get(kind, [])
+        if len(merged) < len(exact) and indexWrites(
+                merged, kind_samples) <= indexWrites(exact, kind_samples):
+            proposed.extend(merged)
+        else:
+            proposed.extend(exact)
+    # an index on a single property and direction is built in
+    return [index for index in proposed
+            if index[1] or len(index[2]) > 1]
+
+
+def loadIndexes(path=INDEX_FILE):
+    """Return the composite indexes defined in index.yaml."""
+    from google.appengine.datastore import datastore_index
+    with open(path) as fh:
+        definitions = datastore_index.ParseIndexDefinitions(fh)
+    if not definitions or not definitions.indexes:
+        return []
+    return [(index.kind, bool(index.ancestor),
+             tuple((prop.name, prop.direction or ASC)
+                   for prop in index.properties or []))
+            for index in definitions.indexes]
+
+
+def formatIndexes(indexes):
+    """Return indexes in index.yaml syntax."""
+    lines = ['indexes:']
+    for kind, ancestor, props in indexes:
+        lines.extend(['', '- kind: %s' % kind])
+        if ancestor:
+            lines.append('  ancestor: yes')
+        lines.append('  properties:')
+        for name, direction in props:
+            lines.append('  - name: %s' % name)
+            if direction == DESC:
+                lines.append('    direction: desc')
+    return '\n'.join(lines) + '\n'
+
+
+# update scenarios estimated per kind, as the properties they change
+UPDATES = {
+    'Conference': [('seat change', ['seatsAvailable'])],
+}
+
+
+def advise():
+    """
+    Compare index.yaml with the indexes the recorded shapes need.
+
+    Return a dict with the recorded shapes and their counts, the current
+    and proposed indexes, the current indexes serving no shape, the
+    shapes index.yaml does not serve, and the index writes per put of
+    both sets, per kind and scenario.
+    """
+    flush()
+    shapes = [(_parseShape(s.key.id()), s.count) for s in QueryShape.query()]
+    current = loadIndexes()
+    kinds = sorted(set([shape[0] for shape, count in shapes] +
+                       [index[0] for index in current]))
+    samples = {kind: ndb.Query(kind=kind).fetch(SAMPLE_SIZE)
+               for kind in kinds}
+    proposed = proposeIndexes([shape for shape, count in shapes], samples)
+
+    writes = {}
+    for kind in kinds:
+        scenarios = [('new entity', None)] + UPDATES.get(kind, [])
+        writes[kind] = [
+            (label,
+             indexWrites([i for i in current if i[0] == kind],
+                         samples[kind], changed),
+             indexWrites([i for i in proposed if i[0] == kind],
+                         samples[kind], changed))
+            for label, changed in scenarios]
+
+    return {
+        'shapes': sorted(shapes, key=lambda s: -s[1]),
+        'current': current,
+        'proposed': proposed,
+        'unused': [index for index in current
+                   if not any(_uses(shape, index)
+                              for shape, count in shapes)],
+        'unserved': [shape for shape, count in shapes
+                     if not serves(current, shape)],
+        'writes': writes,
+    }
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""
+jobs.py.
+
+Conference server-side Python App Engine background jobs over every
+entity of a kind: the kind is split into key ranges, each worked through
+by a chain of push tasks checkpointing their progress
+
+"""
+
+import functools
+import logging
+import time
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceSummary
+from models import JobRun
+from models import JobShard
+from models import Profile
+from models import Session
+
+import storage
+import tasklag
+import versions
+
+JOB_QUEUE = 'jobs'
+DEFAULT_SHARDS = 8
+MAX_SHARDS = 64
+# scatter keys sampled per shard to place the split points
+OVERSAMPLING = 32
+# a task works through its range for this long, then chains the next one
+SLICE_SECONDS = 60
+# entity groups one cross-group transaction may hold
+XG_GROUPS = 25
+RECENT_RUNS = 10
+
+
+class Job(object):
+
+    """Job -- work over every entity of a kind, a batch at a time.
+
+    A batch may be processed twice when a task fails between processing
+    it and checkpointing, so jobs must be idempotent.
+    """
+
+    model = None
+    batchSize = 100
+    # run batches in cross-group transactions of XG_GROUPS entities,
+    # for jobs updating entities users also write
+    transactional = False
+
+    def __init__(self, params):
+        self.params = params or {}
+
+    def process(self, entities):
+        """Return the entities of a batch to put."""
+        raise NotImplementedError
+
+    def _batch(self, keys):
+        entities = [entity for entity in ndb.get_multi(keys) if entity]
+        changed = self.process(entities)
+        ndb.put_multi(changed)
+        return len(changed)
+
+    def runBatch(self, keys):
+        """Process the entities of keys; return how many changed."""
+        if not self.transactional:
+            return self._batch(keys)
+        return sum(ndb.transaction(functools.partial(
+            self._batch, keys[i:i + XG_GROUPS]), xg=True)
+            for i in range(0, len(keys), XG_GROUPS))
+
+
+class ReconcileSeats(Job):
+
+    """ReconcileSeats -- check seatsAvailable against registrations.
+
+    A conference's seats are its available seats, the seats released to
+    its waitlist and its registered users. Mismatches are logged, and
+    corrected when the job runs with fix=1.
+    """
+
+    model = Conference
+    batchSize = 50
+
+    def runBatch(self, keys):
+        conferences = [conf for conf in ndb.get_multi(keys)
+                       if conf and not conf.deleted and conf.maxAttendees > 0]
+        # count the registrations of the whole batch concurrently
+        counts = [Profile.query(
+            Profile.conferenceKeysToAttend == conf.key.urlsafe()
+        ).count_async(limit=None) for conf in conferences]
+        changed = 0
+        for conf, count in zip(conferences, counts):
+            expected = max(0, conf.maxAttendees - conf.seatsReleased -
+                           count.get_result())
+            if conf.seatsAvailable == expected:
+                continue
+            logging.warning('conference %s has %d seats available, '
+                            'expected %d', conf.key.urlsafe(),
+                            conf.seatsAvailable, expected)
+            if self.params.get('fix') == '1' and self._fix(
+                    conf.key, (conf.seatsAvailable, conf.seatsReleased),
+                    expected):
+                changed += 1
+        return changed
+
+    @staticmethod
+    @ndb.transactional
+    def _fix(c_key, seen, expected):
+        """Correct the seats of a conference, unless they changed since."""
+        conf = c_key.get()
+        # a registration since the count is left to the next run
+        if not conf or (conf.seatsAvailable, conf.seatsReleased) != seen:
+            return False
+        conf.seatsAvailable = expected
+        conf.put()
+        versions.bump('conference', c_key.urlsafe())
+        return True
+
+
+class MigrateProfiles(Job):
+
+    """MigrateProfiles -- save wishlists still stored as websafe keys."""
+
+    model = Profile
+    transactional = True
+
+    def process(self, profiles):
+        migrated = [prof for prof in profiles if prof.migrateWishList()]
+        for prof in migrated:
+            if prof.feedToken:
+                versions.bump('wishlist', prof.feedToken)
+        return migrated
+
+
+class BackfillSessionSummaries(Job):
+
+    """BackfillSessionSummaries -- store conference summaries on sessions.
+
+    Sessions created before summaries were stored on them.
+    """
+
+    model = Session
+
+    def process(self, sessions):
+        sessions = [session for session in sessions
+                    if not session.conference]
+        conferences = ndb.get_multi(list(set(
+            session.key.parent() for session in sessions)))
+        summaries = {conf.key: ConferenceSummary.fromConference(conf)
+                     for conf in conferences if conf}
+        sessions = [session for session in sessions
+                    if session.key.parent() in summaries]
+        for session in sessions:
+            session.conference = summaries[session.key.parent()]
+        for c_key in set(session.key.parent() for session in sessions):
+            versions.bump('sessions', c_key.urlsafe())
+        return sessions
+
+
+class Reindex(Job):
+
+    """Reindex -- put entities again, to apply their index settings.
+
+    An entity keeps the index entries of properties marked unindexed
+    since it was written, until it is put again.
+    """
+
+    # users may update the entities between the read and the put
+    transactional = True
+
+    def process(self, entities):
+        return entities
+
+
+class ReindexConferences(Reindex):
+
+    """ReindexConferences -- reindex every Conference."""
+
+    model = Conference
+
+
+class ReindexSessions(Reindex):
+
+    """ReindexSessions -- reindex every Session."""
+
+    model = Session
+
+
+class ReindexProfiles(Reindex):
+
+    """ReindexProfiles -- reindex every Profile."""
+
+    model = Profile
+
+
+JOBS = {
+    'reconcileSeats': ReconcileSeats,
+    'migrateProfiles': MigrateProfiles,
+    'backfillSessionSummaries': BackfillSessionSummaries,
+    'reindexConferences': ReindexConferences,
+    'reindexSessions': ReindexSessions,
+    'reindexProfiles': ReindexProfiles,
+}
+
+
+def _splitKeys(model, shards):
+    """
+    Return up to shards - 1 keys splitting a kind into similar ranges.
+
+    The keys are picked from a sample of the randomly distributed
+    __scatter__ property the datastore sets on some entities.
+    """
+    keys = model.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * OVERSAMPLING, keys_only=True)
+    keys.sort()
+    splits = []
+    for i in range(1, shards):
+        key = keys[len(keys) * i // shards] if keys else None
+        if key and key not in splits:
+            splits.append(key)
+    return splits
+
+
+def _enqueue(shard, transactional=False):
+    taskqueue.add(queue_name=JOB_QUEUE, url='/tasks/run_job_shard',
+                  params=tasklag.params({'shard': shard.key.urlsafe(),
+                                         'slice': shard.slice}),
+                  transactional=transactional)
+
+
+def start(name, shards=DEFAULT_SHARDS, params=None):
+    """Start a run of the job name over its kind; return the JobRun."""
+    if name not in JOBS:
+        raise ValueError('Unknown job: %s' % name)
+    if not isinstance(storage.backend(), storage.NdbStorage):
+        # shards are datastore key ranges, split on __scatter__
+        raise ValueError('Jobs only run on the ndb storage backend')
+    splits = _splitKeys(JOBS[name].model, max(1, min(shards, MAX_SHARDS)))
+    bounds = [None] + splits + [None]
+    run = JobRun(name=name, params=params or {}, shards=len(bounds) - 1)
+    run.put()
+    shards = [JobShard(id=i + 1, parent=run.key, start=bounds[i],
+                       end=bounds[i + 1]) for i in range(run.shards)]
+    ndb.put_multi(shards)
+    for shard in shards:
+        _enqueue(shard)
+    return run
+
+
+def _rangeQuery(model, shard):
+    q = model.query()
+    if shard.start:
+        q = q.filter(model.key >= shard.start)
+    if shard.end:
+        q = q.filter(model.key < shard.end)
+    return q.order(model.key)
+
+
+def runShard(wssk, number):
+    """
+    Work through a slice of a shard's key range.
+
+    Batches are read with keys-only queries from the shard's cursor,
+    which is saved after each batch. After SLICE_SECONDS the shard moves
+    to its next slice in a transaction adding the task running it, so
+    repeated tasks for a slice are dropped.
+    """
+    shard = ndb.Key(urlsafe=wssk).get()
+    if not shard or shard.done or shard.slice != number:
+        return
+    run = shard.key.parent().get()
+    job = JOBS[run.name](run.params)
+    q = _rangeQuery(job.model, shard)
+
+    started = time.time()
+    processed = changed = 0
+    cursor = Cursor(urlsafe=shard.cursor) if shard.cursor else None
+    more = True
+    while more and time.time() - started < SLICE_SECONDS:
+        batch_started = time.time()
+        keys, cursor, more = q.fetch_page(job.batchSize, keys_only=True,
+                                          start_cursor=cursor)
+        batch_changed = job.runBatch(keys)
+        processed += len(keys)
+        changed += batch_changed
+        # checkpoint: a failed task resumes after the last saved batch
+        shard.cursor = cursor.urlsafe() if cursor else None
+        shard.processed += len(keys)
+        shard.changed += batch_changed
+        shard.elapsed += time.time() - batch_started
+        shard.done = not more
+        shard.put()
+
+    elapsed = time.time() - started
+    logging.info('job %s shard %d slice %d: %d entities, %d changed, '
+                 'in %.1f s (%.1f/s)', run.name, shard.key.id(), number,
+                 processed, changed, elapsed, processed / max(elapsed, 0.001))
+    if more:
+        @ndb.transactional
+        def advance():
+            current = shard.key.get()
+            if current.slice != number:
+                return
+            current.slice += 1
+            current.put()
+            _enqueue(current, transactional=True)
+        advance()
+    else:
+        _finish(run)
+
+
+def _finish(run):
+    """Mark a run finished once all its shards are done."""
+    shards = JobShard.query(ancestor=run.key).fetch()
+    if all(shard.done for shard in shards) and not run.finished:
+        run.finished = datetime.utcnow()
+        run.put()
+        logging.info('job %s finished: %d entities, %d changed',
+                     run.name, sum(shard.processed for shard in shards),
+                     sum(shard.changed for shard in shards))
+
+
+def report():
+    """Return progress and throughput lines for the recent job runs."""
+    lines = []
+    for run in JobRun.query().order(-JobRun.started).fetch(RECENT_RUNS):
+        shards = JobShard.query(ancestor=run.key).fetch()
+        processed = sum(shard.processed for shard in shards)
+        wall = ((run.finished or datetime.utcnow()) -
+                run.started).total_seconds()
+        lines.append('%s %s %s: %d/%d shards done, %d entities, %d changed, '
+                     '%.1f/s overall' % (
+                         run.key.id(), run.name, run.params,
+                         sum(1 for shard in shards if shard.done),
+                         run.shards, processed,
+                         sum(shard.changed for shard in shards),
+                         processed / max(wall, 0.001)))
+        lines.extend('  shard %2d: %8d entities %6d changed %8.1f/s%s' % (
+            shard.key.id(), shard.processed, shard.changed,
+            shard.processed / max(shard.elapsed, 0.001),
+            '' if shard.done else ', slice %d' % shard.slice)
+            for shard in shards)
+    return lines
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""
+mailer.py.
+
+Conference server-side Python App Engine notification mail pipeline:
+notifications are queued on a pull queue and sent in deduplicated
+batches by a worker
+
+"""
+
+import json
+import logging
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.runtime.apiproxy_errors import OverQuotaError
+
+import storage
+import tasklag
+
+MAIL_QUEUE = 'mail'
+LEASE_SECONDS = 60
+LEASE_BATCH = 100
+MEMCACHE_BACKOFF_KEY = "MAIL_BACKOFF"
+MIN_BACKOFF = 60
+MAX_BACKOFF = 60 * 60
+
+# template name -> (subject, body), formatted with the conference fields
+TEMPLATES = {
+    'conferenceCreated': (
+        'You created a new Conference!',
+        'Hi, you have created the following conference:\r\n\r\n'
+        '{details}'),
+    'registered': (
+        'You are registered for {name}',
+        'Hi, you are now registered for the following conference:\r\n\r\n'
+        '{details}'),
+    'waitlistPromoted': (
+        'A seat opened up for {name}',
+        'Hi, a seat opened up and you have been registered from the '
+        'waitlist for the following conference:\r\n\r\n{details}'),
+}
+
+
+class AppEngineMailTransport(object):
+
+    """Send mail through the App Engine mail API."""
+
+    def send(self, sender, to, subject, body):
+        # imported on first use to keep instance start-up fast
+        from google.appengine.api import mail
+        mail.send_mail(sender, to, subject, body)
+
+
+class RecordingMailTransport(object):
+
+    """Record mail instead of sending it, for tests and benchmarks."""
+
+    def __init__(self):
+        self.deliveries = []
+
+    def send(self, sender, to, subject, body):
+        self.deliveries.append((sender, to, subject, body))
+
+
+transport = AppEngineMailTransport()
+
+
+def enqueue(template, recipients, wsck):
+    """
+    Queue a notification about a conference to one or more recipients.
+
+    Inside a transaction the notification is only queued if the
+    transaction commits.
+    """
+    if isinstance(recipients, basestring):
+        recipients = [recipients]
+    recipients = [to for to in recipients if to]
+    if not recipients:
+        return
+    taskqueue.Queue(MAIL_QUEUE).add(
+        taskqueue.Task(payload=json.dumps(tasklag.params({
+            'template': template,
+            'to': recipients,
+            'websafeConferenceKey': wsck})), method='PULL'),
+        transactional=ndb.in_transaction())
+
+
+def enqueueDetails(template, recipient, details):
+    """
+    Queue a notification whose conference details are already written.
+
+    used by send confirmation email tasks queued before notifications
+    named their conference.
+    """
+    taskqueue.Queue(MAIL_QUEUE).add(
+        taskqueue.Task(payload=json.dumps(tasklag.params({
+            'template': template,
+            'to': [recipient],
+            'details': details})), method='PULL'))
+
+
+def _message(payload, to):
+    """Return the (template, conference, details, to) of a notification."""
+    return (payload['template'], payload.get('websafeConferenceKey'),
+            payload.get('details'), to)
+
+
+def _render(template, conf=None, details=None):
+    """Return the (subject, body) of a template for a conference."""
+    subject, body = TEMPLATES[template]
+    if conf is None:
+        return subject.format(name=''), body.format(name='', details=details)
+    details = '\r\n'.join('%s: %s' % (label, value) for label, value in (
+        ('Name', conf.name),
+        ('City', conf.city),
+        ('Topics', ', '.join(conf.topics or [])),
+        ('Start date', conf.startDate),
+        ('End date', conf.endDate),
+        ('Description', conf.description)) if value)
+    return (subject.format(name=conf.name),
+            body.format(name=conf.name, details=details))
+
+
+def _backOff():
+    """Pause sending for exponentially longer on repeated quota errors."""
+    backoff = memcache.get(MEMCACHE_BACKOFF_KEY)
+    delay = min(backoff[1] * 2, MAX_BACKOFF) if backoff else MIN_BACKOFF
+    memcache.set(MEMCACHE_BACKOFF_KEY, (time.time() + delay, delay),
+                 time=MAX_BACKOFF * 2)
+    logging.warning('mail quota exceeded, backing off %d seconds', delay)
+
+
+def backingOff():
+    """Return True while sending is paused after a quota error."""
+    backoff = memcache.get(MEMCACHE_BACKOFF_KEY)
+    return bool(backoff) and time.time() < backoff[0]
+
+
+def processBatch():
+    """
+    Lease a batch of notifications and send them.
+
+    Notifications repeating a template, recipient and conference are
+    sent once, and each template is rendered once per conference. On a
+    quota error the unsent notifications are left to their lease expiry;
+    those of a partly sent notification are queued again on their own.
+    Return the number of notifications leased.
+    """
+    queue = taskqueue.Queue(MAIL_QUEUE)
+    started = time.time()
+    tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH)
+    if not tasks:
+        return 0
+
+    payloads = [json.loads(task.payload) for task in tasks]
+    messages = []
+    seen = set()
+    for payload in payloads:
+        for to in payload['to']:
+            message = _message(payload, to)
+            if message not in seen:
+                seen.add(message)
+                messages.append(message)
+
+    c_keys = list(set(ndb.Key(urlsafe=wsck)
+                      for t, wsck, details, to in messages if wsck))
+    confs = {c_key.urlsafe(): conf
+             for c_key, conf in zip(c_keys,
+                                    storage.backend().getMulti(c_keys))}
+
+    sender = 'noreply@%s.appspotmail.com' % (
+        app_identity.get_application_id())
+    rendered = {}
+    sent = set()
+    try:
+        for template, wsck, details, to in messages:
+            if not wsck:
+                transport.send(sender, to,
+                               *_render(template, details=details))
+            elif confs[wsck] and not confs[wsck].deleted:
+                if (template, wsck) not in rendered:
+                    rendered[template, wsck] = _render(template, confs[wsck])
+                subject, body = rendered[template, wsck]
+                transport.send(sender, to, subject, body)
+            sent.add((template, wsck, details, to))
+    except OverQuotaError:
+        _backOff()
+        done = []
+        requeued = []
+        for task, payload in zip(tasks, payloads):
+            unsent = [to for to in payload['to']
+                      if _message(payload, to) not in sent]
+            if not unsent:
+                done.append(task)
+            elif len(unsent) < len(payload['to']):
+                # queue the unsent recipients alone, so the sent ones are
+                # not mailed again; the payload keeps its enqueue time
+                requeued.append(task)
+                queue.add(taskqueue.Task(
+                    payload=json.dumps(dict(payload, to=unsent)),
+                    method='PULL'))
+        tasks = done
+    else:
+        requeued = []
+        memcache.delete(MEMCACHE_BACKOFF_KEY)
+
+    if tasks or requeued:
+        queue.delete_tasks(tasks + requeued)
+        finished = time.time()
+        tasklag.recordMulti([
+            ('mail', tasklag.enqueuedAt(json.loads(task.payload)), started,
+             finished, task.retry_count, True) for task in tasks])
+    return len(payloads)
+
+
+def run(seconds):
+    """Send queued notifications for up to seconds, or until drained."""
+    deadline = time.time() + seconds
+    while time.time() < deadline and not backingOff():
+        if not processBatch():
+            break
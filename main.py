@@ -14,10 +14,104 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+from datetime import datetime
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+import facets
+import feeds
+import idempotency
+import indexadvisor
+import jobs
+import mailer
+import profiler
+import recommend
+import searchindex
+import storage
+import tasklag
+import versions
+
+# cron runs every minute; stop sending before the next one starts
+MAIL_RUN_SECONDS = 50
+
+MEMCACHE_FEED_KEY = "FEED:%s:%s:%s"
+FEED_CACHE_TTL = 24 * 60 * 60
+FEED_MAX_AGE = 5 * 60
+
+
+class WarmupHandler(webapp2.RequestHandler):
+
+    """Prepare a new instance before it serves traffic."""
+
+    def get(self):
+        """Prepare a new instance before it serves traffic."""
+        ConferenceApi._warmup()
+
+
+class FeedHandler(webapp2.RequestHandler):
+
+    """Base handler serving versioned, cached iCalendar feeds."""
+
+    def serveFeed(self, kind, ident, build):
+        """
+        Serve the feed of (kind, ident), built by build() on a cache miss.
+
+        A poll repeating the current ETag or Last-Modified costs one
+        memcache read and gets a 304.
+        """
+        version = versions.get(kind, ident)
+        etag = '"%s"' % version
+        last_modified = datetime.utcfromtimestamp(version // 1000).strftime(
+            '%a, %d %b %Y %H:%M:%S GMT')
+        self.response.headers['ETag'] = etag
+        self.response.headers['Last-Modified'] = last_modified
+        self.response.headers['Cache-Control'] = 'private, max-age=%d' % (
+            FEED_MAX_AGE)
+
+        if_none_match = self.request.headers.get('If-None-Match')
+        if (if_none_match == etag or not if_none_match and
+                self.request.headers.get('If-Modified-Since') ==
+                last_modified):
+            self.response.status = 304
+            return
+
+        feed_key = MEMCACHE_FEED_KEY % (kind, ident, version)
+        feed = memcache.get(feed_key)
+        if feed is None:
+            feed = build()
+            if feed is None:
+                self.abort(404)
+            memcache.set(feed_key, feed, time=FEED_CACHE_TTL)
+        self.response.headers['Content-Type'] = 'text/calendar; charset=utf-8'
+        self.response.write(feed)
+
+
+class ConferenceFeedHandler(FeedHandler):
+
+    """Serve the iCalendar schedule of a conference."""
+
+    def get(self, wsck):
+        """Serve the iCalendar schedule of a conference."""
+        try:
+            c_key = ndb.Key(urlsafe=wsck)
+        except Exception:
+            self.abort(404)
+        self.serveFeed('schedule', c_key.urlsafe(),
+                       lambda: feeds.conferenceFeed(c_key))
+
+
+class WishListFeedHandler(FeedHandler):
+
+    """Serve the iCalendar of a user's wishlist."""
+
+    def get(self, token):
+        """Serve the iCalendar of a user's wishlist."""
+        def build():
+            prof = storage.backend().profileByFeedToken(token)
+            return feeds.wishListFeed(prof) if prof else None
+        self.serveFeed('wishlist', token, build)
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
@@ -29,33 +123,290 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         ConferenceApi._cacheAnnouncement()
 
 
+class PurgeIdempotencyKeysHandler(webapp2.RequestHandler):
+
+    """Purge expired idempotent responses."""
+
+    def get(self):
+        """Purge expired idempotent responses."""
+        idempotency.purgeExpired()
+
+
+class BuildRecommenderHandler(webapp2.RequestHandler):
+
+    """Rebuild the conference recommender snapshot."""
+
+    def get(self):
+        """Rebuild the conference recommender snapshot."""
+        recommend.build()
+
+
+class RebuildFacetsHandler(webapp2.RequestHandler):
+
+    """Verify and rebuild the conference facet counts."""
+
+    def get(self):
+        """Verify and rebuild the conference facet counts."""
+        facets.rebuild()
+
+
+class UpdateFacetsHandler(webapp2.RequestHandler):
+
+    """Apply conference facet count changes."""
+
+    @tasklag.tracked('update_facets')
+    def post(self):
+        """Apply conference facet count changes."""
+        facets.applyDeltas(json.loads(self.request.get('deltas')),
+                           self.request.headers['X-AppEngine-TaskName'])
+
+
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
 
     """Set Featured Speaker in Memcache."""
 
+    @tasklag.tracked('set_featured_speaker')
     def post(self):
         """Set Featured Speaker in Memcache."""
         ConferenceApi._speakerAnnouncement(self.request)
 
 
+class IndexDocumentHandler(webapp2.RequestHandler):
+
+    """Update the search index for a Conference or Session."""
+
+    @tasklag.tracked('index_document')
+    def post(self):
+        """Update the search index for a Conference or Session."""
+        searchindex.indexEntity(ndb.Key(urlsafe=self.request.get(
+            'websafeKey')))
+
+
+class UpdateSessionSummariesHandler(webapp2.RequestHandler):
+
+    """Copy a changed conference summary onto its sessions."""
+
+    @tasklag.tracked('update_session_summaries')
+    def post(self):
+        """Copy a changed conference summary onto its sessions."""
+        ConferenceApi._updateSessionSummaries(
+            self.request.get('websafeConferenceKey'))
+
+
+class ProcessRegistrationsHandler(webapp2.RequestHandler):
+
+    """Commit the queued registrations of a conference."""
+
+    @tasklag.tracked('process_registrations')
+    def post(self):
+        """Commit the queued registrations of a conference."""
+        ConferenceApi._processRegistrations(
+            self.request.get('websafeConferenceKey'))
+
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+
+    """Register waitlisted users for released seats."""
+
+    @tasklag.tracked('promote_waitlist')
+    def post(self):
+        """Register waitlisted users for released seats."""
+        ConferenceApi._promoteWaitlist(
+            self.request.get('websafeConferenceKey'))
+
+
+class DeleteConferenceHandler(webapp2.RequestHandler):
+
+    """Purge the sessions and registrations of a deleted conference."""
+
+    @tasklag.tracked('delete_conference')
+    def post(self):
+        """Purge the sessions and registrations of a deleted conference."""
+        ConferenceApi._purgeConference(
+            self.request.get('websafeConferenceKey'),
+            self.request.get('cursor') or None)
+
+
+class ScrubProfilesHandler(webapp2.RequestHandler):
+
+    """Remove a deleted conference from a batch of profiles."""
+
+    @tasklag.tracked('scrub_profiles')
+    def post(self):
+        """Remove a deleted conference from a batch of profiles."""
+        ConferenceApi._scrubProfiles(
+            self.request.get('websafeConferenceKey'),
+            json.loads(self.request.get('userIds')))
+
+
+class SendMailHandler(webapp2.RequestHandler):
+
+    """Send queued notification emails."""
+
+    def get(self):
+        """Send queued notification emails."""
+        mailer.run(MAIL_RUN_SECONDS)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
 
-    """Send email confirming Conference creation."""
+    """Queue the email of a task from before the mail queue."""
+
+    # kept for one release, until the tasks queued before it have run
+    def post(self):
+        """Queue the email of a task from before the mail queue."""
+        mailer.enqueueDetails('conferenceCreated', self.request.get('email'),
+                              self.request.get('conferenceInfo'))
+
+
+class IndexAdvisorHandler(webapp2.RequestHandler):
+
+    """Report the composite indexes the recorded queries need."""
+
+    def get(self):
+        """Report the composite indexes the recorded queries need."""
+        report = indexadvisor.advise()
+        out = ['Recorded query shapes (count: kind, ancestor, equalities,'
+               ' inequality, orders, projection):']
+        out.extend('%8d: %s' % (count, shape)
+                   for shape, count in report['shapes'])
+        out.extend(['', 'Index writes per put (current -> proposed):'])
+        for kind, writes in sorted(report['writes'].items()):
+            out.extend('  %-14s %-12s %7.1f -> %7.1f' % (
+                kind, label, current, proposed)
+                for label, current, proposed in writes)
+        out.extend(['', 'Composite indexes serving no recorded query:'])
+        out.extend('  %s' % (index,) for index in report['unused'])
+        out.extend(['', 'Recorded queries index.yaml does not serve:'])
+        out.extend('  %s' % (shape,) for shape in report['unserved'])
+        out.extend(['', 'Proposed index.yaml (%d composite indexes, '
+                    'currently %d):' % (len(report['proposed']),
+                                        len(report['current'])), ''])
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('\n'.join(out) + '\n' +
+                            indexadvisor.formatIndexes(report['proposed']))
+
+
+class TaskLagHandler(webapp2.RequestHandler):
+
+    """Report task queue wait, handler time and lag per task type."""
+
+    def get(self):
+        """Report task queue wait, handler time and lag per task type."""
+        windows = int(self.request.get('windows') or 12)
+        out = ['Task lag over the last %d minutes (seconds, p50/p95/p99; '
+               'histogram bucket upper bounds):' % (
+                   windows * tasklag.WINDOW // 60), '']
+        for task_type, info in sorted(tasklag.stats(windows=windows).items()):
+            out.append('%-26s %6d runs %5d retries   budget %4d s%s' % (
+                task_type, info['runs'], info['retried'], info['budget'],
+                '   ALERT: p95 lag over budget' if info['alert'] else ''))
+            for metric in tasklag.METRICS:
+                out.append('  %-8s %s' % (metric, ' / '.join(
+                    '-' if value is None else '%.2f' % value
+                    for value in info['percentiles'][metric])))
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('\n'.join(out) + '\n')
+
+
+class CheckTaskLagHandler(webapp2.RequestHandler):
+
+    """Log an error for each task type over its lag budget."""
+
+    def get(self):
+        """Log an error for each task type over its lag budget."""
+        tasklag.check()
+
+
+class ProfilesHandler(webapp2.RequestHandler):
+
+    """List recent request profiles, or show one."""
+
+    def get(self, profile_id=None):
+        """List recent request profiles, or show one."""
+        self.response.headers['Content-Type'] = 'text/plain'
+        if profile_id:
+            record = profiler.get(profile_id)
+            if not record:
+                self.abort(404, 'Profile expired or not found.')
+            self.response.write(
+                '%(method)s %(path)s: %(wall).3f s, CPU %(cpu).3f s, '
+                'waiting %(wait).3f s\n\nBy cumulative time:\n'
+                '%(cumulativeStats)s\nBy own time:\n%(totalStats)s' % record)
+            return
+        out = ['Recent request profiles (wall, CPU, waiting on API calls); '
+               'profile a request with an X-Conference-Profile: 1 header '
+               'or a _profile=1 query flag:', '']
+        out.extend('%s  %s %-44s %7.3f s %7.3f s %7.3f s  '
+                   '/admin/profiles/%s' % (
+                       datetime.utcfromtimestamp(record['started']).strftime(
+                           '%Y-%m-%d %H:%M:%S'),
+                       record['method'], record['path'], record['wall'],
+                       record['cpu'], record['wait'], record['id'])
+                   for record in profiler.recent())
+        self.response.write('\n'.join(out) + '\n')
+
+
+class JobsHandler(webapp2.RequestHandler):
+
+    """Start background jobs and report their progress."""
+
+    def get(self):
+        """Report the progress and throughput of recent job runs."""
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('\n'.join(
+            ['Jobs: %s' % ', '.join(sorted(jobs.JOBS)), ''] +
+            jobs.report()) + '\n')
+
+    def post(self):
+        """Start a job; other arguments than name and shards are params."""
+        name = self.request.get('name')
+        if name not in jobs.JOBS:
+            self.abort(400, 'Unknown job: %s' % name)
+        try:
+            jobs.start(name, int(self.request.get('shards') or
+                                 jobs.DEFAULT_SHARDS),
+                       {arg: self.request.get(arg)
+                        for arg in self.request.arguments()
+                        if arg not in ('name', 'shards')})
+        except ValueError as e:
+            self.abort(400, str(e))
+        self.redirect('/admin/jobs')
+
+
+class RunJobShardHandler(webapp2.RequestHandler):
+
+    """Work through a slice of a background job's key range."""
 
+    @tasklag.tracked('run_job_shard')
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
-            self.request.get('email'),                  # to
-            'You created a new Conference!',            # subj
-            'Hi, you have created a following '         # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
+        """Work through a slice of a background job's key range."""
+        jobs.runShard(self.request.get('shard'),
+                      int(self.request.get('slice')))
 
-app = webapp2.WSGIApplication([
+app = profiler.middleware(webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
+    (r'/feeds/conference/([\w-]+)\.ics', ConferenceFeedHandler),
+    (r'/feeds/wishlist/(\w+)\.ics', WishListFeedHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/purge_idempotency_keys', PurgeIdempotencyKeysHandler),
+    ('/crons/rebuild_facets', RebuildFacetsHandler),
+    ('/crons/build_recommender', BuildRecommenderHandler),
+    ('/crons/send_mail', SendMailHandler),
+    ('/crons/check_task_lag', CheckTaskLagHandler),
+    ('/admin/index_advisor', IndexAdvisorHandler),
+    ('/admin/jobs', JobsHandler),
+    ('/admin/task_lag', TaskLagHandler),
+    ('/admin/profiles', ProfilesHandler),
+    (r'/admin/profiles/(\w+)', ProfilesHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler)
-], debug=True)
+    ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
+    ('/tasks/index_document', IndexDocumentHandler),
+    ('/tasks/update_facets', UpdateFacetsHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/update_session_summaries', UpdateSessionSummariesHandler),
+    ('/tasks/process_registrations', ProcessRegistrationsHandler),
+    ('/tasks/run_job_shard', RunJobShardHandler),
+    ('/tasks/delete_conference', DeleteConferenceHandler),
+    ('/tasks/scrub_profiles', ScrubProfilesHandler)
+], debug=True))
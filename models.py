@@ -10,6 +10,7 @@ Conference server-side Python App Engine data & ProtoRPC models
 __author__ = 'youness.assassi@gmail.com (Youness Assassi)'
 
 import httplib
+import json
 import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
@@ -21,11 +22,30 @@ class Profile(ndb.Model):
 
     """Profile -- User profile object."""
 
-    displayName = ndb.StringProperty()
-    mainEmail = ndb.StringProperty()
-    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # only properties the API filters or sorts on are indexed; the others
+    # would cost index writes on every put for nothing
+    displayName = ndb.StringProperty(indexed=False)
+    mainEmail = ndb.StringProperty(indexed=False)
+    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED', indexed=False)
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
-    wishList = ndb.StringProperty(repeated=True)
+    wishList = ndb.KeyProperty('wishListKeys', kind='Session',
+                               repeated=True)
+    # websafe Session key strings stored before wishList held keys
+    legacyWishList = ndb.StringProperty('wishList', repeated=True,
+                                        indexed=False)
+    # secret part of the wishlist calendar feed url
+    feedToken = ndb.StringProperty()
+
+    def migrateWishList(self):
+        """Move legacy wishlist entries into wishList; True if any."""
+        if not self.legacyWishList:
+            return False
+        for wssk in self.legacyWishList:
+            s_key = ndb.Key(urlsafe=wssk)
+            if s_key not in self.wishList:
+                self.wishList.append(s_key)
+        self.legacyWishList = []
+        return True
 
 
 class ProfileMiniForm(messages.Message):
@@ -46,6 +66,8 @@ class ProfileForm(messages.Message):
     teeShirtSize = messages.EnumField('TeeShirtSize', 4)
     conferenceKeysToAttend = messages.StringField(5, repeated=True)
     wishList = messages.StringField(6, repeated=True)
+    etag = messages.StringField(7)
+    notModified = messages.BooleanField(8)
 
 
 class TeeShirtSize(messages.Enum):
@@ -74,15 +96,22 @@ class Conference(ndb.Model):
     """Conference -- Conference object."""
 
     name = ndb.StringProperty(required=True)
-    description = ndb.StringProperty()
-    organizerUserId = ndb.StringProperty()
+    description = ndb.StringProperty(indexed=False)
+    # conferences are found by organizer through their parent Profile key
+    organizerUserId = ndb.StringProperty(indexed=False)
     topics = ndb.StringProperty(repeated=True)
     city = ndb.StringProperty()
     startDate = ndb.DateProperty()
     month = ndb.IntegerProperty()
-    endDate = ndb.DateProperty()
+    endDate = ndb.DateProperty(indexed=False)
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    waitlistSize = ndb.IntegerProperty(default=0, indexed=False)
+    seatsReleased = ndb.IntegerProperty(default=0, indexed=False)
+    # incremented by each update, for compare-and-set updates
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # set while the conference, its sessions and registrations are purged
+    deleted = ndb.BooleanProperty(default=False, indexed=False)
 
 
 class BooleanMessage(messages.Message):
@@ -92,6 +121,22 @@ class BooleanMessage(messages.Message):
     data = messages.BooleanField(1)
 
 
+class IdempotentResponse(ndb.Model):
+
+    """IdempotentResponse -- stored response of an idempotent call."""
+
+    response = ndb.BlobProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class QueryShape(ndb.Model):
+
+    """QueryShape -- count of a datastore query shape, keyed by its JSON."""
+
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    lastSeen = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
 class ConflictException(endpoints.ServiceException):
 
     """ConflictException -- exception mapped to HTTP 409 response."""
@@ -99,6 +144,23 @@ class ConflictException(endpoints.ServiceException):
     http_status = httplib.CONFLICT
 
 
+class RateLimitExceededException(endpoints.ServiceException):
+
+    """RateLimitExceededException -- exception mapped to HTTP 403 response."""
+
+    # Endpoints passes no 429 through; the message is a JSON object with
+    # the reason and the seconds to wait before retrying
+    http_status = httplib.FORBIDDEN
+
+    def __init__(self, message, retryAfter):
+        self.retryAfter = retryAfter
+        super(RateLimitExceededException, self).__init__(json.dumps({
+            'reason': 'rateLimitExceeded',
+            'retryAfter': retryAfter,
+            'message': message,
+        }))
+
+
 class ConferenceForm(messages.Message):
 
     """ConferenceForm -- Conference outbound form message."""
@@ -115,6 +177,10 @@ class ConferenceForm(messages.Message):
     endDate = messages.StringField(10)
     websafeKey = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    idempotencyKey = messages.StringField(13)
+    etag = messages.StringField(14)
+    notModified = messages.BooleanField(15)
+    version = messages.IntegerField(16)
 
 
 class ConferenceForms(messages.Message):
@@ -124,6 +190,14 @@ class ConferenceForms(messages.Message):
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
 
 
+class WishListUpdateForm(messages.Message):
+
+    """WishListUpdateForm -- inbound batch wishlist change message."""
+
+    add = messages.StringField(1, repeated=True)
+    remove = messages.StringField(2, repeated=True)
+
+
 class ConferenceQueryForm(messages.Message):
 
     """ConferenceQueryForm -- Conference query inbound form message."""
@@ -142,6 +216,7 @@ class ConferenceQueryForms(messages.Message):
     """
 
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    upcomingOnly = messages.BooleanField(2, default=False)
 
 
 class StringMessage(messages.Message):
@@ -151,17 +226,35 @@ class StringMessage(messages.Message):
     data = messages.StringField(1, required=True)
 
 
+class ConferenceSummary(ndb.Model):
+
+    """ConferenceSummary -- Conference fields copied onto its Sessions."""
+
+    name = ndb.StringProperty()
+    city = ndb.StringProperty()
+    startDate = ndb.DateProperty()
+    endDate = ndb.DateProperty()
+
+    @classmethod
+    def fromConference(cls, conf):
+        """Return the summary of a Conference."""
+        return cls(name=conf.name, city=conf.city,
+                   startDate=conf.startDate, endDate=conf.endDate)
+
+
 class Session(ndb.Model):
 
     """Session -- Conference Session object."""
 
-    name = ndb.StringProperty(required=True)
-    highlights = ndb.StringProperty(repeated=True)
+    name = ndb.StringProperty(required=True, indexed=False)
+    highlights = ndb.StringProperty(repeated=True, indexed=False)
     speaker = ndb.StringProperty()
-    duration = ndb.IntegerProperty()
+    duration = ndb.IntegerProperty(indexed=False)
     sessionType = ndb.StringProperty(choices=sessionTypeChoices)
-    startDate = ndb.DateProperty()
+    startDate = ndb.DateProperty(indexed=False)
     startTime = ndb.TimeProperty()
+    # parent conference summary, so listings need no Conference reads
+    conference = ndb.LocalStructuredProperty(ConferenceSummary)
 
 
 class SessionForm(messages.Message):
@@ -177,6 +270,11 @@ class SessionForm(messages.Message):
     startTime = messages.StringField(7)
     websafeConferenceKey = messages.StringField(8)
     websafeKey = messages.StringField(9)
+    idempotencyKey = messages.StringField(10)
+    conferenceName = messages.StringField(11)
+    conferenceCity = messages.StringField(12)
+    conferenceStartDate = messages.StringField(13)
+    conferenceEndDate = messages.StringField(14)
 
 
 class SessionForms(messages.Message):
@@ -184,3 +282,197 @@ class SessionForms(messages.Message):
     """SessionForms -- multiple Sessions outbound from message."""
 
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+
+
+class BatchRequestItem(messages.Message):
+
+    """BatchRequestItem -- single sub-request of a batch call."""
+
+    id = messages.StringField(1)
+    method = messages.StringField(2, required=True)
+    websafeConferenceKey = messages.StringField(3)
+    ifNoneMatch = messages.StringField(4)
+
+
+class BatchRequestForm(messages.Message):
+
+    """BatchRequestForm -- inbound batch of sub-requests message."""
+
+    items = messages.MessageField(BatchRequestItem, 1, repeated=True)
+
+
+class BatchResponseItem(messages.Message):
+
+    """BatchResponseItem -- result of a single batch sub-request."""
+
+    id = messages.StringField(1)
+    method = messages.StringField(2)
+    status = messages.IntegerField(3, default=200)
+    error = messages.StringField(4)
+    profile = messages.MessageField(ProfileForm, 5)
+    conference = messages.MessageField(ConferenceForm, 6)
+    conferences = messages.MessageField(ConferenceForms, 7)
+    sessions = messages.MessageField(SessionForms, 8)
+    data = messages.StringField(9)
+
+
+class BatchResponseForms(messages.Message):
+
+    """BatchResponseForms -- combined outbound batch response message."""
+
+    items = messages.MessageField(BatchResponseItem, 1, repeated=True)
+
+
+class SearchDocument(ndb.Model):
+
+    """SearchDocument -- indexed terms of a searchable entity."""
+
+    kind = ndb.StringProperty(indexed=False)
+    title = ndb.StringProperty(indexed=False)
+    terms = ndb.JsonProperty(compressed=True)
+
+
+class PostingList(ndb.Model):
+
+    """PostingList -- one shard of a search term's postings."""
+
+    postings = ndb.JsonProperty(compressed=True)
+
+
+class SearchTerm(ndb.Model):
+
+    """SearchTerm -- search term dictionary entry, keyed by the term."""
+
+
+class SearchResultForm(messages.Message):
+
+    """SearchResultForm -- single search hit outbound form message."""
+
+    kind = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+    title = messages.StringField(3)
+    score = messages.FloatField(4)
+
+
+class SearchResultForms(messages.Message):
+
+    """SearchResultForms -- page of search hits outbound form message."""
+
+    items = messages.MessageField(SearchResultForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class FacetShard(ndb.Model):
+
+    """FacetShard -- one shard of a facet's conference counts."""
+
+    counts = ndb.JsonProperty()
+
+
+class AppliedFacetTask(ndb.Model):
+
+    """AppliedFacetTask -- facet delta task already applied, by task name."""
+
+    applied = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class FacetCountForm(messages.Message):
+
+    """FacetCountForm -- count of conferences with a facet value."""
+
+    value = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+
+class FacetForm(messages.Message):
+
+    """FacetForm -- counts of a single facet outbound form message."""
+
+    name = messages.StringField(1)
+    counts = messages.MessageField(FacetCountForm, 2, repeated=True)
+
+
+class FacetForms(messages.Message):
+
+    """FacetForms -- multiple facets outbound form message."""
+
+    items = messages.MessageField(FacetForm, 1, repeated=True)
+
+
+class RecommenderSnapshot(ndb.Model):
+
+    """RecommenderSnapshot -- header of the current recommender snapshot."""
+
+    version = ndb.IntegerProperty(indexed=False)
+    chunks = ndb.IntegerProperty(indexed=False)
+
+
+class RecommenderChunk(ndb.Model):
+
+    """RecommenderChunk -- piece of a serialized recommender snapshot."""
+
+    data = ndb.BlobProperty()
+
+
+class WaitlistEntry(ndb.Model):
+
+    """WaitlistEntry -- user waiting for a seat, child of the Conference."""
+
+    joined = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class WaitlistPositionForm(messages.Message):
+
+    """WaitlistPositionForm -- outbound waitlist position message."""
+
+    position = messages.IntegerField(1)
+    waitlistSize = messages.IntegerField(2)
+
+
+class RegistrationTicket(ndb.Model):
+
+    """RegistrationTicket -- queued registration outcome, child of Profile."""
+
+    websafeConferenceKey = ndb.StringProperty(indexed=False)
+    status = ndb.StringProperty(indexed=False)
+    reason = ndb.StringProperty(indexed=False)
+    resolved = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class RegistrationTicketForm(messages.Message):
+
+    """RegistrationTicketForm -- queued registration status message."""
+
+    ticketId = messages.StringField(1)
+    websafeConferenceKey = messages.StringField(2)
+    status = messages.StringField(3)
+    reason = messages.StringField(4)
+
+
+class JobRun(ndb.Model):
+
+    """JobRun -- run of a background job over every entity of a kind."""
+
+    name = ndb.StringProperty(indexed=False)
+    params = ndb.JsonProperty()
+    shards = ndb.IntegerProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+
+class JobShard(ndb.Model):
+
+    """JobShard -- progress of a job over a key range, child of JobRun."""
+
+    # range of keys [start, end); None is unbounded
+    start = ndb.KeyProperty(indexed=False)
+    end = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    slice = ndb.IntegerProperty(default=0, indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    changed = ndb.IntegerProperty(default=0, indexed=False)
+    # seconds spent processing, summed over slices
+    elapsed = ndb.FloatProperty(default=0.0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+profiler.py.
+
+Conference server-side Python App Engine on-demand request profiling: an
+admin request carrying the profiling header, or the _profile=1 flag, is
+run under cProfile and its stats kept in memcache for a while
+
+"""
+
+import time
+import uuid
+
+from google.appengine.api import memcache
+
+from settings import REQUEST_PROFILING
+
+# the X-Conference-Profile request header, as found in the WSGI environ
+PROFILE_ENVIRON = 'HTTP_X_CONFERENCE_PROFILE'
+PROFILE_FLAG = '_profile=1'
+
+MEMCACHE_PROFILE_KEY = "PROFILE:%s"
+MEMCACHE_PROFILES_KEY = "PROFILES"
+PROFILE_TTL = 24 * 60 * 60
+RECENT_PROFILES = 50
+TOP_FUNCTIONS = 40
+CAS_RETRIES = 3
+
+
+def _isAdmin():
+    """Return True if an admin, signed in or with an OAuth token, asks."""
+    import endpoints
+    from google.appengine.api import oauth
+    from google.appengine.api import users
+    if users.is_current_user_admin():
+        return True
+    try:
+        return oauth.is_current_user_admin(endpoints.EMAIL_SCOPE)
+    except oauth.Error:
+        return False
+
+
+def _cpuSeconds():
+    """Return the CPU seconds this request used so far."""
+    from google.appengine.api import quota
+    megacycles = quota.get_request_cpu_usage()
+    if megacycles:
+        return quota.megacycles_to_cpu_seconds(megacycles)
+    # not measured by the development server, where a request has the
+    # process to itself
+    return time.clock()
+
+
+def _statsText(profile, sort):
+    import pstats
+    import StringIO
+    out = StringIO.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats(sort).print_stats(TOP_FUNCTIONS)
+    return out.getvalue()
+
+
+def _save(record):
+    """Store a profile, and its summary at the head of the recent list."""
+    memcache.set(MEMCACHE_PROFILE_KEY % record['id'], record,
+                 time=PROFILE_TTL)
+    summary = dict((name, value) for name, value in record.items()
+                   if not name.endswith('Stats'))
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        recent = client.gets(MEMCACHE_PROFILES_KEY)
+        if recent is None:
+            if client.add(MEMCACHE_PROFILES_KEY, [summary],
+                          time=PROFILE_TTL):
+                return
+            continue
+        if client.cas(MEMCACHE_PROFILES_KEY,
+                      ([summary] + recent)[:RECENT_PROFILES],
+                      time=PROFILE_TTL):
+            return
+
+
+def _profiled(app, environ, start_response):
+    """Run a request under the profiler; return its response body."""
+    import cProfile
+    profile = cProfile.Profile()
+    cpu = _cpuSeconds()
+    started = time.time()
+    # the body is read inside the profile, for apps producing it lazily
+    body = profile.runcall(lambda: list(app(environ, start_response)))
+    wall = time.time() - started
+    cpu = _cpuSeconds() - cpu
+    profile.create_stats()
+
+    _save({
+        'id': uuid.uuid4().hex,
+        'path': environ.get('PATH_INFO'),
+        'method': environ.get('REQUEST_METHOD'),
+        'started': started,
+        'wall': wall,
+        'cpu': cpu,
+        # time off the CPU, which is mostly waiting on API calls
+        'wait': max(0.0, wall - cpu),
+        'cumulativeStats': _statsText(profile, 'cumulative'),
+        'totalStats': _statsText(profile, 'time'),
+    })
+    return body
+
+
+def middleware(app):
+    """
+    Wrap a WSGI app so admin requests asking for it are profiled.
+
+    Other requests cost a header and query string check, and nothing
+    with profiling disabled in settings.
+    """
+    if not REQUEST_PROFILING:
+        return app
+
+    def wrapper(environ, start_response):
+        if (environ.get(PROFILE_ENVIRON) or
+                PROFILE_FLAG in environ.get('QUERY_STRING', '')) and \
+                _isAdmin():
+            return _profiled(app, environ, start_response)
+        return app(environ, start_response)
+    return wrapper
+
+
+def recent():
+    """Return the summaries of the recent profiles, newest first."""
+    return memcache.get(MEMCACHE_PROFILES_KEY) or []
+
+
+def get(profile_id):
+    """Return a stored profile, or None once expired."""
+    return memcache.get(MEMCACHE_PROFILE_KEY % profile_id)
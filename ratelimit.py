@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+ratelimit.py.
+
+Conference server-side Python App Engine per-user rate limiting and
+admission control for write endpoints
+
+"""
+
+import functools
+import math
+import random
+import time
+
+import endpoints
+from google.appengine.api import memcache
+from google.appengine.api.datastore_errors import TransactionFailedError
+
+from models import RateLimitExceededException
+from settings import COLLISION_MIN_SAMPLES
+from settings import COLLISION_RATE_THRESHOLD
+from settings import COLLISION_WINDOW
+from settings import RATE_LIMITS
+from utils import getUserId
+
+MEMCACHE_BUCKET_KEY = "RATELIMIT:%s:%s"
+MEMCACHE_WRITES_KEY = "RATELIMIT_WRITES:%d"
+MEMCACHE_COLLISIONS_KEY = "RATELIMIT_COLLISIONS:%d"
+CAS_RETRIES = 3
+
+
+def _takeToken(user_id, endpoint):
+    """
+    Take one token from the user's bucket for endpoint.
+
+    Return 0 when the call is admitted, otherwise the number of seconds
+    until a token becomes available.
+    """
+    rate, burst = RATE_LIMITS[endpoint]
+    key = MEMCACHE_BUCKET_KEY % (endpoint, user_id)
+    # a full bucket is indistinguishable from a missing one
+    ttl = int(math.ceil(burst / rate))
+    client = memcache.Client()
+
+    for i in range(CAS_RETRIES):
+        now = time.time()
+        bucket = client.gets(key)
+        if bucket is None:
+            if client.add(key, (burst - 1, now), time=ttl):
+                return 0
+            continue
+
+        tokens, stamp = bucket
+        tokens = min(burst, tokens + (now - stamp) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        if client.cas(key, (tokens - 1, now), time=ttl):
+            return 0
+
+    # memcache is contended; fail open rather than rejecting the user
+    return 0
+
+
+def _window():
+    """Return the id of the current collision-tracking window."""
+    return int(time.time()) // COLLISION_WINDOW
+
+
+def _shouldShed():
+    """Return True if the global collision rate calls for shedding."""
+    window = _window()
+    counts = memcache.get_multi([MEMCACHE_WRITES_KEY % window,
+                                 MEMCACHE_COLLISIONS_KEY % window])
+    writes = counts.get(MEMCACHE_WRITES_KEY % window, 0)
+    collisions = counts.get(MEMCACHE_COLLISIONS_KEY % window, 0)
+    if writes < COLLISION_MIN_SAMPLES:
+        return False
+
+    collision_rate = float(collisions) / writes
+    if collision_rate <= COLLISION_RATE_THRESHOLD:
+        return False
+    return random.random() < collision_rate
+
+
+def _count(key):
+    """Increment a collision-tracking counter for the current window."""
+    key = key % _window()
+    # incr cannot set an expiry; counters of past windows are never read
+    # again and left to eviction
+    memcache.incr(key, initial_value=0)
+
+
+def limited(endpoint):
+    """
+    Rate limit an endpoint method per authenticated user.
+
+    Rejects calls with a 403 rateLimitExceeded error once the user's token
+    bucket is empty or while the global transaction-collision rate is above
+    threshold.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request):
+            user = endpoints.get_current_user()
+            # unauthenticated calls are rejected by the method itself
+            if user:
+                if _shouldShed():
+                    raise RateLimitExceededException(
+                        'Service is busy.', COLLISION_WINDOW)
+                wait = _takeToken(getUserId(user), endpoint)
+                if wait:
+                    raise RateLimitExceededException(
+                        'Rate limit exceeded.', int(math.ceil(wait)))
+
+            _count(MEMCACHE_WRITES_KEY)
+            try:
+                return func(self, request)
+            except TransactionFailedError:
+                _count(MEMCACHE_COLLISIONS_KEY)
+                raise RateLimitExceededException(
+                    'Too much contention.', COLLISION_WINDOW)
+        return wrapper
+    return decorator
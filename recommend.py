@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+recommend.py.
+
+Conference server-side Python App Engine conference recommendations,
+scored against a periodically rebuilt snapshot of conference feature
+vectors
+
+"""
+
+import cPickle as pickle
+import time
+import zlib
+from datetime import date
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import RecommenderChunk
+from models import RecommenderSnapshot
+
+import storage
+
+# weight of a shared topic, city or organizer in the similarity score
+FEATURE_WEIGHTS = {
+    'topic': 1.0,
+    'city': 0.5,
+    'organizer': 0.5,
+}
+
+CHUNK_SIZE = 900 * 1024
+VERSION_CHECK_INTERVAL = 60
+RECOMMENDATIONS_TTL = 60 * 60
+MEMCACHE_VERSION_KEY = "RECOMMENDER_VERSION"
+MEMCACHE_RECOMMENDATIONS_KEY = "RECOMMENDATIONS:%s"
+
+# per-instance copy of the current snapshot
+_snapshot = {'version': None, 'checked': 0, 'data': None}
+
+
+def _features(conf):
+    """Return the (kind, value) features of a Conference."""
+    features = [('topic', topic) for topic in conf.topics or []]
+    if conf.city:
+        features.append(('city', conf.city))
+    if conf.organizerUserId:
+        features.append(('organizer', conf.organizerUserId))
+    return features
+
+
+def build():
+    """
+    Rebuild the snapshot from the upcoming conferences.
+
+    Each conference is a sparse row of weighted features, stored as
+    CSR arrays (indices, indptr, weights) next to the feature vocabulary.
+    """
+    import numpy
+    keys = []
+    vocab = {}
+    indices = []
+    indptr = [0]
+    weights = []
+    for conf in storage.backend().iterConferences(
+            startingFrom=date.today()):
+        if conf.deleted:
+            continue
+        keys.append(conf.key.urlsafe())
+        for kind, value in _features(conf):
+            indices.append(vocab.setdefault('%s:%s' % (kind, value),
+                                            len(vocab)))
+            weights.append(FEATURE_WEIGHTS[kind])
+        indptr.append(len(indices))
+
+    blob = zlib.compress(pickle.dumps({
+        'keys': keys,
+        'vocab': vocab,
+        'indices': numpy.array(indices, dtype=numpy.int32).tostring(),
+        'indptr': numpy.array(indptr, dtype=numpy.int32).tostring(),
+        'weights': numpy.array(weights, dtype=numpy.float32).tostring(),
+    }, pickle.HIGHEST_PROTOCOL))
+
+    # write the new chunks before switching the header over to them
+    version = int(time.time())
+    chunks = [RecommenderChunk(id='%d:%d' % (version, i),
+                               data=blob[offset:offset + CHUNK_SIZE])
+              for i, offset in enumerate(range(0, len(blob), CHUNK_SIZE))]
+    ndb.put_multi(chunks)
+    h_key = ndb.Key(RecommenderSnapshot, 'current')
+    old = h_key.get()
+    RecommenderSnapshot(key=h_key, version=version, chunks=len(chunks)).put()
+    memcache.set(MEMCACHE_VERSION_KEY, version)
+    if old:
+        ndb.delete_multi([ndb.Key(RecommenderChunk, '%d:%d' % (old.version, i))
+                          for i in range(old.chunks)])
+    return len(keys)
+
+
+def _currentVersion():
+    version = memcache.get(MEMCACHE_VERSION_KEY)
+    if version is None:
+        header = ndb.Key(RecommenderSnapshot, 'current').get()
+        if header:
+            version = header.version
+            memcache.set(MEMCACHE_VERSION_KEY, version)
+    return version
+
+
+def _load():
+    """Return the current snapshot, reloading it once it is replaced."""
+    global _snapshot
+    now = time.time()
+    if now - _snapshot['checked'] < VERSION_CHECK_INTERVAL:
+        return _snapshot['data']
+
+    version = _currentVersion()
+    if version != _snapshot['version']:
+        import numpy
+        header = ndb.Key(RecommenderSnapshot, 'current').get()
+        chunks = ndb.get_multi([
+            ndb.Key(RecommenderChunk, '%d:%d' % (header.version, i))
+            for i in range(header.chunks)])
+        data = pickle.loads(zlib.decompress(
+            ''.join(chunk.data for chunk in chunks)))
+        for name, dtype in (('indices', numpy.int32),
+                            ('indptr', numpy.int32),
+                            ('weights', numpy.float32)):
+            data[name] = numpy.fromstring(data[name], dtype=dtype)
+        data['rows'] = {key: i for i, key in enumerate(data['keys'])}
+        if data['keys']:
+            data['norms'] = numpy.sqrt(numpy.add.reduceat(
+                data['weights'] ** 2, data['indptr'][:-1]))
+        data['version'] = header.version
+        _snapshot = {'version': header.version, 'checked': now,
+                     'data': data}
+    else:
+        _snapshot = dict(_snapshot, checked=now)
+    return _snapshot['data']
+
+
+def _score(snapshot, seeds, limit):
+    """Return the keys of the conferences most similar to the seeds."""
+    import numpy
+    vocab = snapshot['vocab']
+    profile = numpy.zeros(len(vocab), dtype=numpy.float32)
+    for conf in seeds:
+        for kind, value in _features(conf):
+            i = vocab.get('%s:%s' % (kind, value))
+            if i is not None:
+                profile[i] += FEATURE_WEIGHTS[kind]
+    if not snapshot['keys'] or not profile.any():
+        return []
+
+    # cosine similarity of the profile against every conference row
+    scores = numpy.add.reduceat(
+        profile[snapshot['indices']] * snapshot['weights'],
+        snapshot['indptr'][:-1]) / (snapshot['norms'] *
+                                    numpy.sqrt((profile ** 2).sum()))
+    for conf in seeds:
+        row = snapshot['rows'].get(conf.key.urlsafe())
+        if row is not None:
+            scores[row] = 0
+    top = numpy.argsort(-scores)[:limit]
+    return [snapshot['keys'][i] for i in top if scores[i] > 0]
+
+
+def recommend(prof, limit):
+    """Return keys of upcoming conferences suited to a user's Profile."""
+    snapshot = _load()
+    if not snapshot:
+        return []
+
+    mc_key = MEMCACHE_RECOMMENDATIONS_KEY % prof.key.id()
+    cached = memcache.get(mc_key)
+    if cached and cached[0] == (snapshot['version'], limit):
+        return [ndb.Key(urlsafe=wsck) for wsck in cached[1]]
+
+    # registered conferences and the parents of wishlisted sessions
+    seed_keys = set(ndb.Key(urlsafe=wsck)
+                    for wsck in prof.conferenceKeysToAttend)
+    seed_keys.update(s_key.parent() for s_key in prof.wishList)
+    seeds = [conf for conf in storage.backend().getMulti(list(seed_keys))
+             if conf]
+
+    keys = _score(snapshot, seeds, limit)
+    memcache.set(mc_key, ((snapshot['version'], limit), keys),
+                 time=RECOMMENDATIONS_TTL)
+    return [ndb.Key(urlsafe=wsck) for wsck in keys]
+
+
+def invalidate(user_id):
+    """
+    Drop a user's cached recommendations.
+
+    Inside a transaction this only happens once the transaction commits.
+    """
+    def drop():
+        memcache.delete(MEMCACHE_RECOMMENDATIONS_KEY % user_id)
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(drop)
+    else:
+        drop()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+searchindex.py.
+
+Conference server-side Python App Engine full-text search over
+conferences and sessions, backed by an inverted index of sharded
+posting lists
+
+"""
+
+import bisect
+import math
+import re
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import PostingList
+from models import SearchDocument
+from models import SearchTerm
+
+import storage
+
+# indexed properties per kind, with the weight of a term found in them
+SEARCH_FIELDS = {
+    'Conference': (('name', 3), ('topics', 2), ('city', 1),
+                   ('description', 1)),
+    'Session': (('name', 3), ('speaker', 2), ('highlights', 1)),
+}
+
+STOPWORDS = frozenset([
+    'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is',
+    'it', 'of', 'on', 'or', 'the', 'to', 'with',
+])
+
+# postings of a term are spread over shards so that concurrent updates
+# of a popular term don't contend on one entity
+POSTING_SHARDS = 8
+MAX_PREFIX_EXPANSIONS = 10
+TERM_CACHE_TTL = 300
+MEMCACHE_TERMS_KEY = "SEARCH_TERMS"
+
+# per-instance copy of the sorted term dictionary
+_termCache = {'terms': [], 'expires': 0}
+
+
+def tokenize(text):
+    """Split text into lowercase search terms."""
+    return [term for term in re.findall(r'[a-z0-9]+', text.lower())
+            if len(term) > 1 and term not in STOPWORDS]
+
+
+def _documentTerms(entity):
+    """Return the weighted terms of an entity, as {term: weight}."""
+    terms = {}
+    for name, weight in SEARCH_FIELDS[entity.key.kind()]:
+        values = getattr(entity, name)
+        if values is None:
+            continue
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            for term in tokenize(value):
+                terms[term] = terms.get(term, 0) + weight
+    return terms
+
+
+def _postingKey(term, shard):
+    return ndb.Key(PostingList, '%s:%d' % (term, shard))
+
+
+def _shard(websafeKey):
+    return (zlib.crc32(websafeKey) & 0xffffffff) % POSTING_SHARDS
+
+
+@ndb.transactional_tasklet
+def _updatePosting(p_key, websafeKey, weight):
+    """Set (or with no weight, remove) a document in a posting shard."""
+    posting = yield p_key.get_async()
+    if not posting:
+        posting = PostingList(key=p_key, postings={})
+    if weight:
+        posting.postings[websafeKey] = weight
+    else:
+        posting.postings.pop(websafeKey, None)
+    yield posting.put_async()
+
+
+def indexEntity(key):
+    """
+    Bring the index up to date with the entity stored at key.
+
+    Only the postings of terms whose weight changed are rewritten; a
+    missing or deleted entity is removed from the index.
+    """
+    websafeKey = key.urlsafe()
+    # the entity is read from the storage backend, the index from ndb
+    doc_future = ndb.Key(SearchDocument, websafeKey).get_async()
+    entity = storage.backend().get(key)
+    doc = doc_future.get_result()
+    if getattr(entity, 'deleted', False):
+        entity = None
+    old = doc.terms if doc else {}
+    new = _documentTerms(entity) if entity else {}
+
+    shard = _shard(websafeKey)
+    futures = [_updatePosting(_postingKey(term, shard), websafeKey,
+                              new.get(term))
+               for term in set(old) | set(new)
+               if old.get(term) != new.get(term)]
+
+    added = [SearchTerm(id=term) for term in new if term not in old]
+    futures.extend(ndb.put_multi_async(added))
+    if entity:
+        futures.append(SearchDocument(
+            key=ndb.Key(SearchDocument, websafeKey), kind=key.kind(),
+            title=entity.name, terms=new).put_async())
+    elif doc:
+        futures.append(doc.key.delete_async())
+
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    if added:
+        memcache.delete(MEMCACHE_TERMS_KEY)
+
+
+def _termDictionary():
+    """Return the sorted term dictionary, cached per instance."""
+    global _termCache
+    if time.time() < _termCache['expires']:
+        return _termCache['terms']
+
+    terms = memcache.get(MEMCACHE_TERMS_KEY)
+    if terms is None:
+        terms = sorted(k.id() for k in SearchTerm.query().iter(
+            keys_only=True))
+        memcache.set(MEMCACHE_TERMS_KEY, terms, time=TERM_CACHE_TTL)
+    _termCache = {'terms': terms, 'expires': time.time() + TERM_CACHE_TTL}
+    return terms
+
+
+def _expand(token, dictionary):
+    """Return the token plus the dictionary terms it is a prefix of."""
+    terms = set([token])
+    i = bisect.bisect_left(dictionary, token)
+    while (i < len(dictionary) and dictionary[i].startswith(token) and
+           len(terms) < MAX_PREFIX_EXPANSIONS):
+        terms.add(dictionary[i])
+        i += 1
+    return terms
+
+
+def query(text, kind=None, offset=0, limit=20):
+    """
+    Search the index for documents matching every word of text.
+
+    Words also match terms they are a prefix of. Return a page of
+    (SearchDocument, score) pairs, best first, and the offset of the
+    next page or None.
+    """
+    tokens = tokenize(text)
+    if not tokens:
+        return [], None
+
+    dictionary = _termDictionary()
+    expansions = [(token, _expand(token, dictionary)) for token in tokens]
+
+    # fetch every shard of every candidate term in one batch
+    terms = set().union(*[terms for token, terms in expansions])
+    postings = {}
+    for posting in ndb.get_multi([_postingKey(term, shard)
+                                  for term in terms
+                                  for shard in range(POSTING_SHARDS)]):
+        if posting:
+            term = posting.key.id().rsplit(':', 1)[0]
+            postings.setdefault(term, {}).update(posting.postings)
+
+    scores = None
+    for token, terms in expansions:
+        token_scores = {}
+        for term in terms:
+            docs = postings.get(term, {})
+            # rarer terms weigh more; prefix matches count for half
+            idf = 1.0 / math.log(2 + len(docs))
+            if term != token:
+                idf /= 2
+            for websafeKey, weight in docs.items():
+                token_scores[websafeKey] = max(
+                    token_scores.get(websafeKey, 0), weight * idf)
+        if scores is None:
+            scores = token_scores
+        else:
+            scores = {websafeKey: scores[websafeKey] + score
+                      for websafeKey, score in token_scores.items()
+                      if websafeKey in scores}
+
+    ranked = sorted(scores.items(), key=lambda hit: (-hit[1], hit[0]))
+    if kind:
+        ranked = [hit for hit in ranked
+                  if ndb.Key(urlsafe=hit[0]).kind() == kind]
+    page = ranked[offset:offset + limit]
+    docs = ndb.get_multi([ndb.Key(SearchDocument, websafeKey)
+                          for websafeKey, score in page])
+    next_offset = offset + limit if len(ranked) > offset + limit else None
+    return ([(doc, score) for doc, (websafeKey, score) in zip(docs, page)
+             if doc], next_offset)
@@ -11,3 +11,63 @@ Conference server-side Python App Engine app user settings
 # Console or Cloud Console.
 WEB_CLIENT_ID = '987715460853-tvcrimhc1hvgso29evg09l5a5tf9ht3o\
 .apps.googleusercontent.com'
+
+# Per-user token bucket limits on write endpoints, as
+# (tokens refilled per second, bucket size).
+RATE_LIMITS = {
+    'createConference': (0.1, 5),
+    'createSession': (0.5, 10),
+    'registerForConference': (0.2, 5),
+    'unregisterFromConference': (0.2, 5),
+    'joinWaitlist': (0.2, 5),
+    'leaveWaitlist': (0.2, 5),
+    'queueRegistration': (0.2, 5),
+    'addSessionToWishlist': (1.0, 20),
+    'removeSessionFromWishList': (1.0, 20),
+    'updateWishList': (0.5, 10),
+}
+
+# Global admission control: once more than COLLISION_RATE_THRESHOLD of the
+# limited writes in a COLLISION_WINDOW (seconds) hit a transaction
+# collision, new writes are shed in proportion to the collision rate.
+COLLISION_WINDOW = 10
+COLLISION_RATE_THRESHOLD = 0.2
+COLLISION_MIN_SAMPLES = 20
+
+# How long (seconds) a response is replayed for a repeated idempotency key.
+IDEMPOTENCY_WINDOW = 24 * 60 * 60
+
+# Storage backend of conferences, sessions and profiles: 'ndb', or
+# 'sqlite:PATH' for load testing off App Engine. The CONFERENCE_STORAGE
+# environment variable overrides it.
+STORAGE_BACKEND = 'ndb'
+
+# Count the shapes of the datastore queries the API runs, for the index
+# advisor at /admin/index_advisor.
+RECORD_QUERY_SHAPES = True
+
+# Answer queryConferences from a per-instance columnar catalog of the
+# upcoming conferences, falling back to the datastore while it is stale.
+CONFERENCE_CATALOG = True
+
+# Task queue lag budgets (seconds from enqueue to the end of a successful
+# run) per task type. /admin/task_lag flags, and a cron logs an error for,
+# task types whose 95th percentile lag is over budget.
+TASK_LAG_BUDGETS = {
+    'set_featured_speaker': 30,
+    'index_document': 60,
+    'update_facets': 60,
+    'promote_waitlist': 60,
+    'update_session_summaries': 300,
+    'process_registrations': 30,
+    'registration': 30,
+    'mail': 180,
+    'run_job_shard': 600,
+    'delete_conference': 600,
+    'scrub_profiles': 300,
+}
+DEFAULT_TASK_LAG_BUDGET = 60
+
+# Let admins profile single requests, with an X-Conference-Profile header
+# or a _profile=1 query flag; see /admin/profiles.
+REQUEST_PROFILING = True
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+
+"""
+sqlitestorage.py.
+
+Conference server-side Python App Engine SQLite storage backend, with an
+in-process cache, for running the API and its benchmarks off App Engine
+
+"""
+
+import cPickle as pickle
+import sqlite3
+import threading
+import time
+
+from google.appengine.api.datastore_errors import TransactionFailedError
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Profile
+from models import Session
+from models import WaitlistEntry
+from storage import Storage
+
+LOCK_TIMEOUT = 5
+TRANSACTION_RETRIES = 3
+# SQLite's default limit on the parameters of a statement is 999
+GET_BATCH = 500
+
+# entities are stored whole in `entity`; the queried properties are
+# copied into per-kind tables with the indexes the API queries need
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entity (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS id_sequence (
+    kind TEXT PRIMARY KEY,
+    next INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS conference (
+    key TEXT PRIMARY KEY,
+    id INTEGER,
+    organizer TEXT,
+    name TEXT,
+    city TEXT,
+    month INTEGER,
+    maxAttendees INTEGER,
+    seatsAvailable INTEGER,
+    startDate TEXT);
+CREATE INDEX IF NOT EXISTS conference_organizer
+    ON conference (organizer, id);
+CREATE INDEX IF NOT EXISTS conference_name ON conference (name);
+CREATE INDEX IF NOT EXISTS conference_city ON conference (city, name);
+CREATE INDEX IF NOT EXISTS conference_month ON conference (month, name);
+CREATE INDEX IF NOT EXISTS conference_max_attendees
+    ON conference (maxAttendees, name);
+CREATE INDEX IF NOT EXISTS conference_seats_available
+    ON conference (seatsAvailable);
+CREATE INDEX IF NOT EXISTS conference_start_date
+    ON conference (startDate);
+CREATE TABLE IF NOT EXISTS conference_topic (
+    key TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    PRIMARY KEY (topic, key));
+CREATE INDEX IF NOT EXISTS conference_topic_key ON conference_topic (key);
+CREATE TABLE IF NOT EXISTS session (
+    key TEXT PRIMARY KEY,
+    id INTEGER,
+    conference TEXT NOT NULL,
+    speaker TEXT,
+    sessionType TEXT,
+    startTime TEXT);
+CREATE INDEX IF NOT EXISTS session_conference_type
+    ON session (conference, sessionType, id);
+CREATE INDEX IF NOT EXISTS session_conference_speaker
+    ON session (conference, speaker, id);
+CREATE INDEX IF NOT EXISTS session_speaker ON session (speaker, sessionType);
+CREATE INDEX IF NOT EXISTS session_start_time ON session (startTime);
+CREATE TABLE IF NOT EXISTS profile (
+    key TEXT PRIMARY KEY,
+    feedToken TEXT);
+CREATE INDEX IF NOT EXISTS profile_feed_token ON profile (feedToken);
+CREATE TABLE IF NOT EXISTS profile_conference (
+    key TEXT NOT NULL,
+    conference TEXT NOT NULL,
+    PRIMARY KEY (conference, key));
+CREATE INDEX IF NOT EXISTS profile_conference_key
+    ON profile_conference (key);
+CREATE TABLE IF NOT EXISTS profile_wishlist (
+    key TEXT NOT NULL,
+    session TEXT NOT NULL,
+    PRIMARY KEY (session, key));
+CREATE INDEX IF NOT EXISTS profile_wishlist_key ON profile_wishlist (key);
+CREATE TABLE IF NOT EXISTS waitlist (
+    key TEXT PRIMARY KEY,
+    conference TEXT NOT NULL,
+    joined TEXT);
+CREATE INDEX IF NOT EXISTS waitlist_conference
+    ON waitlist (conference, joined);
+"""
+
+# tables holding rows of an entity, cleared when it is deleted
+ENTITY_TABLES = ('entity', 'conference', 'conference_topic', 'session',
+                 'profile', 'profile_conference', 'profile_wishlist',
+                 'waitlist')
+
+CONFERENCE_FIELDS = ('city', 'month', 'maxAttendees', 'topics')
+OPERATORS = ('=', '>', '>=', '<', '<=', '!=')
+
+_adapter = ndb.ModelAdapter()
+# cacheSet's time argument, as in memcache, shadows the module
+_clock = time.time
+
+
+def _dump(entity):
+    return sqlite3.Binary(_adapter.entity_to_pb(entity).Encode())
+
+
+def _load(data):
+    return _adapter.pb_to_entity(entity_pb.EntityProto(str(data)))
+
+
+class SqliteStorage(Storage):
+
+    """SqliteStorage -- a SQLite database and an in-process cache.
+
+    Transactions take the database write lock up front, so concurrent
+    writers queue behind each other instead of colliding; a writer still
+    waiting after LOCK_TIMEOUT is retried, then fails like a datastore
+    transaction. Task and version updates made inside a transaction are
+    applied even if it rolls back; only onCommit callbacks wait for it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._cache = {}
+        self._cacheLock = threading.Lock()
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+
+    def _connection(self):
+        """Return this thread's connection, in autocommit mode."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT,
+                                   isolation_level=None)
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def transaction(self, func, xg=False):
+        conn = self._connection()
+        if self._local.depth:
+            return func()
+        for i in range(TRANSACTION_RETRIES):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError:
+                # still locked by another writer after LOCK_TIMEOUT
+                continue
+            self._local.depth = 1
+            self._local.committed = []
+            try:
+                result = func()
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+            finally:
+                self._local.depth = 0
+            for callback in self._local.committed:
+                callback()
+            return result
+        raise TransactionFailedError(
+            'The transaction could not be committed. Please try again.')
+
+    def inTransaction(self):
+        self._connection()
+        return bool(self._local.depth)
+
+    def onCommit(self, func):
+        if self.inTransaction():
+            self._local.committed.append(func)
+        else:
+            func()
+
+    # - - - entities - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def get(self, key):
+        return self.getMulti([key])[0]
+
+    def getMulti(self, keys):
+        conn = self._connection()
+        wskeys = [key.urlsafe() for key in keys]
+        found = {}
+        for i in range(0, len(wskeys), GET_BATCH):
+            batch = wskeys[i:i + GET_BATCH]
+            found.update(conn.execute(
+                'SELECT key, data FROM entity WHERE key IN (%s)'
+                % ','.join('?' * len(batch)), batch))
+        return [_load(found[wskey]) if wskey in found else None
+                for wskey in wskeys]
+
+    def put(self, entity):
+        return self.putMulti([entity])[0]
+
+    def putMulti(self, entities):
+        for entity in entities:
+            if not entity.key or not entity.key.id():
+                entity.key = self.allocateKey(
+                    type(entity), entity.key and entity.key.parent())
+        self.transaction(lambda: [self._write(entity)
+                                  for entity in entities])
+        return [entity.key for entity in entities]
+
+    def deleteMulti(self, keys):
+        wskeys = [key.urlsafe() for key in keys]
+
+        def delete():
+            conn = self._connection()
+            for i in range(0, len(wskeys), GET_BATCH):
+                batch = wskeys[i:i + GET_BATCH]
+                for table in ENTITY_TABLES:
+                    conn.execute('DELETE FROM %s WHERE key IN (%s)' % (
+                        table, ','.join('?' * len(batch))), batch)
+        self.transaction(delete)
+
+    def _write(self, entity):
+        """Store an entity and its indexed properties."""
+        conn = self._connection()
+        entity._prepare_for_put()
+        wskey = entity.key.urlsafe()
+        conn.execute('INSERT OR REPLACE INTO entity VALUES (?, ?, ?)',
+                     (wskey, entity.key.kind(), _dump(entity)))
+        if isinstance(entity, Conference):
+            conn.execute(
+                'INSERT OR REPLACE INTO conference VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (wskey, entity.key.id(), entity.key.parent().id(),
+                 entity.name, entity.city, entity.month,
+                 entity.maxAttendees, entity.seatsAvailable,
+                 entity.startDate and entity.startDate.isoformat()))
+            conn.execute('DELETE FROM conference_topic WHERE key = ?',
+                         (wskey,))
+            conn.executemany('INSERT OR IGNORE INTO conference_topic '
+                             'VALUES (?, ?)',
+                             [(wskey, topic) for topic in entity.topics])
+        elif isinstance(entity, Session):
+            conn.execute(
+                'INSERT OR REPLACE INTO session VALUES (?, ?, ?, ?, ?, ?)',
+                (wskey, entity.key.id(), entity.key.parent().urlsafe(),
+                 entity.speaker, entity.sessionType,
+                 entity.startTime and entity.startTime.isoformat()))
+        elif isinstance(entity, Profile):
+            conn.execute('INSERT OR REPLACE INTO profile VALUES (?, ?)',
+                         (wskey, entity.feedToken))
+            for table, values in (
+                    ('profile_conference', entity.conferenceKeysToAttend),
+                    ('profile_wishlist', [s_key.urlsafe() for s_key
+                                          in entity.wishList])):
+                conn.execute('DELETE FROM %s WHERE key = ?' % table,
+                             (wskey,))
+                conn.executemany('INSERT OR IGNORE INTO %s VALUES (?, ?)'
+                                 % table,
+                                 [(wskey, value) for value in values])
+        elif isinstance(entity, WaitlistEntry):
+            conn.execute('INSERT OR REPLACE INTO waitlist VALUES (?, ?, ?)',
+                         (wskey, entity.key.parent().urlsafe(),
+                          entity.joined.isoformat()))
+
+    def allocateKey(self, model, parent=None):
+        kind = model._get_kind()
+
+        def allocate():
+            conn = self._connection()
+            conn.execute('INSERT OR IGNORE INTO id_sequence VALUES (?, 0)',
+                         (kind,))
+            conn.execute('UPDATE id_sequence SET next = next + 1 '
+                         'WHERE kind = ?', (kind,))
+            return conn.execute('SELECT next FROM id_sequence '
+                                'WHERE kind = ?', (kind,)).fetchone()[0]
+        return ndb.Key(model, self.transaction(allocate), parent=parent)
+
+    def _select(self, table, where, args, order):
+        """Return the entities of the rows of table matching where."""
+        return [_load(data) for data, in self._connection().execute(
+            'SELECT e.data FROM %s r JOIN entity e ON e.key = r.key '
+            'WHERE %s ORDER BY %s' % (table, where, order), args)]
+
+    # - - - queries - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def queryConferences(self, inequality_field, filters):
+        where = ['1']
+        args = []
+        for field, operator, value in filters:
+            if field not in CONFERENCE_FIELDS or operator not in OPERATORS:
+                raise ValueError('Invalid filter: %s %s' % (field, operator))
+            if field == 'topics':
+                where.append('EXISTS (SELECT 1 FROM conference_topic t '
+                             'WHERE t.key = r.key AND t.topic %s ?)'
+                             % operator)
+            else:
+                where.append('r.%s %s ?' % (field, operator))
+            args.append(value)
+
+        order = 'r.name'
+        if inequality_field == 'topics':
+            order = ('(SELECT MIN(topic) FROM conference_topic t '
+                     'WHERE t.key = r.key), r.name')
+        elif inequality_field:
+            order = 'r.%s, r.name' % inequality_field
+        return self._select('conference', ' AND '.join(where), args, order)
+
+    def conferencesByOrganizer(self, user_id):
+        return self._select('conference', 'r.organizer = ?', [user_id],
+                            'r.id')
+
+    def iterConferences(self, startingFrom=None, undated=False):
+        if not startingFrom:
+            return self._select('conference', '1', [], 'r.key')
+        return self._select('conference',
+                            'r.startDate >= ? OR r.startDate IS NULL'
+                            if undated else 'r.startDate >= ?',
+                            [startingFrom.isoformat()], 'r.startDate')
+
+    def nearlySoldOut(self, seats):
+        return [name for name, in self._connection().execute(
+            'SELECT name FROM conference '
+            'WHERE seatsAvailable > 0 AND seatsAvailable <= ?', (seats,))]
+
+    def _sessions(self, c_key, sessionType, speaker, order):
+        where = []
+        args = []
+        for column, value in (('conference', c_key and c_key.urlsafe()),
+                              ('speaker', speaker),
+                              ('sessionType', sessionType)):
+            if value is not None:
+                where.append('r.%s = ?' % column)
+                args.append(value)
+        return self._select('session', ' AND '.join(where) or '1', args,
+                            order)
+
+    def sessionsByConference(self, c_key, sessionType=None, speaker=None):
+        return self._sessions(c_key, sessionType, speaker, 'r.id')
+
+    def sessionsBySpeaker(self, speaker, sessionType=None):
+        return self._sessions(None, sessionType, speaker, 'r.key')
+
+    def sessionKeysByConference(self, c_key, limit=None):
+        return [ndb.Key(urlsafe=wskey) for wskey, in
+                self._connection().execute(
+                    'SELECT key FROM session WHERE conference = ? '
+                    'ORDER BY id LIMIT ?',
+                    (c_key.urlsafe(), -1 if limit is None else limit))]
+
+    def sessionsStartingAfter(self, startTime):
+        if not startTime:
+            return self._sessions(None, None, None, 'r.key')
+        return self._select('session', 'r.startTime >= ?',
+                            [startTime.isoformat()], 'r.startTime')
+
+    # - - - profiles and waitlists - - - - - - - - - - - - - - - - -
+
+    def profileByFeedToken(self, token):
+        profiles = self._select('profile', 'r.feedToken = ?', [token],
+                                'r.key')
+        return profiles[0] if profiles else None
+
+    def profileKeysAttending(self, wsck, limit, cursor=None):
+        # the cursor is the last key of the previous page
+        wskeys = [wskey for wskey, in self._connection().execute(
+            'SELECT key FROM profile_conference '
+            'WHERE conference = ? AND key > ? ORDER BY key LIMIT ?',
+            (wsck, cursor or '', limit + 1))]
+        more = len(wskeys) > limit
+        wskeys = wskeys[:limit]
+        return ([ndb.Key(urlsafe=wskey) for wskey in wskeys],
+                wskeys[-1] if wskeys else cursor, more)
+
+    def profileKeysWishing(self, s_keys):
+        return [ndb.Key(urlsafe=wskey) for wskey, in
+                self._connection().execute(
+                    'SELECT DISTINCT key FROM profile_wishlist '
+                    'WHERE session IN (%s)' % ','.join('?' * len(s_keys)),
+                    [s_key.urlsafe() for s_key in s_keys])]
+
+    def waitlistKeys(self, c_key, limit=None):
+        return [ndb.Key(urlsafe=wskey) for wskey, in
+                self._connection().execute(
+                    'SELECT key FROM waitlist WHERE conference = ? '
+                    'ORDER BY joined, key LIMIT ?',
+                    (c_key.urlsafe(), -1 if limit is None else limit))]
+
+    # - - - cache - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def cacheGet(self, key):
+        with self._cacheLock:
+            entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires and expires < _clock():
+            self.cacheDelete(key)
+            return None
+        # values are copies, as from memcache
+        return pickle.loads(value)
+
+    def cacheSet(self, key, value, time=0):
+        entry = (_clock() + time if time else 0,
+                 pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._cacheLock:
+            self._cache[key] = entry
+        return True
+
+    def cacheDelete(self, key):
+        with self._cacheLock:
+            return self._cache.pop(key, None) is not None
@@ -130,3 +130,63 @@ app.factory('oauth2Provider', function ($modal) {
 
     return oauth2Provider;
 });
+
+
+/**
+ * @ngdoc service
+ * @name etagCache
+ *
+ * @description
+ * Service that keeps the last copy of API responses with their ETag, so that requests can send
+ * ifNoneMatch and reuse the cached copy when the server answers notModified.
+ *
+ */
+app.factory('etagCache', function ($window) {
+    var storage = $window.sessionStorage;
+    var etagCache = {};
+
+    /**
+     * Returns the cached entry for the key.
+     *
+     * @param key
+     * @returns {{etag: string, data: {}}|undefined}
+     */
+    etagCache.get = function (key) {
+        var entry = storage.getItem('etag:' + key);
+        return entry ? JSON.parse(entry) : undefined;
+    };
+
+    /**
+     * Returns the ETag cached for the key, to be sent as ifNoneMatch.
+     *
+     * @param key
+     * @returns {string|undefined}
+     */
+    etagCache.etag = function (key) {
+        var entry = etagCache.get(key);
+        return entry && entry.etag;
+    };
+
+    /**
+     * Returns the data to use for a response: the cached copy if the response is notModified,
+     * otherwise the response itself, which is then cached.
+     *
+     * @param key
+     * @param result the response carrying etag and notModified.
+     * @returns {{}}
+     */
+    etagCache.resolve = function (key, result) {
+        if (result.notModified) {
+            var entry = etagCache.get(key);
+            if (entry) {
+                return entry.data;
+            }
+        }
+        if (result.etag) {
+            storage.setItem('etag:' + key, JSON.stringify({etag: result.etag, data: result}));
+        }
+        return result;
+    };
+
+    return etagCache;
+});
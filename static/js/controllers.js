@@ -25,7 +25,7 @@ conferenceApp.controllers = angular.module('conferenceControllers', ['ui.bootstr
  * A controller used for the My Profile page.
  */
 conferenceApp.controllers.controller('MyProfileCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, etagCache, HTTP_ERRORS) {
         $scope.submitted = false;
         $scope.loading = false;
 
@@ -57,24 +57,39 @@ conferenceApp.controllers.controller('MyProfileCtrl',
         ];
         /**
          * Initializes the My profile page.
-         * Update the profile if the user's profile has been stored.
+         * Invokes the conference.batch method to fetch the user's profile and the announcement in a single
+         * round trip, and updates the profile if the user's profile has been stored.
          */
         $scope.init = function () {
             var retrieveProfileCallback = function () {
                 $scope.profile = {};
                 $scope.loading = true;
-                gapi.client.conference.getProfile().
+                gapi.client.conference.batch({
+                    items: [
+                        {id: 'profile', method: 'getProfile', ifNoneMatch: etagCache.etag('profile')},
+                        {id: 'announcement', method: 'getAnnouncement'}
+                    ]
+                }).
                     execute(function (resp) {
                         $scope.$apply(function () {
                             $scope.loading = false;
                             if (resp.error) {
-                                // Failed to get a user profile.
-                            } else {
-                                // Succeeded to get the user profile.
-                                $scope.profile.displayName = resp.result.displayName;
-                                $scope.profile.teeShirtSize = resp.result.teeShirtSize;
-                                $scope.initialProfile = resp.result;
+                                // The whole batch has failed.
+                                return;
                             }
+                            angular.forEach(resp.items, function (item) {
+                                if (item.error) {
+                                    // Failed to get a user profile or the announcement.
+                                } else if (item.id == 'profile') {
+                                    // Succeeded to get the user profile, possibly the cached copy.
+                                    var profile = etagCache.resolve('profile', item.profile);
+                                    $scope.profile.displayName = profile.displayName;
+                                    $scope.profile.teeShirtSize = profile.teeShirtSize;
+                                    $scope.initialProfile = profile;
+                                } else if (item.id == 'announcement') {
+                                    $scope.announcement = item.data;
+                                }
+                            });
                         });
                     }
                 );
@@ -506,33 +521,51 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Retrieves the conferences to attend by calling the conference.getProfile method and
-     * invokes the conference.getConference method n times where n == the number of the conferences to attend.
+     * Retrieves the conferences to attend and the announcement in a single round trip
+     * by calling the conference.batch method.
      */
     $scope.getConferencesAttend = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
+        gapi.client.conference.batch({
+            items: [
+                {id: 'conferences', method: 'getConferencesToAttend'},
+                {id: 'announcement', method: 'getAnnouncement'}
+            ]
+        }).
             execute(function (resp) {
                 $scope.$apply(function () {
                     if (resp.error) {
-                        // The request has failed.
+                        // The whole batch has failed.
                         var errorMessage = resp.error.message || '';
                         $scope.messages = 'Failed to query the conferences to attend : ' + errorMessage;
                         $scope.alertStatus = 'warning';
                         $log.error($scope.messages);
-
-                        if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
-                            oauth2Provider.showLoginModal();
-                            return;
-                        }
-                    } else {
-                        // The request has succeeded.
-                        $scope.conferences = resp.result.items;
-                        $scope.loading = false;
-                        $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
-                        $scope.alertStatus = 'success';
-                        $log.info($scope.messages);
+                        $scope.submitted = true;
+                        return;
                     }
+                    angular.forEach(resp.items, function (item) {
+                        if (item.id == 'conferences') {
+                            if (item.error) {
+                                // The request has failed.
+                                $scope.messages = 'Failed to query the conferences to attend : ' + item.error;
+                                $scope.alertStatus = 'warning';
+                                $log.error($scope.messages);
+
+                                if (item.status == HTTP_ERRORS.UNAUTHORIZED) {
+                                    oauth2Provider.showLoginModal();
+                                }
+                            } else {
+                                // The request has succeeded.
+                                $scope.conferences = item.conferences.items;
+                                $scope.loading = false;
+                                $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
+                                $scope.alertStatus = 'success';
+                                $log.info($scope.messages);
+                            }
+                        } else if (item.id == 'announcement' && !item.error) {
+                            $scope.announcement = item.data;
+                        }
+                    });
                     $scope.submitted = true;
                 });
             });
@@ -547,57 +580,71 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
  * @description
  * A controller used for the conference detail page.
  */
-conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, etagCache, HTTP_ERRORS) {
     $scope.conference = {};
 
     $scope.isUserAttending = false;
 
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.batch method to fetch the conference and the user's profile in a single
+     * round trip and sets the returned conference in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
-            websafeConferenceKey: $routeParams.websafeConferenceKey
+        gapi.client.conference.batch({
+            items: [
+                {id: 'conference', method: 'getConference',
+                 websafeConferenceKey: $routeParams.websafeConferenceKey,
+                 ifNoneMatch: etagCache.etag('conference:' + $routeParams.websafeConferenceKey)},
+                {id: 'profile', method: 'getProfile', ifNoneMatch: etagCache.etag('profile')}
+            ]
         }).execute(function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
                 if (resp.error) {
-                    // The request has failed.
+                    // The whole batch has failed.
                     var errorMessage = resp.error.message || '';
-                    $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeKey
+                    $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeConferenceKey
                         + ' ' + errorMessage;
                     $scope.alertStatus = 'warning';
                     $log.error($scope.messages);
-                } else {
-                    // The request has succeeded.
-                    $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
+                    return;
                 }
-            });
-        });
-
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                    console.log('Failed to get a user profile.')
-                } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
-                            // The user is attending the conference.
-                            $scope.alertStatus = 'info';
-                            $scope.messages = 'You are attending this conference';
-                            $scope.isUserAttending = true;
+                angular.forEach(resp.items, function (item) {
+                    if (item.id == 'conference') {
+                        if (item.error) {
+                            // The request has failed.
+                            $scope.messages = 'Failed to get the conference : '
+                                + $routeParams.websafeConferenceKey + ' ' + item.error;
+                            $scope.alertStatus = 'warning';
+                            $log.error($scope.messages);
+                        } else {
+                            // The request has succeeded, possibly with the cached copy.
+                            $scope.alertStatus = 'success';
+                            $scope.conference = etagCache.resolve(
+                                'conference:' + $routeParams.websafeConferenceKey, item.conference);
+                        }
+                    } else if (item.id == 'profile') {
+                        if (item.error) {
+                            // Failed to get a user profile.
+                            console.log('Failed to get a user profile.')
+                            return;
+                        }
+                        // If the user is attending the conference, updates the status message and available function.
+                        var profile = etagCache.resolve('profile', item.profile);
+                        var conferenceKeysToAttend = profile.conferenceKeysToAttend || [];
+                        for (var i = 0; i < conferenceKeysToAttend.length; i++) {
+                            if ($routeParams.websafeConferenceKey == conferenceKeysToAttend[i]) {
+                                // The user is attending the conference.
+                                $scope.alertStatus = 'info';
+                                $scope.messages = 'You are attending this conference';
+                                $scope.isUserAttending = true;
+                            }
                         }
                     }
-                }
+                });
             });
         });
     };
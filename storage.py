@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+"""
+storage.py.
+
+Conference server-side Python App Engine storage of conferences, sessions
+and profiles, behind an interface with a datastore backend and a SQLite
+backend for load testing off App Engine
+
+"""
+
+import functools
+import itertools
+import os
+
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Profile
+from models import Session
+from models import WaitlistEntry
+
+import indexadvisor
+from settings import STORAGE_BACKEND
+
+# environment variable overriding the STORAGE_BACKEND setting
+STORAGE_ENV = 'CONFERENCE_STORAGE'
+
+_backend = None
+
+
+def _done(result):
+    """Return a future already holding result."""
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+class Storage(object):
+
+    """Storage -- store of Conference, Session and Profile entities.
+
+    Entities are ndb models and keys ndb keys on every backend; queries
+    return lists of entities. The *Async methods return ndb futures.
+    """
+
+    def get(self, key):
+        """Return the entity of a key, or None."""
+        raise NotImplementedError
+
+    def getMulti(self, keys):
+        """Return the entities of keys, None for the missing ones."""
+        raise NotImplementedError
+
+    def getAsync(self, key):
+        return _done(self.get(key))
+
+    def getMultiAsync(self, keys):
+        return _done(self.getMulti(keys))
+
+    def put(self, entity):
+        """Store an entity, return its key."""
+        raise NotImplementedError
+
+    def putMulti(self, entities):
+        """Store entities, return their keys."""
+        raise NotImplementedError
+
+    def putAsync(self, entity):
+        return _done(self.put(entity))
+
+    def delete(self, key):
+        """Delete the entity of a key."""
+        self.deleteMulti([key])
+
+    def deleteMulti(self, keys):
+        """Delete the entities of keys; missing ones are ignored."""
+        raise NotImplementedError
+
+    def allocateKey(self, model, parent=None):
+        """Return a new complete key of model under parent."""
+        raise NotImplementedError
+
+    def transaction(self, func, xg=False):
+        """
+        Run func in a transaction and return its result.
+
+        A transaction already in progress is joined.
+        """
+        raise NotImplementedError
+
+    def inTransaction(self):
+        raise NotImplementedError
+
+    def onCommit(self, func):
+        """
+        Call func once the current transaction commits, or now outside one.
+
+        For cache updates which must not run if the transaction fails.
+        """
+        raise NotImplementedError
+
+    def queryConferences(self, inequality_field, filters):
+        """
+        Return conferences matching (field, operator, value) filters.
+
+        Conferences are ordered by the inequality field, if any, then name.
+        """
+        raise NotImplementedError
+
+    def conferencesByOrganizer(self, user_id):
+        raise NotImplementedError
+
+    def iterConferences(self, startingFrom=None, undated=False):
+        """
+        Iterate over all conferences, or those starting from a date.
+
+        With a date, undated conferences follow if undated is True.
+        """
+        raise NotImplementedError
+
+    def nearlySoldOut(self, seats):
+        """Return names of conferences with 1 to seats seats available."""
+        raise NotImplementedError
+
+    def sessionsByConference(self, c_key, sessionType=None, speaker=None):
+        raise NotImplementedError
+
+    def sessionsByConferenceAsync(self, c_key):
+        return _done(self.sessionsByConference(c_key))
+
+    def sessionKeysByConference(self, c_key, limit=None):
+        """Return keys of up to limit sessions of a conference."""
+        raise NotImplementedError
+
+    def sessionsBySpeaker(self, speaker, sessionType=None):
+        raise NotImplementedError
+
+    def sessionsStartingAfter(self, startTime):
+        """Return sessions starting at or after startTime, or all."""
+        raise NotImplementedError
+
+    def profileByFeedToken(self, token):
+        """Return the Profile with a wishlist feed token, or None."""
+        raise NotImplementedError
+
+    def profileKeysAttending(self, wsck, limit, cursor=None):
+        """
+        Return a page of keys of the profiles registered for a conference.
+
+        Return (keys, cursor, more); cursor is an opaque string starting
+        the next page.
+        """
+        raise NotImplementedError
+
+    def profileKeysWishing(self, s_keys):
+        """Return keys of the profiles wishlisting any of 30 sessions."""
+        raise NotImplementedError
+
+    def waitlistKeys(self, c_key, limit=None):
+        """Return keys of a conference's waitlist, first come first."""
+        raise NotImplementedError
+
+    def cacheGet(self, key):
+        raise NotImplementedError
+
+    def cacheGetAsync(self, key):
+        return _done(self.cacheGet(key))
+
+    def cacheSet(self, key, value, time=0):
+        raise NotImplementedError
+
+    def cacheDelete(self, key):
+        raise NotImplementedError
+
+
+class NdbStorage(Storage):
+
+    """NdbStorage -- the datastore, cached in memcache."""
+
+    def get(self, key):
+        return key.get()
+
+    def getMulti(self, keys):
+        return ndb.get_multi(keys)
+
+    def getAsync(self, key):
+        return key.get_async()
+
+    def getMultiAsync(self, keys):
+        return ndb.get_multi_async(keys)
+
+    def put(self, entity):
+        return entity.put()
+
+    def putMulti(self, entities):
+        return ndb.put_multi(entities)
+
+    def putAsync(self, entity):
+        return entity.put_async()
+
+    def deleteMulti(self, keys):
+        ndb.delete_multi(keys)
+
+    def allocateKey(self, model, parent=None):
+        return ndb.Key(model, model.allocate_ids(size=1, parent=parent)[0],
+                       parent=parent)
+
+    def transaction(self, func, xg=False):
+        return ndb.transaction(
+            func, xg=xg, propagation=ndb.TransactionOptions.ALLOWED)
+
+    def inTransaction(self):
+        return ndb.in_transaction()
+
+    def onCommit(self, func):
+        if ndb.in_transaction():
+            ndb.get_context().call_on_commit(func)
+        else:
+            func()
+
+    def queryConferences(self, inequality_field, filters):
+        indexadvisor.record(
+            'Conference',
+            equalities=[field for field, operator, value in filters
+                        if operator == '='],
+            inequality=inequality_field,
+            orders=[inequality_field, 'name'] if inequality_field
+            else ['name'])
+        q = Conference.query()
+        # If exists, sort on inequality filter first
+        if inequality_field:
+            q = q.order(ndb.GenericProperty(inequality_field))
+        q = q.order(Conference.name)
+        for field, operator, value in filters:
+            q = q.filter(ndb.query.FilterNode(field, operator, value))
+        return q.fetch()
+
+    def conferencesByOrganizer(self, user_id):
+        indexadvisor.record('Conference', ancestor=True)
+        return Conference.query(
+            ancestor=ndb.Key(Profile, user_id)).fetch()
+
+    def iterConferences(self, startingFrom=None, undated=False):
+        q = Conference.query()
+        if startingFrom:
+            indexadvisor.record('Conference', inequality='startDate')
+            q = q.filter(Conference.startDate >= startingFrom)
+            if undated:
+                # an inequality never matches a missing value
+                indexadvisor.record('Conference', equalities=['startDate'])
+                none = Conference.query(
+                    Conference.startDate == None)  # noqa: E711
+                return itertools.chain(q.iter(batch_size=500),
+                                       none.iter(batch_size=500))
+        return q.iter(batch_size=500)
+
+    def nearlySoldOut(self, seats):
+        indexadvisor.record('Conference', inequality='seatsAvailable',
+                            projection=['name'])
+        return [conf.name for conf in Conference.query(ndb.AND(
+            Conference.seatsAvailable <= seats,
+            Conference.seatsAvailable > 0)
+        ).fetch(projection=[Conference.name])]
+
+    def _sessionQuery(self, c_key, sessionType, speaker):
+        indexadvisor.record(
+            'Session', ancestor=bool(c_key),
+            equalities=[name for name, value in (('speaker', speaker),
+                                                 ('sessionType', sessionType))
+                        if value is not None])
+        q = Session.query(ancestor=c_key) if c_key else Session.query()
+        if speaker is not None:
+            q = q.filter(Session.speaker == speaker)
+        if sessionType is not None:
+            q = q.filter(Session.sessionType == sessionType)
+        return q
+
+    def sessionsByConference(self, c_key, sessionType=None, speaker=None):
+        return self._sessionQuery(c_key, sessionType, speaker).fetch()
+
+    def sessionsByConferenceAsync(self, c_key):
+        indexadvisor.record('Session', ancestor=True)
+        return Session.query(ancestor=c_key).fetch_async()
+
+    def sessionKeysByConference(self, c_key, limit=None):
+        indexadvisor.record('Session', ancestor=True)
+        return Session.query(ancestor=c_key).fetch(limit, keys_only=True)
+
+    def sessionsBySpeaker(self, speaker, sessionType=None):
+        return self._sessionQuery(None, sessionType, speaker).fetch()
+
+    def sessionsStartingAfter(self, startTime):
+        indexadvisor.record('Session',
+                            inequality='startTime' if startTime else None)
+        q = Session.query()
+        if startTime:
+            q = q.filter(Session.startTime >= startTime)
+        return q.fetch()
+
+    def profileByFeedToken(self, token):
+        indexadvisor.record('Profile', equalities=['feedToken'])
+        return Profile.query(Profile.feedToken == token).get()
+
+    def profileKeysAttending(self, wsck, limit, cursor=None):
+        indexadvisor.record('Profile', equalities=['conferenceKeysToAttend'])
+        keys, cursor, more = Profile.query(
+            Profile.conferenceKeysToAttend == wsck).fetch_page(
+            limit, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        return keys, cursor and cursor.urlsafe(), more
+
+    def profileKeysWishing(self, s_keys):
+        # an IN query runs one query per value, at most 30
+        indexadvisor.record('Profile', equalities=['wishListKeys'])
+        return Profile.query(Profile.wishList.IN(s_keys)).fetch(
+            keys_only=True)
+
+    def waitlistKeys(self, c_key, limit=None):
+        indexadvisor.record('WaitlistEntry', ancestor=True, orders=['joined'])
+        return WaitlistEntry.query(ancestor=c_key).order(
+            WaitlistEntry.joined).fetch(limit, keys_only=True)
+
+    def cacheGet(self, key):
+        return memcache.get(key)
+
+    def cacheGetAsync(self, key):
+        return ndb.get_context().memcache_get(key)
+
+    def cacheSet(self, key, value, time=0):
+        return memcache.set(key, value, time=time)
+
+    def cacheDelete(self, key):
+        return memcache.delete(key)
+
+
+def create(spec):
+    """Return the backend named by spec: 'ndb' or 'sqlite:PATH'."""
+    name, _, path = spec.partition(':')
+    if name == 'ndb':
+        return NdbStorage()
+    if name == 'sqlite':
+        # only used off App Engine, where sqlite3 is available
+        import sqlitestorage
+        return sqlitestorage.SqliteStorage(path or 'conference.sqlite3')
+    raise ValueError('Unknown storage backend: %s' % spec)
+
+
+def backend():
+    """Return the configured backend."""
+    global _backend
+    if _backend is None:
+        _backend = create(os.environ.get(STORAGE_ENV, STORAGE_BACKEND))
+    return _backend
+
+
+def setBackend(storage):
+    """Replace the configured backend, for tools and benchmarks."""
+    global _backend
+    _backend = storage
+
+
+def transactional(xg=False):
+    """Decorator running a function in a transaction of the backend."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return backend().transaction(lambda: func(*args, **kwargs),
+                                         xg=xg)
+        return wrapper
+    return decorator
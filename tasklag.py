@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+tasklag.py.
+
+Conference server-side Python App Engine task queue lag tracking: tasks
+carry their enqueue time and a trace id, and their queue wait, handler
+time and retries are counted in memcache histograms per task type
+
+"""
+
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+
+from google.appengine.api import memcache
+
+from settings import DEFAULT_TASK_LAG_BUDGET
+from settings import TASK_LAG_BUDGETS
+
+ENQUEUED_PARAM = '_enqueued'
+TRACE_PARAM = '_trace'
+
+MEMCACHE_LAG_KEY = "TASKLAG:%s:%s:%d:%d"
+WINDOW = 5 * 60
+# upper bounds, in seconds, of the histogram buckets; the last is open
+BUCKET_BOUNDS = [0.01 * 2 ** i for i in range(21)]
+MAX_RETRIES = 5
+
+METRICS = ('wait', 'handler', 'lag')
+PERCENTILES = (0.5, 0.95, 0.99)
+ALERT_PERCENTILE = 0.95
+
+# trace id of the task this thread runs
+_local = threading.local()
+
+
+def traceId():
+    """Return the trace id of the current task or request, or a new one."""
+    trace = getattr(_local, 'trace', None)
+    if not trace:
+        header = os.environ.get('HTTP_X_CLOUD_TRACE_CONTEXT')
+        trace = header.split('/')[0] if header else uuid.uuid4().hex
+    return trace
+
+
+def params(values=None):
+    """Return task params or payload fields with the enqueue time and trace."""
+    values = dict(values or {})
+    values[ENQUEUED_PARAM] = repr(time.time())
+    values[TRACE_PARAM] = traceId()
+    return values
+
+
+def budget(task_type):
+    return TASK_LAG_BUDGETS.get(task_type, DEFAULT_TASK_LAG_BUDGET)
+
+
+def _bucket(seconds):
+    return min(bisect.bisect_left(BUCKET_BOUNDS, seconds),
+               len(BUCKET_BOUNDS) - 1)
+
+
+def recordMulti(samples):
+    """
+    Count (task type, enqueued, started, finished, retries, ok) samples.
+
+    Queue wait runs from enqueued, None if unknown, to started, and lag
+    from enqueued to the finish of a successful run.
+    """
+    offsets = {}
+
+    def count(task_type, metric, window, bucket):
+        key = MEMCACHE_LAG_KEY % (task_type, metric, window, bucket)
+        offsets[key] = offsets.get(key, 0) + 1
+
+    for task_type, enqueued, started, finished, retries, ok in samples:
+        window = int(finished) // WINDOW
+        count(task_type, 'handler', window, _bucket(finished - started))
+        count(task_type, 'retries', window, min(retries, MAX_RETRIES))
+        if enqueued is None:
+            continue
+        count(task_type, 'wait', window, _bucket(started - enqueued))
+        if ok:
+            count(task_type, 'lag', window, _bucket(finished - enqueued))
+            if finished - enqueued > budget(task_type):
+                logging.warning('%s task finished %.1f s after its enqueue, '
+                                'over its %d s budget', task_type,
+                                finished - enqueued, budget(task_type))
+    # counters of past windows are left to memcache's eviction
+    memcache.offset_multi(offsets, initial_value=0)
+
+
+def record(task_type, enqueued, started, finished, retries=0, ok=True):
+    """Count one run of a task."""
+    recordMulti([(task_type, enqueued, started, finished, retries, ok)])
+
+
+def enqueuedAt(values):
+    """Return the enqueue time carried by task params, or None."""
+    enqueued = values.get(ENQUEUED_PARAM)
+    return float(enqueued) if enqueued else None
+
+
+def tracked(task_type):
+    """
+    Count the runs of a push task handler method.
+
+    The task's trace id is kept for the tasks it enqueues in turn.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(handler, *args, **kwargs):
+            request = handler.request
+            started = time.time()
+            _local.trace = request.get(TRACE_PARAM)
+            ok = False
+            try:
+                result = func(handler, *args, **kwargs)
+                ok = True
+                return result
+            finally:
+                _local.trace = None
+                record(task_type, enqueuedAt(request.params), started,
+                       time.time(),
+                       int(request.headers.get('X-AppEngine-TaskRetryCount',
+                                               0)), ok)
+        return wrapper
+    return decorator
+
+
+def _percentile(histogram, p):
+    """Return the upper bound of the bucket holding percentile p."""
+    total = sum(histogram)
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if count and seen >= p * total:
+            return BUCKET_BOUNDS[bucket]
+    return None
+
+
+def stats(task_types=None, windows=12):
+    """
+    Return {task type: stats} over the last windows of WINDOW seconds.
+
+    Stats hold the number of runs, the percentiles of each metric, the
+    runs which were retries, and whether the lag is over budget.
+    """
+    task_types = sorted(task_types or TASK_LAG_BUDGETS)
+    last = int(time.time()) // WINDOW
+    buckets = {'retries': range(MAX_RETRIES + 1)}
+    keys = [MEMCACHE_LAG_KEY % (task_type, metric, window, bucket)
+            for task_type in task_types
+            for metric in METRICS + ('retries',)
+            for window in range(last - windows + 1, last + 1)
+            for bucket in buckets.get(metric, range(len(BUCKET_BOUNDS)))]
+    counts = memcache.get_multi(keys)
+
+    result = {}
+    for task_type in task_types:
+        histograms = {}
+        for metric in METRICS + ('retries',):
+            histograms[metric] = [
+                sum(counts.get(MEMCACHE_LAG_KEY % (task_type, metric,
+                                                   window, bucket), 0)
+                    for window in range(last - windows + 1, last + 1))
+                for bucket in buckets.get(metric,
+                                          range(len(BUCKET_BOUNDS)))]
+        lag = _percentile(histograms['lag'], ALERT_PERCENTILE)
+        result[task_type] = {
+            'runs': sum(histograms['handler']),
+            'retried': sum(histograms['retries'][1:]),
+            'percentiles': {
+                metric: [_percentile(histograms[metric], p)
+                         for p in PERCENTILES]
+                for metric in METRICS},
+            'budget': budget(task_type),
+            'alert': lag is not None and lag > budget(task_type),
+        }
+    return result
+
+
+def check():
+    """Log an error for each task type over its lag budget lately."""
+    # the current window may have just started
+    for task_type, info in sorted(stats(windows=2).items()):
+        if info['alert']:
+            logging.error('%s tasks: over %d%% of runs finished more than '
+                          'their %d s lag budget after enqueue', task_type,
+                          100 - ALERT_PERCENTILE * 100, info['budget'])
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+test_catalog.py.
+
+Unit tests of the in-process conference filtering of catalog.py
+
+"""
+
+import unittest
+from datetime import date
+from datetime import timedelta
+
+import testutil
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceQueryForm
+from models import ConferenceQueryForms
+from models import Profile
+import catalog
+import conference as api
+
+
+def conference(name, city=None, topics=(), maxAttendees=None, start=30,
+               end=None, deleted=False):
+    """Return an unsaved Conference starting start days from today."""
+    startDate = date.today() + timedelta(days=start)
+    return Conference(
+        key=ndb.Key(Conference, name, parent=ndb.Key(Profile, 'alice')),
+        name=name, city=city, topics=list(topics),
+        maxAttendees=maxAttendees, startDate=startDate,
+        month=startDate.month,
+        endDate=None if end is None else date.today() + timedelta(days=end),
+        deleted=deleted)
+
+
+class CatalogQueryTest(testutil.AppEngineTestCase):
+
+    """CatalogQueryTest -- filters evaluated over the catalog columns."""
+
+    def setUp(self):
+        super(CatalogQueryTest, self).setUp()
+        self.conferences = [
+            conference('PyCon', 'Tokyo', ['Web', 'Programming Languages'],
+                       100),
+            conference('DjangoCon', 'Paris', ['Web'], 50),
+            conference('FilmFest', 'Paris', ['Movie Making'], 500),
+            conference('NoCity', None, [], None),
+        ]
+
+    def _catalog(self, conferences=None):
+        return catalog.Catalog().update(1, 1, {
+            conf.key.urlsafe(): conf
+            for conf in conferences or self.conferences})
+
+    def _query(self, inequality_field, filters, snapshot=None):
+        snapshot = snapshot or self._catalog()
+        return [ndb.Key(urlsafe=wsck).id()
+                for wsck in snapshot.query(inequality_field, filters)]
+
+    def testNoFiltersByName(self):
+        self.assertEqual(self._query(None, []),
+                         ['DjangoCon', 'FilmFest', 'NoCity', 'PyCon'])
+
+    def testEquality(self):
+        self.assertEqual(self._query(None, [('city', '=', 'Paris')]),
+                         ['DjangoCon', 'FilmFest'])
+
+    def testRepeatedMatchesAnyValue(self):
+        self.assertEqual(self._query(None, [('topics', '=', 'Web')]),
+                         ['DjangoCon', 'PyCon'])
+
+    def testInequalityOrdersResults(self):
+        self.assertEqual(
+            self._query('maxAttendees', [('maxAttendees', '>', 60)]),
+            ['PyCon', 'FilmFest'])
+
+    def testInequalitiesOnSeveralFields(self):
+        self.assertEqual(
+            self._query('maxAttendees', [('maxAttendees', '<', 200),
+                                         ('city', '!=', 'Tokyo')]),
+            ['DjangoCon'])
+
+    def testMissingValueMatchesNothing(self):
+        self.assertEqual(self._query(None, [('city', '!=', 'Paris')]),
+                         ['PyCon'])
+        self.assertEqual(
+            self._query('maxAttendees', [('maxAttendees', '>=', 0)]),
+            ['DjangoCon', 'PyCon', 'FilmFest'])
+
+    def testUnknownValue(self):
+        self.assertEqual(self._query(None, [('city', '=', 'Chicago')]), [])
+
+    def testEndedAndDeletedLeftOut(self):
+        self.assertEqual(self._query(None, [], self._catalog([
+            conference('Ended', start=-10, end=-5),
+            conference('Ending', start=-10, end=0),
+            conference('Deleted', deleted=True),
+            conference('Upcoming')])), ['Ending', 'Upcoming'])
+
+    def testUpdateReplacesAndPurgesRows(self):
+        old = self._catalog()
+        pycon, djangocon = self.conferences[:2]
+        pycon.city = 'Paris'
+        new = old.update(1, 2, {pycon.key.urlsafe(): pycon,
+                                djangocon.key.urlsafe(): None})
+        self.assertEqual(self._query(None, [('city', '=', 'Paris')], new),
+                         ['FilmFest', 'PyCon'])
+        # the old snapshot is left as it was
+        self.assertEqual(self._query(None, [('city', '=', 'Paris')], old),
+                         ['DjangoCon', 'FilmFest'])
+
+
+class MatchesTest(testutil.AppEngineTestCase):
+
+    """MatchesTest -- filters checked on a single conference."""
+
+    def testFilters(self):
+        conf = conference('PyCon', 'Tokyo', ['Web', 'Programming Languages'],
+                          100)
+        self.assertTrue(catalog.matches(conf, [('topics', '=', 'Web'),
+                                               ('maxAttendees', '>=', 100)]))
+        self.assertFalse(catalog.matches(conf, [('city', '=', 'Paris')]))
+        self.assertFalse(catalog.matches(conf, [('maxAttendees', '>', 100)]))
+
+    def testMissingValue(self):
+        conf = conference('NoCity')
+        self.assertFalse(catalog.matches(conf, [('city', '!=', 'Paris')]))
+
+    def testEnded(self):
+        conf = conference('Ended', start=-10, end=-5)
+        self.assertFalse(catalog.matches(conf, []))
+        self.assertTrue(catalog.matches(conf, [], upcoming=False))
+
+    def testDeleted(self):
+        conf = conference('Deleted', deleted=True)
+        self.assertFalse(catalog.matches(conf, [], upcoming=False))
+
+
+class CatalogBuildTest(testutil.AppEngineTestCase):
+
+    """CatalogBuildTest -- the snapshot built from the datastore."""
+
+    def setUp(self):
+        super(CatalogBuildTest, self).setUp()
+        catalog._snapshot.update(checked=0, data=None)
+
+    def testUpcomingAndUndated(self):
+        for conf in [conference('Upcoming'),
+                     conference('Running', start=-3, end=2),
+                     conference('Ended', start=-10, end=-5),
+                     conference('Old', start=-catalog.LOOKBACK_DAYS - 1,
+                                end=10)]:
+            conf.put()
+        Conference(key=ndb.Key(Conference, 'Undated',
+                               parent=ndb.Key(Profile, 'alice')),
+                   name='Undated').put()
+        self.assertEqual(
+            [ndb.Key(urlsafe=wsck).id()
+             for wsck in catalog._current().query(None, [])],
+            ['Running', 'Undated', 'Upcoming'])
+
+
+class QueryFallbackTest(testutil.AppEngineTestCase):
+
+    """QueryFallbackTest -- upcoming queries without the catalog."""
+
+    def setUp(self):
+        super(QueryFallbackTest, self).setUp()
+        catalog._snapshot.update(checked=0, data=None)
+        # another request of this instance is rebuilding the catalog
+        catalog._lock.acquire()
+        for conf in [conference('PyCon', 'Tokyo', maxAttendees=100),
+                     conference('DjangoCon', 'Paris', maxAttendees=50),
+                     conference('FilmFest', 'Paris', maxAttendees=500),
+                     conference('Ended', 'Paris', maxAttendees=50,
+                                start=-10, end=-5)]:
+            conf.put()
+
+    def tearDown(self):
+        catalog._lock.release()
+        super(QueryFallbackTest, self).tearDown()
+
+    def _query(self, filters, upcomingOnly=True):
+        request = ConferenceQueryForms(upcomingOnly=upcomingOnly, filters=[
+            ConferenceQueryForm(field=field, operator=operator, value=value)
+            for field, operator, value in filters])
+        return sorted(conf.name
+                      for conf in api.ConferenceApi()._getQuery(request))
+
+    def testInequalitiesOnSeveralFields(self):
+        self.assertIsNone(catalog.query(None, []))
+        self.assertEqual(self._query([('MAX_ATTENDEES', 'LT', '200'),
+                                      ('CITY', 'NE', 'Tokyo')]),
+                         ['DjangoCon'])
+
+    def testSeveralFieldsRejectedWithoutUpcomingOnly(self):
+        with self.assertRaises(api.endpoints.BadRequestException):
+            self._query([('MAX_ATTENDEES', 'LT', '200'),
+                         ('CITY', 'NE', 'Tokyo')], upcomingOnly=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+test_indexadvisor.py.
+
+Unit tests of the composite index suggestions of indexadvisor.py
+
+"""
+
+import unittest
+
+import testutil
+
+from models import Conference
+import indexadvisor
+
+ASC = indexadvisor.ASC
+DESC = indexadvisor.DESC
+
+
+def shape(kind='Conference', ancestor=False, equalities=(), inequality=None,
+          orders=(), projection=()):
+    """Return a parsed query shape."""
+    return (kind, ancestor, tuple(sorted(set(equalities))), inequality,
+            tuple(indexadvisor._order(order) for order in orders),
+            tuple(projection))
+
+
+def index(*props, **kwargs):
+    """Return a composite index on Conference properties."""
+    return (kwargs.get('kind', 'Conference'), kwargs.get('ancestor', False),
+            tuple(prop if isinstance(prop, tuple) else (prop, ASC)
+                  for prop in props))
+
+
+class RequiredIndexTest(unittest.TestCase):
+
+    """RequiredIndexTest -- the composite index one query shape needs."""
+
+    def testEqualitiesUseBuiltInIndexes(self):
+        self.assertIsNone(indexadvisor.requiredIndex(
+            shape(equalities=['city', 'topics'])))
+
+    def testSinglePropertyUsesBuiltInIndex(self):
+        self.assertIsNone(indexadvisor.requiredIndex(
+            shape(inequality='maxAttendees', orders=['maxAttendees'])))
+        self.assertIsNone(indexadvisor.requiredIndex(
+            shape(orders=['-name'])))
+
+    def testEqualitiesBeforeInequality(self):
+        self.assertEqual(
+            indexadvisor.requiredIndex(shape(equalities=['topics', 'city'],
+                                             inequality='maxAttendees')),
+            index('city', 'topics', 'maxAttendees'))
+
+    def testInequalitySortedFirst(self):
+        self.assertEqual(
+            indexadvisor.requiredIndex(shape(inequality='month',
+                                             orders=['name'])),
+            index('month', 'name'))
+
+    def testDescendingOrder(self):
+        self.assertEqual(
+            indexadvisor.requiredIndex(shape(equalities=['city'],
+                                             orders=['-name'])),
+            index('city', ('name', DESC)))
+
+    def testAncestorOrder(self):
+        self.assertEqual(
+            indexadvisor.requiredIndex(shape(kind='WaitlistEntry',
+                                             ancestor=True,
+                                             orders=['joined'])),
+            index('joined', kind='WaitlistEntry', ancestor=True))
+
+    def testProjectionAfterOrders(self):
+        self.assertEqual(
+            indexadvisor.requiredIndex(shape(
+                inequality='startDate',
+                projection=['maxAttendees', 'seatsAvailable'])),
+            index('startDate', 'maxAttendees', 'seatsAvailable'))
+
+
+class ServesTest(unittest.TestCase):
+
+    """ServesTest -- whether a set of indexes serves a shape."""
+
+    def testMergedIndexes(self):
+        query = shape(equalities=['city', 'topics'], orders=['name'])
+        self.assertTrue(indexadvisor.serves(
+            [index('city', 'name'), index('topics', 'name')], query))
+        self.assertFalse(indexadvisor.serves([index('city', 'name')], query))
+
+    def testExactIndex(self):
+        query = shape(equalities=['city', 'topics'], orders=['name'])
+        self.assertTrue(indexadvisor.serves(
+            [index('topics', 'city', 'name')], query))
+
+    def testSortOrderMustMatch(self):
+        query = shape(equalities=['city'], orders=['-name'])
+        self.assertFalse(indexadvisor.serves([index('city', 'name')], query))
+
+    def testBuiltIn(self):
+        self.assertTrue(indexadvisor.serves([], shape(equalities=['city'])))
+
+
+class ProposeIndexesTest(testutil.AppEngineTestCase):
+
+    """ProposeIndexesTest -- the smallest index set serving shapes."""
+
+    def testSharedOrdersMerged(self):
+        shapes = [shape(equalities=['city'], orders=['name']),
+                  shape(equalities=['city', 'month'], orders=['name']),
+                  shape(equalities=['month'], orders=['name'])]
+        proposed = indexadvisor.proposeIndexes(shapes, {})
+        self.assertEqual(proposed, [index('city', 'name'),
+                                    index('month', 'name')])
+        for query in shapes:
+            self.assertTrue(indexadvisor.serves(proposed, query))
+
+    def testExactWhenCheaper(self):
+        # conferences without topics keep no entries in an index holding
+        # topics, so the indexes on topics and other filters cost nothing
+        samples = {'Conference': [Conference(name='c%d' % i, city='Tokyo',
+                                             month=1) for i in range(3)]}
+        shapes = [shape(equalities=['topics'], orders=['name']),
+                  shape(equalities=['city', 'topics'], orders=['name']),
+                  shape(equalities=['month', 'topics'], orders=['name']),
+                  shape(equalities=['city', 'month', 'topics'],
+                        orders=['name'])]
+        proposed = indexadvisor.proposeIndexes(shapes, samples)
+        self.assertEqual(proposed, [
+            index('city', 'month', 'topics', 'name'),
+            index('city', 'topics', 'name'),
+            index('month', 'topics', 'name'),
+            index('topics', 'name')])
+        for query in shapes:
+            self.assertTrue(indexadvisor.serves(proposed, query))
+
+    def testBuiltInIndexesDropped(self):
+        self.assertEqual(indexadvisor.proposeIndexes(
+            [shape(orders=['name']), shape(equalities=['city'])], {}), [])
+
+    def testIndexWritesCountRepeatedValues(self):
+        conf = Conference(name='PyCon', topics=['Web', 'Movie Making'])
+        self.assertEqual(
+            indexadvisor.indexWrites([index('topics', 'name')], [conf]) -
+            indexadvisor.indexWrites([], [conf]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+test_mailer.py.
+
+Unit tests of the batched, deduplicated sending of mailer.py
+
+"""
+
+import unittest
+
+import testutil
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.runtime.apiproxy_errors import OverQuotaError
+
+from models import Conference
+from models import Profile
+import mailer
+
+
+class FailingMailTransport(mailer.RecordingMailTransport):
+
+    """FailingMailTransport -- runs out of quota after some deliveries."""
+
+    def __init__(self, quota):
+        super(FailingMailTransport, self).__init__()
+        self.quota = quota
+
+    def send(self, sender, to, subject, body):
+        if len(self.deliveries) == self.quota:
+            raise OverQuotaError()
+        super(FailingMailTransport, self).send(sender, to, subject, body)
+
+
+class ProcessBatchTest(testutil.AppEngineTestCase):
+
+    """ProcessBatchTest -- deduplication and rendering of a batch."""
+
+    def setUp(self):
+        super(ProcessBatchTest, self).setUp()
+        self.transport = mailer.transport = mailer.RecordingMailTransport()
+        self.wsck = self._conference('PyCon')
+
+    def tearDown(self):
+        mailer.transport = mailer.AppEngineMailTransport()
+        super(ProcessBatchTest, self).tearDown()
+
+    def _conference(self, name, deleted=False):
+        c_key = ndb.Key(Conference, name, parent=ndb.Key(Profile, 'alice'))
+        Conference(key=c_key, name=name, city='Tokyo',
+                   deleted=deleted).put()
+        return c_key.urlsafe()
+
+    def _queued(self):
+        return len(self.testbed.get_stub(
+            testutil.testbed.TASKQUEUE_SERVICE_NAME).GetTasks(
+            mailer.MAIL_QUEUE))
+
+    def _sent(self):
+        return sorted((to, subject) for sender, to, subject, body
+                      in self.transport.deliveries)
+
+    def testDuplicatesSentOnce(self):
+        mailer.enqueue('registered', ['a@example.com', 'b@example.com'],
+                       self.wsck)
+        mailer.enqueue('registered', 'a@example.com', self.wsck)
+        self.assertEqual(mailer.processBatch(), 2)
+        self.assertEqual(self._sent(), [
+            ('a@example.com', 'You are registered for PyCon'),
+            ('b@example.com', 'You are registered for PyCon')])
+        self.assertEqual(self._queued(), 0)
+
+    def testTemplatesAndConferencesKeptApart(self):
+        other = self._conference('DjangoCon')
+        mailer.enqueue('registered', 'a@example.com', self.wsck)
+        mailer.enqueue('registered', 'a@example.com', other)
+        mailer.enqueue('waitlistPromoted', 'a@example.com', self.wsck)
+        mailer.processBatch()
+        self.assertEqual(self._sent(), [
+            ('a@example.com', 'A seat opened up for PyCon'),
+            ('a@example.com', 'You are registered for DjangoCon'),
+            ('a@example.com', 'You are registered for PyCon')])
+
+    def testDeletedConferenceSendsNothing(self):
+        mailer.enqueue('registered', 'a@example.com',
+                       self._conference('Gone', deleted=True))
+        self.assertEqual(mailer.processBatch(), 1)
+        self.assertEqual(self._sent(), [])
+        self.assertEqual(self._queued(), 0)
+
+    def testDetailsWithoutConference(self):
+        mailer.enqueueDetails('conferenceCreated', 'a@example.com',
+                              'ConferenceForm(name=PyCon)')
+        mailer.processBatch()
+        sender, to, subject, body = self.transport.deliveries[0]
+        self.assertEqual(subject, 'You created a new Conference!')
+        self.assertTrue(body.endswith('ConferenceForm(name=PyCon)'))
+
+    def testQuotaErrorKeepsUnsentTasks(self):
+        self.transport = mailer.transport = FailingMailTransport(1)
+        mailer.enqueue('registered', 'a@example.com', self.wsck)
+        mailer.enqueue('registered', ['a@example.com', 'b@example.com'],
+                       self.wsck)
+        mailer.processBatch()
+        self.assertEqual(self._sent(), [
+            ('a@example.com', 'You are registered for PyCon')])
+        self.assertTrue(mailer.backingOff())
+        # the first task was sent whole; the second is queued again for b
+        self.assertEqual(self._queued(), 1)
+
+    def testPartlySentTaskNotSentTwice(self):
+        self.transport = mailer.transport = FailingMailTransport(1)
+        mailer.enqueue('registered', ['a@example.com', 'b@example.com'],
+                       self.wsck)
+        mailer.processBatch()
+        sent = self._sent()
+        self.transport = mailer.transport = mailer.RecordingMailTransport()
+        memcache.delete(mailer.MEMCACHE_BACKOFF_KEY)
+        self.assertEqual(mailer.processBatch(), 1)
+        self.assertEqual(sent + self._sent(), [
+            ('a@example.com', 'You are registered for PyCon'),
+            ('b@example.com', 'You are registered for PyCon')])
+        self.assertEqual(self._queued(), 0)
+
+    def testEmptyQueue(self):
+        self.assertEqual(mailer.processBatch(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+test_ratelimit.py.
+
+Unit tests of the per-user token buckets and the collision-based
+shedding of ratelimit.py
+
+"""
+
+import unittest
+
+import testutil
+
+from google.appengine.api import memcache
+
+import ratelimit
+
+
+class TakeTokenTest(testutil.AppEngineTestCase):
+
+    """TakeTokenTest -- token bucket refill and burst."""
+
+    def setUp(self):
+        super(TakeTokenTest, self).setUp()
+        self.clock = testutil.Clock()
+        self.time, ratelimit.time = ratelimit.time, self.clock
+        # one token a second, bursts of three
+        ratelimit.RATE_LIMITS['test'] = (1.0, 3)
+
+    def tearDown(self):
+        del ratelimit.RATE_LIMITS['test']
+        ratelimit.time = self.time
+        super(TakeTokenTest, self).tearDown()
+
+    def testBurstThenWait(self):
+        for i in range(3):
+            self.assertEqual(ratelimit._takeToken('alice', 'test'), 0)
+        self.assertAlmostEqual(ratelimit._takeToken('alice', 'test'), 1.0)
+
+    def testRefill(self):
+        for i in range(3):
+            ratelimit._takeToken('alice', 'test')
+        self.clock.sleep(0.5)
+        self.assertAlmostEqual(ratelimit._takeToken('alice', 'test'), 0.5)
+        self.clock.sleep(0.5)
+        self.assertEqual(ratelimit._takeToken('alice', 'test'), 0)
+        self.assertAlmostEqual(ratelimit._takeToken('alice', 'test'), 1.0)
+
+    def testRefillCappedAtBurst(self):
+        ratelimit._takeToken('alice', 'test')
+        self.clock.sleep(100)
+        for i in range(3):
+            self.assertEqual(ratelimit._takeToken('alice', 'test'), 0)
+        self.assertTrue(ratelimit._takeToken('alice', 'test') > 0)
+
+    def testBucketsPerUser(self):
+        for i in range(3):
+            ratelimit._takeToken('alice', 'test')
+        self.assertTrue(ratelimit._takeToken('alice', 'test') > 0)
+        self.assertEqual(ratelimit._takeToken('bob', 'test'), 0)
+
+
+class ShouldShedTest(testutil.AppEngineTestCase):
+
+    """ShouldShedTest -- shedding on the collision rate of a window."""
+
+    def setUp(self):
+        super(ShouldShedTest, self).setUp()
+        self.clock = testutil.Clock()
+        self.time, ratelimit.time = ratelimit.time, self.clock
+
+    def tearDown(self):
+        ratelimit.time = self.time
+        super(ShouldShedTest, self).tearDown()
+
+    def _record(self, writes, collisions):
+        for i in range(writes):
+            ratelimit._count(ratelimit.MEMCACHE_WRITES_KEY)
+        for i in range(collisions):
+            ratelimit._count(ratelimit.MEMCACHE_COLLISIONS_KEY)
+
+    def testCountStartsAtOne(self):
+        ratelimit._count(ratelimit.MEMCACHE_WRITES_KEY)
+        self.assertEqual(memcache.get(
+            ratelimit.MEMCACHE_WRITES_KEY % ratelimit._window()), 1)
+
+    def testTooFewSamples(self):
+        self._record(ratelimit.COLLISION_MIN_SAMPLES - 1,
+                     ratelimit.COLLISION_MIN_SAMPLES - 1)
+        self.assertFalse(ratelimit._shouldShed())
+
+    def testBelowThreshold(self):
+        writes = ratelimit.COLLISION_MIN_SAMPLES
+        self._record(writes,
+                     int(writes * ratelimit.COLLISION_RATE_THRESHOLD))
+        self.assertFalse(ratelimit._shouldShed())
+
+    def testAllCollisionsShed(self):
+        self._record(ratelimit.COLLISION_MIN_SAMPLES,
+                     ratelimit.COLLISION_MIN_SAMPLES)
+        self.assertTrue(ratelimit._shouldShed())
+
+    def testNewWindowStartsOver(self):
+        self._record(ratelimit.COLLISION_MIN_SAMPLES,
+                     ratelimit.COLLISION_MIN_SAMPLES)
+        self.clock.sleep(ratelimit.COLLISION_WINDOW)
+        self.assertFalse(ratelimit._shouldShed())
+
+
+if __name__ == '__main__':
+    unittest.main()
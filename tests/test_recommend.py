@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+test_recommend.py.
+
+Unit tests of the similarity scoring of recommend.py, against a
+snapshot built from the stubbed datastore
+
+"""
+
+import unittest
+from datetime import date
+from datetime import timedelta
+
+import testutil
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Profile
+import recommend
+
+
+class ScoreTest(testutil.AppEngineTestCase):
+
+    """ScoreTest -- ranking conferences against seed conferences."""
+
+    def setUp(self):
+        super(ScoreTest, self).setUp()
+        recommend._snapshot = {'version': None, 'checked': 0, 'data': None}
+        self.start = date.today() + timedelta(days=30)
+
+    def _conference(self, name, topics, city, organizer='alice'):
+        conf = Conference(
+            key=ndb.Key(Conference, name, parent=ndb.Key(Profile, organizer)),
+            name=name, topics=topics, city=city, organizerUserId=organizer,
+            startDate=self.start)
+        conf.put()
+        return conf
+
+    def _score(self, seeds, limit=10):
+        recommend.build()
+        keys = recommend._score(recommend._load(), seeds, limit)
+        return [ndb.Key(urlsafe=wsck).id() for wsck in keys]
+
+    def testMostSimilarFirst(self):
+        seed = self._conference('seed', ['Web'], 'Tokyo')
+        self._conference('web-paris', ['Web'], 'Paris', 'bob')
+        self._conference('web-tokyo', ['Web'], 'Tokyo', 'bob')
+        self._conference('film', ['Movie Making'], 'London', 'bob')
+        self.assertEqual(self._score([seed]), ['web-tokyo', 'web-paris'])
+
+    def testSharedOrganizerCounts(self):
+        seed = self._conference('seed', ['Web'], 'Tokyo')
+        self._conference('same-organizer', ['Web'], 'Paris')
+        self._conference('other-organizer', ['Web'], 'Paris', 'bob')
+        self.assertEqual(self._score([seed]),
+                         ['same-organizer', 'other-organizer'])
+
+    def testSeedsExcluded(self):
+        seeds = [self._conference('seed1', ['Web'], 'Tokyo'),
+                 self._conference('seed2', ['Web'], 'Tokyo')]
+        self._conference('other', ['Web'], 'Tokyo', 'bob')
+        self.assertEqual(self._score(seeds), ['other'])
+
+    def testLimit(self):
+        seed = self._conference('seed', ['Web'], 'Tokyo')
+        for i in range(5):
+            self._conference('web%d' % i, ['Web'], 'Paris', 'bob')
+        self.assertEqual(len(self._score([seed], limit=3)), 3)
+
+    def testUnknownFeaturesScoreNothing(self):
+        self._conference('web', ['Web'], 'Tokyo')
+        seed = Conference(key=ndb.Key(Conference, 'unsaved'), name='unsaved',
+                          topics=['Medical Innovations'], city='Chicago',
+                          organizerUserId='carol')
+        self.assertEqual(self._score([seed]), [])
+
+    def testEndedConferencesLeftOut(self):
+        seed = self._conference('seed', ['Web'], 'Tokyo')
+        self.start = date.today() - timedelta(days=30)
+        self._conference('past', ['Web'], 'Tokyo', 'bob')
+        self.assertEqual(self._score([seed]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
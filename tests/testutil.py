@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+testutil.py.
+
+Shared set-up of the unit tests: puts the App Engine SDK named by the
+APPENGINE_SDK environment variable on sys.path, and runs each test
+against fresh SDK service stubs
+
+usage: APPENGINE_SDK=~/google_appengine python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import unittest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.expanduser(os.environ['APPENGINE_SDK']))
+import dev_appserver  # noqa: E402
+dev_appserver.fix_sys_path()
+sys.path.insert(0, APP_DIR)
+
+from google.appengine.ext import ndb  # noqa: E402
+from google.appengine.ext import testbed  # noqa: E402
+
+
+class Clock(object):
+
+    """Clock -- stand-in for the time module, advanced by hand."""
+
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class AppEngineTestCase(unittest.TestCase):
+
+    """AppEngineTestCase -- test case run against the SDK service stubs."""
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        # queue.yaml defines the pull queues
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        self.testbed.init_user_stub()
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
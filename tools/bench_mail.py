@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+bench_mail.py.
+
+Benchmark the notification mail pipeline against the App Engine SDK
+service stubs, recording deliveries instead of sending them.
+
+usage: python tools/bench_mail.py --sdk ~/google_appengine
+       [--notifications 5000]
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--notifications', type=int, default=5000)
+    parser.add_argument('--conferences', type=int, default=50)
+    parser.add_argument('--recipients', type=int, default=1000)
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_app_identity_stub()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=APP_DIR)
+
+    import mailer
+    from models import Conference
+    mailer.transport = mailer.RecordingMailTransport()
+
+    c_keys = ndb.put_multi([
+        Conference(name='Conference %d' % i, city='Tokyo',
+                   topics=['Web Technologies'])
+        for i in range(args.conferences)])
+    for i in range(args.notifications):
+        mailer.enqueue(random.choice(['registered', 'waitlistPromoted']),
+                       'user%d@example.com' % random.randrange(
+                           args.recipients),
+                       random.choice(c_keys).urlsafe())
+
+    start = time.time()
+    leased = 1
+    while leased:
+        leased = mailer.processBatch()
+    elapsed = time.time() - start
+
+    sent = len(mailer.transport.deliveries)
+    print('%d notifications, %d sent (%.1f%% deduplicated) in %.2f s: '
+          '%.0f notifications/s' % (
+              args.notifications, sent,
+              100.0 * (args.notifications - sent) / args.notifications,
+              elapsed, args.notifications / elapsed))
+
+
+if __name__ == '__main__':
+    main()
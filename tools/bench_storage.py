@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+bench_storage.py.
+
+Run the same API load scenarios against each storage backend: the
+datastore and memcache service stubs, and a SQLite database with an
+in-process cache. Requests go through the unmodified Endpoints API.
+
+usage: python tools/bench_storage.py --sdk ~/google_appengine [--users 50]
+
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BACKENDS = ['ndb', 'sqlite']
+
+CITIES = ['Tokyo', 'London', 'Chicago', 'Paris']
+TOPICS = ['Web Technologies', 'Programming Languages', 'Medical Innovations',
+          'Movie Making']
+SESSION_TYPES = ['Lecture', 'Keynote', 'Workshop']
+
+
+def _setupSdk(sdk):
+    """Put the SDK on sys.path and activate the service stubs."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+    from google.appengine.ext import testbed
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_app_identity_stub()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=APP_DIR)
+    tb.init_user_stub()
+    return tb
+
+
+class Client(object):
+
+    """Call API methods as a user, timing each call by method."""
+
+    def __init__(self, app):
+        self.app = app
+        self.timings = {}
+
+    def call(self, email, method, **body):
+        import webapp2
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+        request = webapp2.Request.blank(
+            '/_ah/spi/ConferenceApi.%s' % method, POST=json.dumps(body))
+        request.content_type = 'application/json'
+        start = time.time()
+        response = request.get_response(self.app)
+        self.timings.setdefault(method, []).append(time.time() - start)
+        if response.status_int != 200:
+            raise RuntimeError('%s: %s %s' % (method, response.status,
+                                              response.body))
+        return json.loads(response.body)
+
+
+def _scenarios(client, args):
+    """Run the scenarios: setup writes, registrations, then reads."""
+    rnd = random.Random(args.seed)
+    users = ['user%d@example.com' % i for i in range(args.users)]
+    organizers = users[:max(1, args.users // 10)]
+
+    for email in users:
+        client.call(email, 'saveProfile', displayName=email.split('@')[0])
+
+    confs = []
+    for i in range(args.conferences):
+        email = rnd.choice(organizers)
+        conf = client.call(
+            email, 'createConference', name='Conference %d' % i,
+            city=rnd.choice(CITIES), topics=rnd.sample(TOPICS, 2),
+            startDate='2026-%02d-01' % rnd.randint(1, 12),
+            maxAttendees=rnd.randint(args.users // 2, args.users * 2))
+        confs.append((email, conf['websafeKey']))
+        for j in range(args.sessions):
+            client.call(
+                email, 'createSession',
+                websafeConferenceKey=conf['websafeKey'],
+                name='Session %d.%d' % (i, j),
+                speaker='Speaker %d' % rnd.randrange(args.conferences),
+                sessionType=rnd.choice(SESSION_TYPES),
+                startDate='2026-01-01',
+                startTime='%02d:00' % rnd.randint(8, 18))
+
+    for email in users:
+        for owner, wsck in rnd.sample(confs, min(3, len(confs))):
+            client.call(email, 'registerForConference',
+                        websafeConferenceKey=wsck)
+
+    for i in range(args.reads):
+        email = rnd.choice(users)
+        owner, wsck = rnd.choice(confs)
+        client.call(email, 'getProfile')
+        client.call(email, 'getConference', websafeConferenceKey=wsck)
+        client.call(email, 'getConferenceSessions',
+                    websafeConferenceKey=wsck)
+        client.call(email, 'getConferencesToAttend')
+        client.call(email, 'queryConferences', filters=[
+            {'field': 'CITY', 'operator': 'EQ', 'value': rnd.choice(CITIES)},
+            {'field': 'MONTH', 'operator': 'GT',
+             'value': str(rnd.randint(1, 11))}])
+        client.call(email, 'getSessionsBySpeaker',
+                    speaker='Speaker %d' % rnd.randrange(args.conferences))
+        client.call(email, 'getSessionsStartingAfter',
+                    startTime='%02d:00' % rnd.randint(8, 18))
+
+
+def child(args):
+    """Run the scenarios against one backend; print timings as JSON."""
+    path = None
+    if args.child == 'sqlite':
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        os.environ['CONFERENCE_STORAGE'] = 'sqlite:%s' % path
+    else:
+        os.environ['CONFERENCE_STORAGE'] = 'ndb'
+    _setupSdk(args.sdk)
+
+    import ratelimit
+    for endpoint in ratelimit.RATE_LIMITS:
+        ratelimit.RATE_LIMITS[endpoint] = (1e6, 1e6)
+    from conference import api
+
+    client = Client(api)
+    start = time.time()
+    try:
+        _scenarios(client, args)
+    finally:
+        if path:
+            os.remove(path)
+    print(json.dumps({'elapsed': time.time() - start,
+                      'timings': client.timings}))
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--conferences', type=int, default=20)
+    parser.add_argument('--sessions', type=int, default=5,
+                        help='sessions per conference')
+    parser.add_argument('--reads', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--child', choices=BACKENDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    argv = [sys.executable, __file__] + sys.argv[1:]
+    for backend in BACKENDS:
+        out = subprocess.check_output(argv + ['--child', backend])
+        result = json.loads(out.strip().splitlines()[-1])
+        print('%s: %.2f s' % (backend, result['elapsed']))
+        for method, timings in sorted(result['timings'].items()):
+            print('  %-28s %6d calls   p50 %7.2f ms   p95 %7.2f ms' % (
+                method, len(timings), _percentile(timings, 0.5) * 1000,
+                _percentile(timings, 0.95) * 1000))
+
+
+if __name__ == '__main__':
+    main()
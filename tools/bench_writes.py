@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+bench_writes.py.
+
+Count the datastore writes of the API's write scenarios against the SDK
+service stubs: puts, entity and index writes, and latency per put, by
+API method. Runs twice: with the properties no query uses indexed, as
+they were, and with the current models. Unchanged updates make no put.
+
+usage: python tools/bench_writes.py --sdk ~/google_appengine [--users 50]
+
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ['indexed', 'current']
+
+# properties marked unindexed, as no query filters or sorts on them
+UNINDEXED = {
+    'Conference': ['description', 'organizerUserId', 'endDate',
+                   'waitlistSize', 'seatsReleased'],
+    'Session': ['name', 'highlights', 'duration', 'startDate'],
+    'Profile': ['displayName', 'mainEmail', 'teeShirtSize'],
+}
+
+CITIES = ['Tokyo', 'London', 'Chicago', 'Paris']
+TOPICS = ['Web Technologies', 'Programming Languages', 'Medical Innovations',
+          'Movie Making']
+SESSION_TYPES = ['Lecture', 'Keynote', 'Workshop']
+
+
+def _setupSdk(sdk):
+    """Put the SDK on sys.path and activate the service stubs."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+    from google.appengine.ext import testbed
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_app_identity_stub()
+    # the composite indexes of index.yaml count in the index writes
+    tb.init_datastore_v3_stub(root_path=APP_DIR)
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=APP_DIR)
+    tb.init_user_stub()
+    return tb
+
+
+class Client(object):
+
+    """Call API methods as a user, counting their datastore writes."""
+
+    def __init__(self, app):
+        self.app = app
+        self.method = None
+        self.calls = {}
+        self.puts = {}
+        self._started = {}
+
+    def call(self, email, method, **body):
+        import webapp2
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+        request = webapp2.Request.blank(
+            '/_ah/spi/ConferenceApi.%s' % method, POST=json.dumps(body))
+        request.content_type = 'application/json'
+        self.method = method
+        self.calls[method] = self.calls.get(method, 0) + 1
+        response = request.get_response(self.app)
+        self.method = None
+        if response.status_int != 200:
+            raise RuntimeError('%s: %s %s' % (method, response.status,
+                                              response.body))
+        return json.loads(response.body)
+
+    def preCall(self, service, call, request, response):
+        if call in ('Put', 'Commit'):
+            self._started[id(response)] = time.time()
+
+    def postCall(self, service, call, request, response):
+        started = self._started.pop(id(response), None)
+        if started is None or not self.method or not response.has_cost():
+            return
+        cost = response.cost()
+        if not cost.entity_writes() and not cost.index_writes():
+            # a read-only transaction
+            return
+        self.puts.setdefault(self.method, []).append(
+            (cost.entity_writes(), cost.index_writes(),
+             time.time() - started))
+
+
+def _scenarios(client, args):
+    """Run the write scenarios, with a no-op repeat of each update."""
+    rnd = random.Random(args.seed)
+    users = ['user%d@example.com' % i for i in range(args.users)]
+    organizers = users[:max(1, args.users // 10)]
+
+    for email in users:
+        client.call(email, 'saveProfile', displayName=email.split('@')[0],
+                    teeShirtSize='M')
+        client.call(email, 'saveProfile', displayName=email.split('@')[0],
+                    teeShirtSize='M')
+
+    confs = []
+    for i in range(args.conferences):
+        email = rnd.choice(organizers)
+        conf = client.call(
+            email, 'createConference', name='Conference %d' % i,
+            description='About conference %d. ' % i * 20,
+            city=rnd.choice(CITIES), topics=rnd.sample(TOPICS, 2),
+            startDate='2026-%02d-01' % rnd.randint(1, 12),
+            endDate='2026-12-31',
+            maxAttendees=rnd.randint(args.users // 2, args.users * 2))
+        confs.append((email, conf['websafeKey']))
+        for j in range(args.sessions):
+            client.call(
+                email, 'createSession',
+                websafeConferenceKey=conf['websafeKey'],
+                name='Session %d.%d' % (i, j),
+                highlights=['highlight %d' % k for k in range(3)],
+                speaker='Speaker %d' % rnd.randrange(args.conferences),
+                duration=60, sessionType=rnd.choice(SESSION_TYPES),
+                startDate='2026-01-01',
+                startTime='%02d:00' % rnd.randint(8, 18))
+
+    for email, wsck in confs:
+        # the repeated update changes nothing
+        for i in range(2):
+            client.call(email, 'updateConference',
+                        websafeConferenceKey=wsck,
+                        description='Updated description.')
+
+    for email in users:
+        for owner, wsck in rnd.sample(confs, min(3, len(confs))):
+            client.call(email, 'registerForConference',
+                        websafeConferenceKey=wsck)
+            client.call(email, 'unregisterFromConference',
+                        websafeConferenceKey=wsck)
+            client.call(email, 'unregisterFromConference',
+                        websafeConferenceKey=wsck)
+
+
+def child(args):
+    """Run the scenarios in one mode; print the writes as JSON."""
+    _setupSdk(args.sdk)
+
+    import models
+    if args.child == 'indexed':
+        for kind, names in UNINDEXED.items():
+            for name in names:
+                getattr(models, kind)._properties[name]._indexed = True
+
+    import ratelimit
+    for endpoint in ratelimit.RATE_LIMITS:
+        ratelimit.RATE_LIMITS[endpoint] = (1e6, 1e6)
+    from google.appengine.api import apiproxy_stub_map
+    from conference import api
+
+    client = Client(api)
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'bench_writes', client.preCall, 'datastore_v3')
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'bench_writes', client.postCall, 'datastore_v3')
+    _scenarios(client, args)
+    print(json.dumps({'calls': client.calls, 'puts': client.puts}))
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--conferences', type=int, default=20)
+    parser.add_argument('--sessions', type=int, default=5,
+                        help='sessions per conference')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    argv = [sys.executable, __file__] + sys.argv[1:]
+    for mode in MODES:
+        out = subprocess.check_output(argv + ['--child', mode])
+        result = json.loads(out.strip().splitlines()[-1])
+        print('%s:' % mode)
+        for method, calls in sorted(result['calls'].items()):
+            puts = result['puts'].get(method, [])
+            print('  %-26s %5d calls %5d puts   %5.1f entity %6.1f index '
+                  'writes/put   p50 %6.2f ms/put' % (
+                      method, calls, len(puts),
+                      sum(p[0] for p in puts) / float(max(len(puts), 1)),
+                      sum(p[1] for p in puts) / float(max(len(puts), 1)),
+                      _percentile([p[2] for p in puts], 0.5) * 1000
+                      if puts else 0.0))
+
+
+if __name__ == '__main__':
+    main()
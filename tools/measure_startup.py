@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+measure_startup.py.
+
+Measure conference instance cold start: time spent importing the app
+modules and time to serve the first request, each in a fresh interpreter
+against the App Engine SDK service stubs.
+
+usage: python tools/measure_startup.py --sdk ~/google_appengine [--runs 5]
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (label, module imported, path of the first request, WSGI app, body)
+SCENARIOS = [
+    ('api', 'conference', '/_ah/spi/ConferenceApi.getAnnouncement',
+     'api', '{}'),
+    ('handlers', 'main', '/_ah/warmup', 'app', None),
+]
+
+
+def _setupSdk(sdk):
+    """Put the SDK on sys.path and activate the service stubs."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+    from google.appengine.ext import testbed
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_app_identity_stub()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=APP_DIR)
+    tb.init_urlfetch_stub()
+    tb.init_user_stub()
+    tb.init_mail_stub()
+    return tb
+
+
+def child(sdk, scenario):
+    """Time one cold start; print the result as JSON."""
+    label, module, path, app_name, body = [
+        s for s in SCENARIOS if s[0] == scenario][0]
+    _setupSdk(sdk)
+    import webapp2
+
+    start = time.time()
+    app = getattr(__import__(module), app_name)
+    imported = time.time()
+
+    if body is None:
+        request = webapp2.Request.blank(path)
+    else:
+        request = webapp2.Request.blank(path, POST=body)
+        request.content_type = 'application/json'
+    response = request.get_response(app)
+    served = time.time()
+
+    print(json.dumps({
+        'import_ms': (imported - start) * 1000,
+        'first_request_ms': (served - imported) * 1000,
+        'status': response.status_int,
+    }))
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.sdk, args.child)
+        return
+
+    for scenario in SCENARIOS:
+        results = []
+        for i in range(args.runs):
+            out = subprocess.check_output(
+                [sys.executable, __file__, '--sdk', args.sdk,
+                 '--child', scenario[0]])
+            results.append(json.loads(out.strip().splitlines()[-1]))
+        print('%-9s import %7.1f ms   first request %7.1f ms   (%s)' % (
+            scenario[0],
+            _median([r['import_ms'] for r in results]),
+            _median([r['first_request_ms'] for r in results]),
+            ', '.join(str(r['status']) for r in results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,6 @@ import os
 import time
 import uuid
 
-from google.appengine.api import urlfetch
 from models import Conference
 
 
@@ -23,6 +22,8 @@ def getUserId(user, id_type="email"):
 
     if id_type == "oauth":
         """A workaround implementation for getting userid."""
+        # only this rare path needs urlfetch; keep it off the import path
+        from google.appengine.api import urlfetch
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
         token_type = 'id_token'
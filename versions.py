@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+versions.py.
+
+Conference server-side Python App Engine version stamps, bumped whenever
+cached content derived from the datastore must be regenerated
+
+"""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+MEMCACHE_VERSION_KEY = "VERSION:%s:%s"
+CAS_RETRIES = 3
+
+
+def _stamp():
+    """Return a new version: the current time in milliseconds."""
+    return int(time.time() * 1000)
+
+
+def getMulti(names):
+    """
+    Return the versions of (kind, ident) names, as {name: version}.
+
+    A version lost from memcache is restarted at the current time, so
+    content cached under an older version is never served again.
+    """
+    keys = {MEMCACHE_VERSION_KEY % name: name for name in names}
+    versions = memcache.get_multi(keys.keys())
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        stamp = _stamp()
+        memcache.add_multi({key: stamp for key in missing})
+        versions.update(memcache.get_multi(missing))
+    return {name: versions.get(key) for key, name in keys.items()}
+
+
+def get(kind, ident):
+    """Return the version of (kind, ident)."""
+    return getMulti([(kind, ident)])[(kind, ident)]
+
+
+def bump(kind, ident):
+    """
+    Move (kind, ident) to a new version.
+
+    Inside a transaction this only happens once the transaction commits.
+    """
+    def update():
+        # keep versions increasing even for bumps in the same millisecond
+        key = MEMCACHE_VERSION_KEY % (kind, ident)
+        client = memcache.Client()
+        for i in range(CAS_RETRIES):
+            current = client.gets(key)
+            if current is None:
+                if client.add(key, _stamp()):
+                    return
+            elif client.cas(key, max(_stamp(), current + 1)):
+                return
+        client.set(key, _stamp())
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(update)
+    else:
+        update()